@@ -15,20 +15,20 @@ fileConfig(config.config_file_name)
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
-import pvault  # Base package of the app
 from pvault.db import ModelBase  # Base model
-# Import your models here to get the metadata
-import pkgutil
-import inspect
-import importlib
-def load_packages(package):
-    """Load all models module."""
-    for _, package_name, is_pkg in pkgutil.iter_modules(package.__path__):
-        if is_pkg:
-            load_packages(importlib.import_module(f'{package.__name__}.{package_name}'))
-        if package_name == 'models':
-            importlib.import_module(f'{package.__name__}.{package_name}')
-load_packages(pvault)
+if getattr(config.cmd_opts, 'autogenerate', False):
+    # autogenerate needs every model, a model missing from a stale manifest
+    # would be dropped by the generated migration: scan the whole package.
+    import pvault
+    from pvault.registration import collect
+    collect(pvault)
+else:
+    # Import the models modules listed in the manifest (see
+    # pvault.registration)
+    import importlib
+    from pvault.manifest import MODELS
+    for module in MODELS:
+        importlib.import_module(module)
 target_metadata = ModelBase.metadata
 
 # other values from the config, defined by the needs of env.py,
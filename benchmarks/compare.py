@@ -0,0 +1,101 @@
+"""Compare two results of ``benchmarks/suite.py``, fail on regressions.
+
+Exit with 1 if the median time of a hot benchmark grew by more than
+``--threshold`` percent (the other benchmarks are only reported), or if a
+benchmark of the baseline is missing from the current results (renamed or
+deleted)::
+
+    python benchmarks/compare.py baseline.json current.json
+    python benchmarks/compare.py baseline.json current.json --threshold 5
+
+Run both on the same machine, with the same options: the noise of the
+measures is reported (stddev) to choose a threshold above it.
+"""
+import sys
+import json
+import argparse
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+
+def _load(path:str) -> Dict[str, dict]:
+    with open(path, encoding='utf8') as results:
+        return {
+            benchmark['name']: benchmark
+            for benchmark in json.load(results)['benchmarks']
+        }
+
+
+def compare(baseline:Dict[str, dict], current:Dict[str, dict],
+            threshold:float, stat:str='median') -> Tuple[List[str], List[str]]:
+    """Return the report lines and the names of the failed benchmarks: the
+    regressed hot benchmarks and the baseline benchmarks missing from the
+    current results.
+
+    :param baseline: the baseline benchmarks by name
+    :param current: the current benchmarks by name
+    :param threshold: the regression threshold in percent
+    :type threshold: float
+    :param stat: the compared statistic
+    :type stat: str
+    """
+    lines = [
+        f'{"benchmark":<20} {"baseline":>10} {"current":>10} '
+        f'{"change":>8} {"stddev":>8}'
+    ]
+    regressions = []
+    for name, benchmark in baseline.items():
+        if name not in current:
+            regressions.append(name)
+            lines.append(f'{name:<20} {benchmark["stats"][stat]:>10.2f} '
+                         f'{"":>10}  MISSING')
+    for name, benchmark in current.items():
+        if name not in baseline:
+            lines.append(f'{name:<20} {"":>10} '
+                         f'{benchmark["stats"][stat]:>10.2f}  (new)')
+            continue
+        before = baseline[name]['stats'][stat]
+        after = benchmark['stats'][stat]
+        change = (after - before) / before * 100 if before else 0.0
+        noise = benchmark['stats']['stddev'] / after * 100 if after else 0.0
+        flag = ''
+        if change > threshold:
+            if benchmark.get('hot', True):
+                regressions.append(name)
+                flag = '  REGRESSION'
+            else:
+                flag = '  (slower, not hot)'
+        lines.append(
+            f'{name:<20} {before:>10.2f} {after:>10.2f} '
+            f'{change:>+7.1f}% {noise:>7.1f}%{flag}'
+        )
+    return lines, regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='regression threshold in percent')
+    parser.add_argument('--stat', default='median',
+                        choices=('median', 'mean', 'min'))
+    args = parser.parse_args(argv)
+
+    lines, regressions = compare(
+        _load(args.baseline), _load(args.current), args.threshold, args.stat,
+    )
+    print('\n'.join(lines))
+    if regressions:
+        print(f'{len(regressions)} benchmark(s) missing or regressed by more '
+              f'than {args.threshold:g}%: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""Throughput and latency of concurrent logins (master key derivation).
+
+``--clients`` threads, like the threads of the WSGI server, derive keys in
+a loop with :class:`pvault.crypto.CryptoEngine`, in the calling threads
+(``workers = 0``) and in a process pool. A "listing" thread measures how
+long a cheap request waits meanwhile (GIL contention)::
+
+    python benchmarks/crypto_logins.py
+    python benchmarks/crypto_logins.py --clients 16 --workers 4 --n 32768
+"""
+import os
+import time
+import argparse
+import threading
+import statistics
+
+from pvault.crypto import CryptoBusy, CryptoEngine, encrypt
+
+
+def _percentile(values, percent:float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def _run(engine:CryptoEngine, clients:int, duration:float) -> dict:
+    latencies = []
+    listing = []
+    rejected = [0]
+    stop = time.perf_counter() + duration
+    key = os.urandom(32)
+    entries = [encrypt(key, os.urandom(64)) for _ in range(200)]
+
+    def login():
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            try:
+                engine.derive_key('master password', os.urandom(16))
+            except CryptoBusy:
+                rejected[0] += 1
+                time.sleep(0.01)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    def list_vault():
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            engine.decrypt_many(key, entries)
+            listing.append(time.perf_counter() - start)
+            time.sleep(0.005)
+
+    threads = [threading.Thread(target=login) for _ in range(clients)]
+    threads.append(threading.Thread(target=list_vault))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        'logins/s': len(latencies) / duration,
+        'p50 ms': statistics.median(latencies) * 1000,
+        'p99 ms': _percentile(latencies, 99) * 1000,
+        'rejected': rejected[0],
+        'listing p99 ms': _percentile(listing, 99) * 1000,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-pending', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--n', type=int, default=2 ** 14)
+    args = parser.parse_args(argv)
+
+    kdf_params = {'n': args.n, 'r': 8, 'p': 1}
+    columns = None
+    for workers in (0, args.workers):
+        engine = CryptoEngine(
+            workers=workers, max_pending=args.max_pending, timeout=30,
+            kdf_params=kdf_params,
+        )
+        engine.derive_key('warm up', os.urandom(16))
+        try:
+            result = _run(engine, args.clients, args.duration)
+        finally:
+            engine.close()
+        if columns is None:
+            columns = list(result)
+            print(f'{"workers":>8} ' + ' '.join(f'{c:>14}' for c in columns))
+        print(f'{workers:>8} ' + ' '.join(
+            f'{result[c]:>14.1f}' for c in columns
+        ))
+
+
+if __name__ == '__main__':
+    main()
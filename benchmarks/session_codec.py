@@ -0,0 +1,70 @@
+"""Encode / decode speed and stored size of the session codec.
+
+Each representative session shape is encoded with the legacy raw msgpack
+format and with :class:`pvault.codec.SessionCodec` for every available
+compression::
+
+    python benchmarks/session_codec.py
+"""
+import uuid
+import timeit
+import argparse
+import datetime
+
+import msgpack
+
+from pvault.codec import COMPRESSIONS, SessionCodec
+
+
+def _shapes() -> dict:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return {
+        'counter': {'counter': 1},
+        'flash': {
+            'counter': 12,
+            '_flash_messages.success': ['Counter updated'] * 5,
+            '_flash_messages.error': ['Invalid master password'],
+        },
+        'user': {
+            'user_id': str(uuid.uuid4()),
+            'login': now.isoformat(),
+            'roles': ['admin', 'user'],
+            'history': [f'/vault/entry/{i}' for i in range(50)],
+            'preferences': {f'pref_{i}': 'x' * 20 for i in range(30)},
+        },
+    }
+
+
+def _legacy_dumps(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _legacy_loads(bdata):
+    return msgpack.unpackb(bdata, raw=False, use_list=True)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=10000)
+    parser.add_argument('--threshold', type=int, default=256)
+    args = parser.parse_args(argv)
+
+    codecs = {'legacy': (_legacy_dumps, _legacy_loads)}
+    for compression in COMPRESSIONS:
+        codec = SessionCodec(compression, args.threshold)
+        codecs[compression] = (codec.dumps, codec.loads)
+
+    print(f'{"shape":>8} {"codec":>7} {"bytes":>7} {"encode us":>10} '
+          f'{"decode us":>10}')
+    for shape, value in _shapes().items():
+        for name, (dumps, loads) in codecs.items():
+            bdata = dumps(value)
+            encode = timeit.timeit(lambda: dumps(value), number=args.number)
+            decode = timeit.timeit(lambda: loads(bdata), number=args.number)
+            print(f'{shape:>8} {name:>7} {len(bdata):>7} '
+                  f'{encode / args.number * 1e6:>10.2f} '
+                  f'{decode / args.number * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
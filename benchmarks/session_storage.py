@@ -0,0 +1,115 @@
+"""Compare the blob and hash session storage modes.
+
+For each mode a session of representative size is loaded, one key is
+modified (like ``test_session_view`` does with the counter) and the session
+is saved. The script report the number of bytes sent to redis for the save
+and the mean latency of a load / modify / save cycle.
+
+By default an in-memory redis (fakeredis) is used, use ``--redis-url`` to
+run against a real server::
+
+    python benchmarks/session_storage.py --redis-url redis://localhost:6379
+"""
+import time
+import argparse
+
+import redis
+from pyramid import testing
+from redis.client import Pipeline
+
+from pvault.ring import HashRing
+from pvault.sessions import PVaultSession, PVaultSessionFactory
+
+
+def _payload_size(command_stack) -> int:
+    size = 0
+    for args, _ in command_stack:
+        for arg in args:
+            if isinstance(arg, dict):
+                arg = b''.join(
+                    str(k).encode('utf8') + v for k, v in arg.items()
+                )
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf8')
+            size += len(arg)
+    return size
+
+
+class _CountingPipeline(Pipeline):
+    written = 0
+
+    def execute(self, *args, **kwargs):
+        _CountingPipeline.written += _payload_size(self.command_stack)
+        return super().execute(*args, **kwargs)
+
+
+def _make_session() -> PVaultSession:
+    session = PVaultSession()
+    session['counter'] = 1
+    session['user'] = {'id': 42, 'name': 'marc', 'roles': ['admin', 'user']}
+    session['history'] = [f'/vault/entry/{i}' for i in range(50)]
+    session['preferences'] = {f'pref_{i}': 'x' * 20 for i in range(30)}
+    return session
+
+
+def _request(factory, cookie=None):
+    request = testing.DummyRequest(scheme='http')
+    if cookie is not None:
+        request.cookies[factory.cookie_name] = cookie
+    return request
+
+
+def run(storage:str, client, iterations:int) -> dict:
+    factory = PVaultSessionFactory('seekrit', None, None, storage=storage)
+    factory.ring = HashRing({'default': client})
+
+    request = _request(factory)
+    request.session = _make_session()
+    factory._process_response(request, request.response)
+    cookie = request.response.headers['Set-Cookie'].split(';')[0]
+    cookie = cookie.split('=', 1)[1]
+
+    _CountingPipeline.written = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        request = _request(factory, cookie)
+        session = factory(request)
+        session['counter'] += 1
+        request.session = session
+        factory._process_response(request, request.response)
+    elapsed = time.perf_counter() - start
+    return {
+        'storage': storage,
+        'bytes_per_save': _CountingPipeline.written / iterations,
+        'latency_ms': elapsed / iterations * 1000,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default=None)
+    parser.add_argument('-n', '--iterations', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    if args.redis_url is None:
+        import fakeredis
+        client = fakeredis.FakeStrictRedis()
+    else:
+        client = redis.StrictRedis.from_url(args.redis_url)
+    client.pipeline = lambda transaction=True, shard_hint=None: (
+        _CountingPipeline(
+            client.connection_pool, client.response_callbacks,
+            transaction, shard_hint,
+        )
+    )
+
+    for storage in PVaultSessionFactory.storages:
+        result = run(storage, client, args.iterations)
+        print(
+            '{storage:>5}: {bytes_per_save:8.1f} bytes/save '
+            '{latency_ms:8.3f} ms/request'.format(**result)
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""Benchmark suite of the sessions and of the requests hot paths.
+
+The benchmarks:
+
+- ``session_*``: :class:`pvault.sessions.PVaultSession` mutation and flash
+  messages,
+- ``factory_*``: :class:`pvault.sessions.PVaultSessionFactory` load and
+  save of a session in redis,
+- ``signer_*``: sign / unsign of the session cookie
+  (``itsdangerous.TimestampSigner``),
+- ``wsgi_*``: WSGI round-trips through :func:`pvault.main` with WebTest
+  for ``/``, ``/testsession`` and a static asset.
+
+Each benchmark is calibrated to run ``--min-time`` seconds per round, the
+statistics (microseconds per call) are computed over ``--rounds``
+rounds. ``--json`` stores the results (pytest-benchmark like layout) for
+``benchmarks/compare.py``::
+
+    python benchmarks/suite.py --json baseline.json
+    # ... change the code ...
+    python benchmarks/suite.py --json current.json
+    python benchmarks/compare.py baseline.json current.json
+
+By default an in-memory redis (fakeredis) is used, use ``--redis-url`` to
+run against a real server. ``-k`` selects the benchmarks containing a
+string.
+"""
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import datetime
+import statistics
+import subprocess
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+)
+
+import redis
+from pyramid import testing
+from pyramid.interfaces import ISessionFactory
+
+from pvault import main as make_app
+from pvault.assets import build_manifest
+from pvault.ring import HashRing
+from pvault.sessions import PVaultSession, PVaultSessionFactory
+
+# name -> (group, hot, setup)
+BENCHMARKS: Dict[str, tuple] = {}
+
+
+def benchmark(group:str, hot:bool=True):
+    """Register a benchmark.
+
+    The decorated function receive the command line options and return the
+    function to time. The regressions of the ``hot`` benchmarks fail
+    ``compare.py``.
+    """
+    def register(setup:Callable) -> Callable:
+        BENCHMARKS[setup.__name__] = (group, hot, setup)
+        return setup
+    return register
+
+
+def _make_session() -> PVaultSession:
+    session = PVaultSession()
+    session['counter'] = 1
+    session['user'] = {'id': 42, 'name': 'marc', 'roles': ['admin', 'user']}
+    session['history'] = [f'/vault/entry/{i}' for i in range(50)]
+    session['preferences'] = {f'pref_{i}': 'x' * 20 for i in range(30)}
+    return session
+
+
+def _client(options):
+    if options.redis_url is None:
+        import fakeredis
+        return fakeredis.FakeStrictRedis()
+    return redis.StrictRedis.from_url(options.redis_url)
+
+
+def _factory(options) -> PVaultSessionFactory:
+    factory = PVaultSessionFactory('seekrit', None, None)
+    factory.ring = HashRing({'default': _client(options)})
+    return factory
+
+
+def _request(factory:PVaultSessionFactory, cookie=None):
+    request = testing.DummyRequest(scheme='http')
+    if cookie is not None:
+        request.cookies[factory.cookie_name] = cookie
+    return request
+
+
+def _saved_cookie(factory:PVaultSessionFactory) -> str:
+    request = _request(factory)
+    request.session = _make_session()
+    factory._process_response(request, request.response)
+    cookie = request.response.headers['Set-Cookie'].split(';')[0]
+    return cookie.split('=', 1)[1]
+
+
+@benchmark('session')
+def session_setitem(options):
+    session = _make_session()
+
+    def run():
+        session['counter'] += 1
+    return run
+
+
+@benchmark('session')
+def session_flash(options):
+    session = _make_session()
+
+    def run():
+        session.flash('Counter updated', queue='success')
+        session.pop_flash(queue='success')
+    return run
+
+
+@benchmark('factory')
+def factory_load(options):
+    factory = _factory(options)
+    cookie = _saved_cookie(factory)
+
+    def run():
+        factory(_request(factory, cookie))
+    return run
+
+
+@benchmark('factory')
+def factory_save(options):
+    factory = _factory(options)
+    session = factory(_request(factory, _saved_cookie(factory)))
+
+    def run():
+        request = _request(factory)
+        session['counter'] += 1
+        request.session = session
+        factory._process_response(request, request.response)
+    return run
+
+
+@benchmark('signer')
+def signer_sign(options):
+    signer = _factory(options).signer
+
+    def run():
+        signer.sign(b'session-id-0123456789abcdef')
+    return run
+
+
+@benchmark('signer')
+def signer_unsign(options):
+    factory = _factory(options)
+    signed = factory.signer.sign(b'session-id-0123456789abcdef')
+
+    def run():
+        factory.signer.unsign(signed, max_age=factory.max_age,
+                              return_timestamp=True)
+    return run
+
+
+def _testapp(options):
+    from webtest import TestApp
+    app = make_app({}, **{
+        'sqlalchemy.url': 'sqlite://',
+        'pvault.registration': 'manifest',
+    })
+    factory = app.registry.queryUtility(ISessionFactory)
+    factory.ring = HashRing({'default': _client(options)})
+    return TestApp(app)
+
+
+@benchmark('wsgi')
+def wsgi_home(options):
+    testapp = _testapp(options)
+
+    def run():
+        testapp.get('/', status=200)
+    return run
+
+
+@benchmark('wsgi')
+def wsgi_testsession(options):
+    testapp = _testapp(options)
+    testapp.get('/testsession', status=200)
+
+    def run():
+        testapp.get('/testsession', status=200)
+    return run
+
+
+@benchmark('wsgi', hot=False)
+def wsgi_static(options):
+    from pyramid.path import AssetResolver
+    testapp = _testapp(options)
+    manifest = build_manifest(
+        AssetResolver().resolve('pvault:static').abspath()
+    )
+    path = '/static/' + manifest['theme.css']
+
+    def run():
+        testapp.get(path, status=200)
+    return run
+
+
+def measure(function:Callable, rounds:int, min_time:float) -> dict:
+    """Return the statistics of a function, in microseconds per call."""
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / elapsed))
+    times = [
+        elapsed / number * 1e6
+        for elapsed in timer.repeat(repeat=rounds, number=number)
+    ]
+    return {
+        'min': min(times),
+        'max': max(times),
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'stddev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'rounds': rounds,
+        'iterations': number,
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(options) -> dict:
+    results: List[dict] = []
+    print(f'{"benchmark":<20} {"median us":>10} {"stddev":>8} {"min":>10}')
+    for name, (group, hot, setup) in BENCHMARKS.items():
+        if options.k and options.k not in name:
+            continue
+        stats = measure(setup(options), options.rounds, options.min_time)
+        results.append({
+            'name': name, 'group': group, 'hot': hot, 'stats': stats,
+        })
+        print(f'{name:<20} {stats["median"]:>10.2f} '
+              f'{stats["stddev"]:>8.2f} {stats["min"]:>10.2f}')
+    return {
+        'machine_info': {
+            'python_version': platform.python_version(),
+            'python_implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'node': platform.node(),
+        },
+        'commit_info': {'id': _commit()},
+        'datetime': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'options': {
+            'redis': 'fakeredis' if options.redis_url is None else 'redis',
+            'rounds': options.rounds,
+            'min_time': options.min_time,
+        },
+        'benchmarks': results,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default=None)
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds per round')
+    parser.add_argument('-k', default=None,
+                        help='run the benchmarks containing this string')
+    parser.add_argument('--json', default=None,
+                        help='store the results in this file')
+    options = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results = run(options)
+    if options.json:
+        with open(options.json, 'w', encoding='utf8') as output:
+            json.dump(results, output, indent=2)
+    print(f'{len(results["benchmarks"])} benchmarks in '
+          f'{time.perf_counter() - start:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""First request and steady-state render times of the templates.
+
+Each round creates a new application (a new worker) and requests ``/``
+and ``/test`` once (first request: the templates are compiled or loaded
+from the bytecode cache), then ``--number`` times (steady state)::
+
+    python benchmarks/template_render.py
+    python benchmarks/template_render.py --rounds 50
+
+The modes: no bytecode cache, a filesystem cache filled by
+:func:`pvault.templating.precompile` and a redis cache (fakeredis) filled
+the same way. The redis of the sessions is replaced by fakeredis.
+"""
+import time
+import argparse
+import tempfile
+import statistics
+
+import fakeredis
+from webtest import TestApp
+from jinja2.bccache import MemcachedBytecodeCache
+from pyramid.config import Configurator
+
+from pvault import make_config, session_factory_from_settings
+from pvault.ring import HashRing
+from pvault.templating import (
+    RedisBytecodeClient,
+    get_environment,
+    precompile,
+    template_names,
+)
+
+PATHS = ('/', '/test')
+
+
+def _settings(mode:str, directory:str, server) -> dict:
+    settings = {
+        'sqlalchemy.url': 'sqlite://',
+        'hero_million.session.secret': 'seekrit',
+    }
+    if mode == 'filesystem':
+        settings['jinja2.bytecode_caching'] = 'true'
+        settings['jinja2.bytecode_caching_directory'] = directory
+    elif mode == 'redis':
+        settings['jinja2.bytecode_caching'] = MemcachedBytecodeCache(
+            RedisBytecodeClient(fakeredis.FakeStrictRedis(server=server)),
+            prefix='pvault/jinja2/',
+        )
+    return settings
+
+
+def _precompile(settings:dict) -> None:
+    config = Configurator(settings=dict(settings), package='pvault')
+    config.include('pyramid_jinja2')
+    config.commit()
+    precompile(get_environment(config.registry), template_names())
+
+
+def _app(settings:dict) -> TestApp:
+    factory = session_factory_from_settings(settings)
+    factory.ring = HashRing({'default': fakeredis.FakeStrictRedis()})
+    return TestApp(make_config(dict(settings), factory).make_wsgi_app())
+
+
+def _run(settings:dict, rounds:int, number:int) -> dict:
+    first = []
+    steady = []
+    for _ in range(rounds):
+        app = _app(settings)
+        start = time.perf_counter()
+        for path in PATHS:
+            app.get(path)
+        first.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(number):
+            for path in PATHS:
+                app.get(path)
+        steady.append((time.perf_counter() - start) / number)
+    return {
+        'first ms': statistics.median(first) * 1000,
+        'steady ms': statistics.median(steady) * 1000,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('-n', '--number', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    server = fakeredis.FakeServer()
+    print(f'{"mode":>10} {"first ms":>10} {"steady ms":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ('none', 'filesystem', 'redis'):
+            settings = _settings(mode, directory, server)
+            if mode != 'none':
+                _precompile(settings)
+            result = _run(settings, args.rounds, args.number)
+            print(f'{mode:>10} {result["first ms"]:>10.2f} '
+                  f'{result["steady ms"]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
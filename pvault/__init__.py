@@ -1,32 +1,157 @@
+import os
+import weakref
+
 from pyramid.config import Configurator
+from pyramid.interfaces import ISessionFactory
+from pyramid.settings import aslist
 
-from .sessions import PVaultSessionFactory
+from .codec import SessionCodec
+from .sessions import PVaultSessionFactory, PVaultCSRFStoragePolicy
 
 
-def main(global_config, **settings):
-    """This function returns a Pyramid WSGI application.
+def _redis_options(settings):
+    """Return the options of the sessions redis connection pools."""
+    prefix = 'hero_million.session.redis.'
+    options = {}
+    for name, convert in (
+        ('max_connections', int),
+        ('socket_timeout', float),
+        ('socket_connect_timeout', float),
+    ):
+        if prefix + name in settings:
+            options[name] = convert(settings[prefix + name])
+    return options
 
-    This is the entrypoint of the application.
+
+def session_factory_from_settings(settings, factory=PVaultSessionFactory):
+    """Create the sessions factory from the settings.
+
+    ``hero_million.session.secret`` is required: it signs the cookies,
+    encrypts the sessions stored in the cookies and, unless
+    ``hero_million.session.csrf.secrets`` is set, signs the CSRF tokens.
+
+    :param settings: the application settings
+    :type settings: dict
+    :param factory: the session factory class
     """
-    # Sessions Factory
-    session_factory = PVaultSessionFactory(
-        'seekrit',
-        settings['hero_million.session.redis.host'],
-        settings['hero_million.session.redis.port']
+    secret = settings.get('hero_million.session.secret', '').strip()
+    if not secret:
+        raise ValueError('hero_million.session.secret is required')
+    return factory(
+        secret,
+        settings.get('hero_million.session.redis.host'),
+        settings.get('hero_million.session.redis.port'),
+        cache_size=int(settings.get('hero_million.session.cache.size', 0)),
+        cache_ttl=int(settings.get('hero_million.session.cache.ttl', 60)),
+        storage=settings.get('hero_million.session.storage', 'blob'),
+        touch_interval=int(
+            settings.get('hero_million.session.touch_interval', 0)
+        ),
+        cookie_max_size=int(
+            settings.get('hero_million.session.cookie_max_size', 0)
+        ),
+        redis_nodes=aslist(settings.get('hero_million.session.redis.nodes', '')),
+        redis_options=_redis_options(settings),
+        codec=SessionCodec(
+            settings.get('hero_million.session.codec.compression', 'zlib'),
+            int(settings.get('hero_million.session.codec.threshold', 1024)),
+        ),
+        csrf_secrets=aslist(
+            settings.get('hero_million.session.csrf.secrets', '')
+        ) or None,
     )
+
+
+def make_config(settings, session_factory):
+    """Return the configurator of the application.
+
+    :param settings: the application settings
+    :type settings: dict
+    :param session_factory: the sessions factory
+    """
     # Configurations
     config = Configurator(
         settings=settings,
         session_factory=session_factory
     )
+    config.set_csrf_storage_policy(PVaultCSRFStoragePolicy())
 
     # Include external packages / modules
+    config.include('.templating')
     config.include('pyramid_jinja2')
 
     # Include internal packages / modules
+    config.include('.security')
     config.include('.db')
+    config.include('.crypto')
+    config.include('.metrics')
+    config.include('.conditional')
     config.include('.routes')
 
-    # Scan
-    config.scan()
+    # Views: scan or manifest
+    config.include('.registration')
+    return config
+
+
+# Registries of the applications created in this process (by id, the
+# registries are dicts), reset by post_fork in the forked processes
+_fork_registries = weakref.WeakValueDictionary()
+_fork_hook_registered = False
+
+
+def post_fork(registry):
+    """Reset the connection pools in a forked worker process.
+
+    The SQLAlchemy and redis connections and the crypto process pool created
+    by the parent process must not be shared by the workers. The
+    applications created by :func:`main` are reset by
+    :func:`register_post_fork`, it works with any pre-fork server (gunicorn
+    ``--preload``, uwsgi...). It can also be called from a gunicorn
+    ``post_fork`` hook.
+
+    :param registry: the registry of the application
+    """
+    from .db import dispose_engine
+    dispose_engine(registry)
+    registry['crypto'].reset()
+    if 'listing_cache' in registry:
+        registry['listing_cache'].client.connection_pool.reset()
+    if 'template_cache' in registry:
+        registry['template_cache'].client.client.connection_pool.reset()
+    session_factory = registry.queryUtility(ISessionFactory)
+    if hasattr(session_factory, 'reset_pools'):
+        session_factory.reset_pools()
+
+
+def _after_fork_in_child():
+    for registry in list(_fork_registries.values()):
+        post_fork(registry)
+
+
+def register_post_fork(registry):
+    """Call :func:`post_fork` for the registry in the processes forked from
+    this one.
+
+    The :func:`os.register_at_fork` hook is registered once per process and
+    the registries are weakly referenced: creating applications doesn't
+    accumulate hooks nor keep the old applications alive.
+
+    :param registry: the registry of the application
+    """
+    global _fork_hook_registered
+    _fork_registries[id(registry)] = registry
+    if not _fork_hook_registered:
+        os.register_at_fork(after_in_child=_after_fork_in_child)
+        _fork_hook_registered = True
+
+
+def main(global_config, **settings):
+    """This function returns a Pyramid WSGI application.
+
+    This is the entrypoint of the application.
+    """
+    # Sessions Factory
+    session_factory = session_factory_from_settings(settings)
+    config = make_config(settings, session_factory)
+    register_post_fork(config.registry)
     return config.make_wsgi_app()
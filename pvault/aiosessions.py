@@ -0,0 +1,160 @@
+"""asyncio implementation of the session factory.
+
+:class:`AsyncPVaultSessionFactory` store the sessions exactly like
+:class:`pvault.sessions.PVaultSessionFactory` (same keys, codec, cookies
+and semantics) but talk to redis with ``redis.asyncio`` on the event loop
+of the ASGI application (see :mod:`pvault.asgi`).
+
+The pyramid views still run in worker threads, so the factory is used in
+two steps:
+
+- :meth:`AsyncPVaultSessionFactory.load` is awaited by the ASGI
+  application before the view is called, the session is then given to
+  pyramid through the WSGI environ. Sessions not preloaded are loaded on
+  the event loop when the view first access them.
+- the response callback only queue the redis commands,
+  :meth:`AsyncPVaultSessionFactory.save` execute them on the event loop
+  once the view returned.
+
+Flash messages are pushed with the session save, and popped on the event
+loop too, the view thread wait for the result.
+"""
+import asyncio
+
+from typing import (
+    Optional,
+    Tuple,
+)
+
+import redis.asyncio
+
+from pyramid.request import Request
+from pyramid.response import Response
+
+from .sessions import PVaultSession, PVaultSessionFactory, _to_int
+
+
+class AsyncPVaultSessionFactory(PVaultSessionFactory):
+    """PVaultSession factory using redis.asyncio."""
+
+    redis_module = redis.asyncio
+
+    # WSGI environ keys
+    environ_key = 'pvault.session'
+    pending_key = 'pvault.session.pending'
+
+    # The event loop of the ASGI application, set on the first request.
+    loop = None
+
+    def _run(self, coroutine):
+        """Run a coroutine on the event loop from a view thread."""
+        if self.loop is None:
+            raise RuntimeError('The session factory has no event loop')
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _afetch(self, session_id:str) -> Tuple[
+            Optional[dict], Optional[int]]:
+        """asyncio version of :meth:`PVaultSessionFactory._fetch`."""
+        pipe = self.ring.get(session_id).pipeline(transaction=True)
+        self._queue_fetch(session_id, pipe)
+        reply, generation = await pipe.execute()
+        data = self._decode(reply)
+        if data is None:
+            return None, None
+        return data, _to_int(generation)
+
+    async def _aload(self, session_id:str) -> Optional[dict]:
+        """asyncio version of :meth:`PVaultSessionFactory._load`."""
+        if self.cache is not None and session_id in self.cache:
+            data = self._cache_get(
+                session_id,
+                await self.ring.get(session_id).get(
+                    self._redis_generation_key(session_id)
+                ),
+            )
+            if data is not None:
+                return data
+        elif self.cache is not None:
+            self.cache.misses += 1
+
+        data, generation = await self._afetch(session_id)
+        self._cache_set(session_id, data, generation)
+        return data
+
+    async def _asession(self, environ:dict) -> PVaultSession:
+        """Return the session of the request, loaded from the cookie or
+        from redis."""
+        session, session_id, renewed = self._parse_cookie(
+            Request(environ).cookies.get(self.cookie_name)
+        )
+        if session is None:
+            session = self._make_session(
+                await self._aload(session_id), session_id, renewed
+            )
+        return session
+
+    async def load(self, environ:dict) -> PVaultSession:
+        """Load the session of the request and store it in the environ.
+
+        :param environ: the WSGI environ of the request
+        :type environ: dict
+        :return: the session
+        :rtype: PVaultSession
+        """
+        session = environ[self.environ_key] = await self._asession(environ)
+        return session
+
+    async def save(self, environ:dict) -> None:
+        """Execute the redis commands queued by the response callback.
+
+        :param environ: the WSGI environ of the request
+        :type environ: dict
+        """
+        pending = environ.pop(self.pending_key, None)
+        if pending is None:
+            return
+        session, pipes, generation_index = pending
+        results = {}
+        for name, pipe in pipes.items():
+            results[name] = await pipe.execute()
+        self._saved(session, results, generation_index)
+
+    async def close(self) -> None:
+        """Close the connection pools of the redis nodes."""
+        for client in self.ring.nodes.values():
+            await client.aclose()
+
+    def _process_request(self, request:Request) -> PVaultSession:
+        request.add_response_callback(self._process_response)
+        # Only the first attempt uses the preloaded session, the retries of
+        # pyramid_retry (same environ) reload it
+        session = request.environ.pop(self.environ_key, None)
+        if session is None:
+            session = self._run(self._asession(request.environ))
+        return session
+
+    def _process_response(self, request:Request, response:Response) -> None:
+        pipes, generation_index = self._prepare_response(request, response)
+        request.environ[self.pending_key] = (
+            request.session, pipes, generation_index
+        )
+
+    async def _apop_flash(self, session_id:str, queue_key:str) -> list:
+        key = self._redis_flash_key(session_id, queue_key)
+        pipe = self.ring.get(session_id).pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        values, _ = await pipe.execute()
+        return self._decode_flash(values)
+
+    async def _apeek_flash(self, session_id:str, queue_key:str) -> list:
+        key = self._redis_flash_key(session_id, queue_key)
+        return self._decode_flash(
+            await self.ring.get(session_id).lrange(key, 0, -1)
+        )
+
+    def pop_flash(self, session_id:str, queue_key:str) -> list:
+        return self._run(self._apop_flash(session_id, queue_key))
+
+    def peek_flash(self, session_id:str, queue_key:str) -> list:
+        return self._run(self._apeek_flash(session_id, queue_key))
@@ -0,0 +1,238 @@
+"""ASGI entry point of the application.
+
+The pyramid application is a WSGI application, views (and the database
+work they do through pyramid_tm) run in a bounded pool of threads. The
+session I/O is done on the event loop by
+:class:`pvault.aiosessions.AsyncPVaultSessionFactory`:
+
+1. the request body is received and the session is loaded on the event
+   loop,
+2. the pyramid application is called in a worker thread,
+3. the session is saved on the event loop,
+4. the response is streamed to the client, the body iterator is consumed
+   in a worker thread.
+
+Slow clients are handled by the event loop, they only hold a thread while
+the view is running.
+
+With a paste deploy ini file use ``use = egg:pvault#asgi``, or run the
+application with an ASGI server::
+
+    PVAULT_INI=production.ini uvicorn --factory pvault.asgi:from_ini
+"""
+import io
+import os
+import sys
+import asyncio
+import logging
+import itertools
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Callable,
+    Iterable,
+    Tuple,
+)
+
+from . import make_config, register_post_fork, session_factory_from_settings
+from .aiosessions import AsyncPVaultSessionFactory
+
+log = logging.getLogger(__name__)
+
+
+def _environ(scope:dict, body:bytes) -> dict:
+    """Build the WSGI environ of an ASGI http scope."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode(
+            'latin1'
+        ),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        if key in environ:
+            # RFC 6265: the cookie-pairs are separated by "; "
+            separator = '; ' if key == 'HTTP_COOKIE' else ','
+            value = f'{environ[key]}{separator}{value}'
+        environ[key] = value
+    return environ
+
+
+class PVaultASGIApp(object):
+    """ASGI application running the pyramid WSGI application.
+
+    :param wsgi_app: the pyramid WSGI application
+    :param session_factory: the asyncio session factory of the application
+    :type session_factory: AsyncPVaultSessionFactory
+    :param threads: number of threads running the views
+    :type threads: int
+    :param preload_exclude: path prefixes for which the session is not
+        preloaded (it's still loaded if the view use it)
+    """
+
+    def __init__(self, wsgi_app:Callable,
+                 session_factory:AsyncPVaultSessionFactory,
+                 threads:int=32,
+                 preload_exclude:Tuple[str, ...]=('/static/',)) -> None:
+        self.wsgi_app = wsgi_app
+        self.session_factory = session_factory
+        self.preload_exclude = preload_exclude
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='pvault'
+        )
+
+    async def __call__(self, scope:dict, receive:Callable,
+                       send:Callable) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported scope type: {scope["type"]}')
+
+    async def _lifespan(self, receive:Callable, send:Callable) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.session_factory.loop = asyncio.get_running_loop()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.session_factory.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope:dict, receive:Callable, send:Callable) -> None:
+        loop = asyncio.get_running_loop()
+        self.session_factory.loop = loop
+
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        environ = _environ(scope, b''.join(body))
+
+        factory = self.session_factory
+        if not scope['path'].startswith(self.preload_exclude) \
+                and factory.cookie_name in environ.get('HTTP_COOKIE', ''):
+            await factory.load(environ)
+
+        try:
+            status, headers, chunks, app_iter = await loop.run_in_executor(
+                self.executor, self._call_wsgi, environ
+            )
+        except Exception:
+            log.exception('Error calling the application for %s',
+                          scope['path'])
+            await send({
+                'type': 'http.response.start',
+                'status': 500,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')],
+            })
+            await send({
+                'type': 'http.response.body',
+                'body': b'Internal Server Error',
+            })
+            return
+        try:
+            await factory.save(environ)
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': headers,
+            })
+            iterator = iter(chunks)
+            while True:
+                chunk = await loop.run_in_executor(
+                    self.executor, next, iterator, None
+                )
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(app_iter, 'close'):
+                await loop.run_in_executor(self.executor, app_iter.close)
+
+    def _call_wsgi(self, environ:dict) -> Tuple[
+            int, list, Iterable[bytes], Iterable[bytes]]:
+        """Call the WSGI application, run in a worker thread.
+
+        :return: the status, the headers, the body chunks and the iterable
+            returned by the application (to close it).
+        :rtype: tuple
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1'))
+                for name, value in headers
+            ]
+            return lambda data: None
+
+        app_iter = chunks = self.wsgi_app(environ, start_response)
+        if 'status' not in response:
+            # start_response is called on the first iteration
+            iterator = iter(app_iter)
+            chunks = itertools.chain([next(iterator, b'')], iterator)
+        return response['status'], response['headers'], chunks, app_iter
+
+
+def main(global_config, **settings):
+    """This function returns the pyramid application as an ASGI application.
+
+    This is the ``asgi`` paste deploy entrypoint of the application.
+    """
+    session_factory = session_factory_from_settings(
+        settings, AsyncPVaultSessionFactory
+    )
+    config = make_config(settings, session_factory)
+    register_post_fork(config.registry)
+    return PVaultASGIApp(
+        config.make_wsgi_app(),
+        session_factory,
+        threads=int(settings.get('pvault.asgi.threads', 32)),
+    )
+
+
+def from_ini(path:str=None):
+    """Return the ASGI application configured by an ini file.
+
+    :param path: the ini file, the ``PVAULT_INI`` environment variable is
+        used if not given.
+    :type path: str
+    """
+    from pyramid.paster import get_appsettings, setup_logging
+    path = path or os.environ['PVAULT_INI']
+    setup_logging(path)
+    return main({}, **get_appsettings(path))
@@ -0,0 +1,155 @@
+"""Fingerprinted static assets.
+
+The manifest of the static directory is computed once at startup: each
+file gets a name containing the hash of its content
+(``theme.css`` -> ``theme.1a2b3c4d5e6f.css``), ``request.static_url``
+emits the hashed names.
+
+The hashed names are served by the static view with a one year
+``immutable`` max-age: a new deployment changes the names of the modified
+assets only. The unhashed names are still served, with the
+``pvault.static.max_age`` setting.
+
+The precompressed ``.br`` / ``.gz`` variants of a file, when present next
+to it, are served to the clients accepting them (``Vary:
+Accept-Encoding``).
+"""
+import os
+import hashlib
+
+from typing import Dict
+
+from pyramid.path import AssetResolver
+from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.static import static_view
+
+# Max-age of the hashed assets
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Extensions of the precompressed variants
+COMPRESSED = ('.br', '.gz')
+
+
+def build_manifest(directory:str) -> Dict[str, str]:
+    """Return the hashed name of the files of a directory.
+
+    :param directory: the static directory
+    :type directory: str
+    :return: the hashed path by path, relative to the directory
+    :rtype: dict
+    """
+    manifest = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(COMPRESSED):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as asset:
+                digest = hashlib.sha256(asset.read()).hexdigest()[:12]
+            relative = os.path.relpath(path, directory).replace(os.sep, '/')
+            base, ext = os.path.splitext(relative)
+            manifest[relative] = f'{base}.{digest}{ext}'
+    return manifest
+
+
+def manifest_digest(manifest:Dict[str, str]) -> str:
+    """Return a hash of a manifest, changing with the content of any
+    asset."""
+    digest = hashlib.sha1()
+    for relative, hashed in sorted(manifest.items()):
+        digest.update(f'{relative}\0{hashed}\0'.encode('utf8'))
+    return digest.hexdigest()
+
+
+class ContentHashCacheBuster(object):
+    """Cache buster using the manifest computed by :func:`build_manifest`."""
+
+    def __init__(self, manifest:Dict[str, str]) -> None:
+        self.manifest = manifest
+
+    def __call__(self, request, subpath:str, kw:dict):
+        return self.manifest.get(subpath, subpath), kw
+
+
+class ManifestAssetPredicate(object):
+    """View predicate matching the names, hashed or not, of a manifest."""
+
+    def __init__(self, manifest:Dict[str, str], config) -> None:
+        self.names = set(manifest) | set(manifest.values())
+
+    def text(self) -> str:
+        return 'manifest_asset'
+
+    phash = text
+
+    def __call__(self, context, request) -> bool:
+        return '/'.join(request.subpath) in self.names
+
+
+def manifest_static_view(directory:str, manifest:Dict[str, str],
+                         max_age:int, content_encodings=()):
+    """Return the view serving the assets of a manifest from ``directory``.
+
+    The hashed names are served with the immutable max-age, the others with
+    ``max_age``.
+    """
+    originals = {hashed: path for path, hashed in manifest.items()}
+    serve = static_view(
+        directory, cache_max_age=max_age, use_subpath=True,
+        content_encodings=content_encodings,
+    )
+
+    def manifest_view(context, request):
+        subpath = '/'.join(request.subpath)
+        if subpath not in originals:
+            return serve(context, request)
+        request.subpath = tuple(originals[subpath].split('/'))
+        response = serve(context, request)
+        response.cache_expires(IMMUTABLE_MAX_AGE)
+        response.headers['Cache-Control'] = \
+            f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        return response
+    return manifest_view
+
+
+def add_hashed_static_view(config, name:str, spec:str,
+                           max_age:int=3600) -> None:
+    """Add a static view serving the fingerprinted assets of ``spec``.
+
+    The static view generates the URLs and serves the files added after the
+    startup. The assets of the manifest are served from the directory by a
+    second view of the static view route, selected by the
+    ``manifest_asset`` predicate.
+
+    The pages embed the hashed names: the digest of the manifest is
+    combined in the ``deployment_id`` of :mod:`pvault.conditional`, so
+    that their ETags change with the assets.
+
+    :param config: the configurator
+    :param name: the name (URL prefix) of the static view
+    :type name: str
+    :param spec: the asset spec of the directory (``pvault:static``)
+    :type spec: str
+    :param max_age: the max-age of the unhashed names
+    :type max_age: int
+    """
+    directory = AssetResolver().resolve(spec).abspath()
+    manifest = build_manifest(directory)
+    content_encodings = ['br', 'gzip']
+    config.add_static_view(
+        name, spec, cache_max_age=max_age,
+        content_encodings=content_encodings,
+    )
+    config.add_view_predicate('manifest_asset', ManifestAssetPredicate)
+    config.add_view(
+        manifest_static_view(directory, manifest, max_age, content_encodings),
+        route_name=f'__{name}/',
+        manifest_asset=manifest,
+        permission=NO_PERMISSION_REQUIRED,
+    )
+    config.add_cache_buster(spec, ContentHashCacheBuster(manifest))
+    if 'deployment_id' in config.registry:
+        config.registry['deployment_id'] = hashlib.sha1(
+            f'{config.registry["deployment_id"]}\0'
+            f'{manifest_digest(manifest)}'.encode('utf8')
+        ).hexdigest()
@@ -0,0 +1,128 @@
+"""Serialization of the sessions.
+
+Encoded values start with a two bytes header:
+
+- ``0xc1`` : a byte never used by msgpack, it mark the value as encoded by
+  :class:`SessionCodec`. Values without it are raw msgpack blobs written
+  before the codec existed and are still readable.
+- the format byte : the format version in the high nibble and the
+  compression used in the low nibble.
+
+The body is msgpack with extension types for the common values that
+msgpack doesn't know: datetimes, dates and UUIDs.
+"""
+import zlib
+import uuid
+import datetime
+
+from typing import Any
+
+import msgpack
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+
+MAGIC = 0xc1
+VERSION = 1
+
+# Extension types
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_UUID = 3
+
+# Compression name: (id, compress, decompress)
+COMPRESSIONS = {
+    'none': (0, None, None),
+    'zlib': (1, zlib.compress, zlib.decompress),
+}
+if lz4 is not None:
+    COMPRESSIONS['lz4'] = (2, lz4.frame.compress, lz4.frame.decompress)
+
+
+def _default(value: Any) -> msgpack.ExtType:
+    """Encode the values that msgpack doesn't know."""
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, value.isoformat().encode())
+    if isinstance(value, datetime.date):
+        return msgpack.ExtType(EXT_DATE, value.isoformat().encode())
+    if isinstance(value, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, value.bytes)
+    raise TypeError(f'Cannot serialize {type(value)!r}')
+
+
+def _ext_hook(code: int, data: bytes) -> Any:
+    """Decode the extension types."""
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    if code == EXT_DATE:
+        return datetime.date.fromisoformat(data.decode())
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    return msgpack.ExtType(code, data)
+
+
+class SessionCodec(object):
+    """Versioned session codec with optional compression.
+
+    Bodies bigger than ``threshold`` bytes are compressed with the
+    ``compression`` algorithm (``none``, ``zlib`` or ``lz4`` if the lz4
+    package is installed). The compression is only kept if it makes the
+    value smaller.
+    """
+
+    def __init__(self, compression:str='zlib', threshold:int=1024) -> None:
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown session compression: {compression}')
+        self.compression = compression
+        self.threshold = threshold
+        self._decompressors = {
+            compression_id: decompress
+            for compression_id, _, decompress in COMPRESSIONS.values()
+        }
+
+    def dumps(self, value: Any) -> bytes:
+        """Encode a value.
+
+        :param value: the value to encode
+        :return: the encoded value
+        :rtype: bytes
+        """
+        body = msgpack.packb(value, use_bin_type=True, default=_default)
+        compression_id, compress, _ = COMPRESSIONS[self.compression]
+        if compress is not None and len(body) > self.threshold:
+            compressed = compress(body)
+            if len(compressed) < len(body):
+                return bytes((MAGIC, VERSION << 4 | compression_id)) + compressed
+        return bytes((MAGIC, VERSION << 4)) + body
+
+    def loads(self, bdata: bytes) -> Any:
+        """Decode a value.
+
+        :param bdata: the encoded value
+        :type bdata: bytes
+        :raise ValueError: if the data is invalid
+        """
+        if bdata[:1] == bytes((MAGIC,)):
+            if len(bdata) < 2:
+                raise ValueError('Truncated session data')
+            version, compression_id = bdata[1] >> 4, bdata[1] & 0x0f
+            if version != VERSION:
+                raise ValueError(f'Unknown session format: {version}')
+            if compression_id not in self._decompressors:
+                raise ValueError(f'Unknown compression: {compression_id}')
+            body = bdata[2:]
+            decompress = self._decompressors[compression_id]
+            if decompress is not None:
+                try:
+                    body = decompress(body)
+                except Exception as exc:
+                    raise ValueError('Invalid compressed session') from exc
+        else:
+            # Legacy raw msgpack blob
+            body = bdata
+        return msgpack.unpackb(
+            body, raw=False, use_list=True, ext_hook=_ext_hook
+        )
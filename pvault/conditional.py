@@ -0,0 +1,112 @@
+"""Conditional GET (``ETag`` / ``If-None-Match``) for the views.
+
+Views declared with an ``etag`` option::
+
+    def listing_version(request):
+        return str(request.listing_cache.version(request.session['user_id']))
+
+    @view_config(route_name='vault', renderer='templates/vault.jinja2',
+                 etag=listing_version)
+    def vault_view(request):
+        ...
+
+call the validator before the view. It must be cheap (a version number, a
+max updated timestamp...) and return a string, or None to disable the
+conditional response. The ETag is a hash of the validator and of the
+session cookie so that two users of the same browser never share a
+response. If the request ``If-None-Match`` matches, a 304 is returned
+without calling the view nor its renderer (no database query, no Jinja2
+rendering).
+
+The ``GET`` / ``HEAD`` responses of these views are ``Cache-Control:
+private, no-cache`` (only the browser cache them, and revalidate them each
+time) and ``Vary: Cookie``.
+"""
+import os
+import hashlib
+
+from typing import Optional
+
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.interfaces import ISessionFactory
+from pyramid.request import Request
+from pyramid.response import Response
+
+
+def compute_etag(request:Request, validator:str) -> str:
+    """Return the ETag of a validator for the user of the request."""
+    factory = request.registry.queryUtility(ISessionFactory)
+    cookie = request.cookies.get(getattr(factory, 'cookie_name', ''), '')
+    return hashlib.sha1(
+        f'{validator}\0{cookie}'.encode('utf8')
+    ).hexdigest()
+
+
+def _cache_headers(response:Response, etag:str) -> None:
+    response.etag = etag
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    vary = tuple(response.vary or ())
+    if 'Cookie' not in vary:
+        response.vary = vary + ('Cookie',)
+
+
+def conditional_view(view, info):
+    """View deriver answering 304 for the views with an ``etag`` option."""
+    validator = info.options.get('etag')
+    if validator is None:
+        return view
+
+    def wrapper(context, request):
+        if request.method not in ('GET', 'HEAD'):
+            return view(context, request)
+        value: Optional[str] = validator(request)
+        if value is None:
+            return view(context, request)
+        etag = compute_etag(request, value)
+        if etag in request.if_none_match:
+            response = HTTPNotModified()
+            _cache_headers(response, etag)
+            return response
+        response = view(context, request)
+        if 200 <= response.status_code < 300:
+            _cache_headers(response, etag)
+        return response
+    return wrapper
+
+
+conditional_view.options = ('etag',)
+
+
+def _deployment_id(settings:dict) -> str:
+    """Return the ``pvault.deployment_id`` setting or a hash of the
+    templates, the same in every worker process.
+
+    :func:`pvault.assets.add_hashed_static_view` combines the digest of the
+    static assets in it.
+    """
+    if settings.get('pvault.deployment_id'):
+        return settings['pvault.deployment_id']
+    digest = hashlib.sha1()
+    templates = os.path.join(os.path.dirname(__file__), 'templates')
+    for root, _, files in sorted(os.walk(templates)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as template:
+                digest.update(name.encode('utf8') + template.read())
+    return digest.hexdigest()
+
+
+def deployment_etag(request:Request) -> str:
+    """Validator of the pages which only change with the application."""
+    return request.registry['deployment_id']
+
+
+def includeme(config):
+    """Add the ``etag`` view option.
+
+    Activate this setup using ``config.include('pvault.conditional')``.
+    """
+    config.registry['deployment_id'] = _deployment_id(config.get_settings())
+    config.add_view_deriver(
+        conditional_view, under='decorated_view', over='rendered_view',
+    )
@@ -0,0 +1,378 @@
+"""Key derivation and encryption of the vault entries.
+
+The master password key derivation (scrypt, or argon2id if the
+``argon2-cffi`` package is installed) is slow on purpose. :class:`CryptoEngine`
+run it in a pool of processes so that it doesn't hold the GIL nor the
+threads of the WSGI server:
+
+- at most ``pvault.crypto.max_pending`` derivations are queued or running,
+  the next ones fail immediately with :class:`CryptoBusy`,
+- a derivation taking more than ``pvault.crypto.timeout`` seconds fail with
+  :class:`CryptoTimeout`,
+- a whole vault listing is decrypted in one call
+  (:meth:`CryptoEngine.decrypt_many`), in the pool for the listings bigger
+  than ``pvault.crypto.offload_threshold`` entries.
+
+With ``pvault.crypto.workers = 0`` everything runs in the calling thread
+(development, tests).
+
+The derived keys are cached in memory by session id, encrypted with a
+random key of the process, until the session expires. They are evicted by
+:meth:`CryptoEngine.lock` (logout) and when the session is invalidated
+(:meth:`PVaultSession.invalidate`). The cache is local to the worker
+process.
+
+Encrypted values are ``nonce (12 bytes) + AES-GCM ciphertext``.
+"""
+import os
+import time
+import hashlib
+import threading
+import collections
+
+from concurrent.futures import TimeoutError
+from typing import (
+    List,
+    Optional,
+    Sequence,
+)
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.interfaces import ISessionFactory
+from pyramid.view import exception_view_config
+
+try:
+    from argon2.low_level import Type, hash_secret_raw
+except ImportError:  # pragma: no cover
+    hash_secret_raw = None
+
+KEY_SIZE = 32
+NONCE_SIZE = 12
+
+KDFS = ('scrypt', 'argon2')
+
+
+class CryptoError(Exception):
+    """Base class of the crypto errors."""
+
+
+class CryptoBusy(CryptoError):
+    """Too many key derivations are pending."""
+
+
+class CryptoTimeout(CryptoError):
+    """The key derivation took too long."""
+
+
+class DecryptionError(CryptoError):
+    """The value is corrupted or the key is wrong."""
+
+
+# #############################################################################
+# ################### Functions run in the pool processes ####################
+# #############################################################################
+def derive_key(password:bytes, salt:bytes, kdf:str='scrypt',
+               n:int=2 ** 15, r:int=8, p:int=1, time_cost:int=3,
+               memory_cost:int=65536) -> bytes:
+    """Derive a key from a password.
+
+    :param password: the password
+    :type password: bytes
+    :param salt: the salt, at least 16 random bytes
+    :type salt: bytes
+    :param kdf: ``scrypt`` or ``argon2`` (argon2id)
+    :type kdf: str
+    :param n: scrypt cost
+    :param r: scrypt block size
+    :param p: scrypt / argon2 parallelism
+    :param time_cost: argon2 iterations
+    :param memory_cost: argon2 memory in KiB
+    :rtype: bytes
+    """
+    if kdf == 'argon2':
+        if hash_secret_raw is None:
+            raise CryptoError('argon2 requires the argon2-cffi package')
+        return hash_secret_raw(
+            password, salt, time_cost=time_cost, memory_cost=memory_cost,
+            parallelism=p, hash_len=KEY_SIZE, type=Type.ID,
+        )
+    return hashlib.scrypt(
+        password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p,
+        dklen=KEY_SIZE,
+    )
+
+
+def encrypt(key:bytes, plaintext:bytes, aad:bytes=None) -> bytes:
+    """Encrypt a value with AES-GCM.
+
+    :param key: the key
+    :param plaintext: the value
+    :param aad: the associated data (entry id...)
+    :rtype: bytes
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + AESGCM(key).encrypt(nonce, plaintext, aad)
+
+
+def decrypt(key:bytes, value:bytes, aad:bytes=None) -> bytes:
+    """Decrypt a value encrypted by :func:`encrypt`.
+
+    :raise DecryptionError: if the value or the key is invalid
+    """
+    try:
+        return AESGCM(key).decrypt(
+            value[:NONCE_SIZE], value[NONCE_SIZE:], aad
+        )
+    except (InvalidTag, ValueError) as exc:
+        raise DecryptionError('Invalid encrypted value') from exc
+
+
+def decrypt_batch(key:bytes, values:Sequence[bytes],
+                  aads:Optional[Sequence[bytes]]=None) -> List[bytes]:
+    """Decrypt several values with the same key."""
+    aead = AESGCM(key)
+    aads = aads or [None] * len(values)
+    plaintexts = []
+    for value, aad in zip(values, aads):
+        try:
+            plaintexts.append(aead.decrypt(
+                value[:NONCE_SIZE], value[NONCE_SIZE:], aad
+            ))
+        except (InvalidTag, ValueError) as exc:
+            raise DecryptionError('Invalid encrypted value') from exc
+    return plaintexts
+
+
+# #############################################################################
+# ################################ Key cache #################################
+# #############################################################################
+class KeyCache(object):
+    """Derived keys by session id, encrypted with a key of the process.
+
+    :param ttl: lifetime of the keys in seconds
+    :type ttl: int
+    """
+
+    def __init__(self, ttl:int=1200) -> None:
+        self.ttl = ttl
+        self._aead = AESGCM(AESGCM.generate_key(bit_length=256))
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def set(self, session_id:str, key:bytes) -> None:
+        nonce = os.urandom(NONCE_SIZE)
+        wrapped = nonce + self._aead.encrypt(nonce, key, session_id.encode())
+        with self._lock:
+            self._keys[session_id] = (time.monotonic() + self.ttl, wrapped)
+            self._keys.move_to_end(session_id)
+            self._expire()
+
+    def get(self, session_id:str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._keys.get(session_id)
+        if entry is None:
+            return None
+        expires, wrapped = entry
+        if expires < time.monotonic():
+            self.evict(session_id)
+            return None
+        return self._aead.decrypt(
+            wrapped[:NONCE_SIZE], wrapped[NONCE_SIZE:], session_id.encode()
+        )
+
+    def evict(self, session_id:str) -> None:
+        with self._lock:
+            self._keys.pop(session_id, None)
+
+    def _expire(self) -> None:
+        # The keys are ordered by expiry
+        now = time.monotonic()
+        while self._keys:
+            session_id, (expires, _) = next(iter(self._keys.items()))
+            if expires >= now:
+                return
+            del self._keys[session_id]
+
+
+# #############################################################################
+# ################################## Engine ##################################
+# #############################################################################
+class CryptoEngine(object):
+    """Run the key derivations and the batch decryptions in a process pool.
+
+    :param workers: the number of processes, 0 to run in the calling thread
+    :type workers: int
+    :param max_pending: the number of derivations queued or running
+    :type max_pending: int
+    :param timeout: the timeout of a call in seconds
+    :type timeout: float
+    :param kdf: ``scrypt`` or ``argon2``
+    :type kdf: str
+    :param kdf_params: the parameters of :func:`derive_key`
+    :type kdf_params: dict
+    :param key_ttl: the lifetime of the cached keys in seconds
+    :type key_ttl: int
+    :param offload_threshold: the size of the listings decrypted in the pool
+    :type offload_threshold: int
+    """
+
+    def __init__(self, workers:int=2, max_pending:int=16, timeout:float=5.0,
+                 kdf:str='scrypt', kdf_params:dict=None, key_ttl:int=1200,
+                 offload_threshold:int=5000) -> None:
+        if kdf not in KDFS:
+            raise ValueError(f'Unknown kdf: {kdf}')
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.kdf = kdf
+        self.kdf_params = kdf_params or {}
+        self.keys = KeyCache(key_ttl)
+        self.offload_threshold = offload_threshold
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created on the first use, after the server forked its workers
+        with self._executor_lock:
+            if self._executor is None:
+                # Imported here: not needed with workers = 0
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('forkserver'),
+                )
+            return self._executor
+
+    def _call(self, function, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise CryptoBusy(f'{self.max_pending} crypto calls pending')
+        if not self.workers:
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._slots.release()
+        try:
+            future = self._get_executor().submit(function, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is released when the call ends, even after a timeout
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError as exc:
+            future.cancel()
+            raise CryptoTimeout(
+                f'Crypto call took more than {self.timeout}s'
+            ) from exc
+
+    def derive_key(self, password:str, salt:bytes) -> bytes:
+        """Derive the key of a master password in the pool.
+
+        :raise CryptoBusy: if too many derivations are pending
+        :raise CryptoTimeout: if the derivation took too long
+        """
+        return self._call(
+            derive_key, password.encode('utf8'), salt, self.kdf,
+            **self.kdf_params
+        )
+
+    def decrypt_many(self, key:bytes, values:Sequence[bytes],
+                     aads:Optional[Sequence[bytes]]=None) -> List[bytes]:
+        """Decrypt the entries of a listing in one call.
+
+        AES-GCM is fast, the listings are decrypted in the calling thread
+        unless they have more than ``offload_threshold`` entries, they are
+        then sent to the pool in one call.
+        """
+        if len(values) < self.offload_threshold or not self.workers:
+            return decrypt_batch(key, values, aads)
+        return self._call(decrypt_batch, key, list(values), aads)
+
+    def unlock(self, session, password:str, salt:bytes) -> bytes:
+        """Derive the key of the session user and cache it.
+
+        :param session: the session of the request
+        :param password: the master password
+        :param salt: the salt of the user
+        :return: the key
+        """
+        key = self.derive_key(password, salt)
+        self.keys.set(session.sid, key)
+        return key
+
+    def session_key(self, session) -> Optional[bytes]:
+        """Return the cached key of the session, None if it's locked."""
+        return self.keys.get(session.sid)
+
+    def lock(self, session) -> None:
+        """Evict the cached key of the session (logout)."""
+        self.keys.evict(session.sid)
+
+    def reset(self) -> None:
+        """Drop the pool inherited from the parent process (after fork)."""
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def close(self) -> None:
+        """Stop the processes of the pool."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+@exception_view_config(CryptoBusy)
+@exception_view_config(CryptoTimeout)
+def crypto_unavailable_view(exc, request):
+    response = HTTPServiceUnavailable()
+    response.retry_after = 1
+    return response
+
+
+def crypto_from_settings(settings:dict) -> CryptoEngine:
+    """Create the crypto engine from the ``pvault.crypto.*`` settings."""
+    prefix = 'pvault.crypto.'
+    kdf_params = {}
+    for name in ('n', 'r', 'p', 'time_cost', 'memory_cost'):
+        if prefix + name in settings:
+            kdf_params[name] = int(settings[prefix + name])
+    return CryptoEngine(
+        workers=int(settings.get(prefix + 'workers', 2)),
+        max_pending=int(settings.get(prefix + 'max_pending', 16)),
+        timeout=float(settings.get(prefix + 'timeout', 5.0)),
+        kdf=settings.get(prefix + 'kdf', 'scrypt'),
+        kdf_params=kdf_params,
+        key_ttl=int(settings.get(prefix + 'key_ttl', 1200)),
+        offload_threshold=int(
+            settings.get(prefix + 'offload_threshold', 5000)
+        ),
+    )
+
+
+def includeme(config):
+    """Add the crypto engine to the registry and ``request.crypto``.
+
+    Activate this setup using ``config.include('pvault.crypto')``.
+    """
+    engine = crypto_from_settings(config.get_settings())
+    config.registry['crypto'] = engine
+    config.add_request_method(
+        lambda request: request.registry['crypto'], 'crypto', reify=True
+    )
+
+    def register_evictions():
+        session_factory = config.registry.queryUtility(ISessionFactory)
+        if hasattr(session_factory, 'add_invalidate_callback'):
+            session_factory.add_invalidate_callback(engine.keys.evict)
+        # The keys live as long as the sessions by default
+        if 'pvault.crypto.key_ttl' not in config.get_settings():
+            engine.keys.ttl = getattr(session_factory, 'max_age', 1200)
+    config.action(None, register_evictions, order=1)
@@ -8,10 +8,38 @@ This module include the following packages in the config:
 
 This module add the following request method:
 - dbsession : return the dbsession.
+
+The engine is configured by the ``sqlalchemy.*`` settings, in addition to
+the :func:`sqlalchemy.create_engine` options (``pool_size``,
+``max_overflow``, ``pool_recycle``, ``pool_timeout``...):
+
+- ``sqlalchemy.pool_pre_ping`` : test the connections when checked out,
+- ``sqlalchemy.statement_timeout`` : PostgreSQL statement timeout in
+  milliseconds.
+
+Forked workers must call :func:`dispose_engine` so that they don't share
+the connections of the parent process (see :func:`pvault.post_fork`).
+
+The views declared with ``read_only=True`` get a session which is not
+joined to the transaction manager, see :mod:`pvault.readonly`.
+
+Reads can be sent to replicas with the ``sqlalchemy.replica.*`` settings,
+see :mod:`pvault.replicas`.
+
+The statements are instrumented (slow queries and N+1 detection) by
+:mod:`pvault.querystats` when ``pvault.db.instrument`` is true.
 """
+import os
+import time
+import uuid
+import logging
+import threading
+
 import sqlalchemy
+from pyramid.settings import asbool, aslist
 from sqlalchemy import engine_from_config, inspect
-from sqlalchemy.orm import sessionmaker, configure_mappers
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker, configure_mappers, declared_attr
 from sqlalchemy.schema import MetaData
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import UUID
@@ -20,6 +48,15 @@ from sqlalchemy.orm.exc import DetachedInstanceError
 
 import zope.sqlalchemy
 
+from .replicas import (
+    READS,
+    ROUTING_SETTINGS,
+    ReplicaSelector,
+    RoutingSession,
+    configure_session,
+)
+from .readonly import before_flush, get_read_only_session, read_only_view
+
 # ####### Old stuff from cookiecutter ############
 # from .statistics.models.draw_number_model import DrawNumberModel
 # run configure_mappers after defining all of the models to ensure
@@ -27,6 +64,8 @@ import zope.sqlalchemy
 # configure_mappers()
 # ################################################
 
+log = logging.getLogger(__name__)
+
 # This come from the pyramid-cookiecutter-alchemy
 NAMING_CONVENTION = {
     "ix": "ix_%(column_0_label)s",
@@ -75,27 +114,120 @@ metadata = MetaData(naming_convention=NAMING_CONVENTION)
 ModelBase = declarative_base(cls=ModelBase, metadata=metadata)
 
 
+_uuid7_lock = threading.Lock()
+_uuid7_last = 0
+
+
+def uuid7() -> uuid.UUID:
+    """Return a time-ordered UUID (version 7, RFC 9562).
+
+    The 48 first bits are the unix time in milliseconds, the 12 next bits
+    the sub-millisecond fraction, the others are random. The UUIDs created
+    by a process are strictly increasing.
+    """
+    global _uuid7_last
+    with _uuid7_lock:
+        # 60 bits timestamp: milliseconds + 12 bits fraction
+        timestamp = time.time_ns() * 4096 // 1_000_000
+        if timestamp <= _uuid7_last:
+            timestamp = _uuid7_last + 1
+        _uuid7_last = timestamp
+    value = (timestamp >> 12) << 80 | 0x7 << 76 | (timestamp & 0xfff) << 64 \
+        | 0b10 << 62 | int.from_bytes(os.urandom(8), 'big') >> 2
+    return uuid.UUID(int=value)
+
+
+class UUIDPrimaryKey(object):
+    """Mixin of the UUID primary key of the models.
+
+    The primary key is a UUID created by PostgreSQL on insert. Set
+    ``__client_uuid__ = True`` on a model to create time-ordered UUIDs
+    (:func:`uuid7`) when the objects are created instead: the key is known
+    before the flush, the inserts don't need ``RETURNING`` (executemany)
+    and the new rows are appended to the end of the primary key index.
+    """
+    __client_uuid__ = False
+
+    @declared_attr
+    def uuid(cls):
+        return sqlalchemy.Column(
+            UUID(as_uuid=False),
+            primary_key=True,
+            server_default=sqlalchemy.text('gen_random_uuid()'),
+            # Core inserts
+            default=(lambda: str(uuid7())) if cls.__client_uuid__ else None,
+        )
+
+    def __init__(self, **kwargs):
+        if self.__client_uuid__ and 'uuid' not in kwargs:
+            kwargs['uuid'] = str(uuid7())
+        super().__init__(**kwargs)
+
+
 # class found in the pypa/warehouse project
-class Model(ModelBase):
+class Model(UUIDPrimaryKey, ModelBase):
+    """Base class of the models, with a UUID primary key (see
+    :class:`UUIDPrimaryKey`)."""
     __abstract__ = True
-
-    uuid = sqlalchemy.Column(
-        UUID(as_uuid=False),
-        primary_key=True,
-        server_default=sqlalchemy.text('gen_random_uuid()'),
-    )
 # #############################################################################
 # #############################################################################
 
 # This come from the pyramid-cookiecutter-alchemy
 def _get_engine(settings, prefix='sqlalchemy.'):
-    return engine_from_config(settings, prefix)
+    settings = {
+        key: value for key, value in settings.items()
+        if not key.startswith(prefix + 'replica.')
+    }
+    options = {}
+    pre_ping = settings.pop(prefix + 'pool_pre_ping', None)
+    if pre_ping is not None:
+        options['pool_pre_ping'] = asbool(pre_ping)
+    statement_timeout = int(settings.pop(prefix + 'statement_timeout', 0))
+    if statement_timeout:
+        if make_url(settings[prefix + 'url']).get_backend_name() == 'postgresql':
+            # Set by the connection startup packet, no extra round-trip
+            options['connect_args'] = {
+                'options': f'-c statement_timeout={statement_timeout}'
+            }
+        else:
+            log.warning('statement_timeout is only supported by PostgreSQL')
+    return engine_from_config(settings, prefix, **options)
+
+def _get_replica_engines(settings, prefix='sqlalchemy.replica.'):
+    options = {
+        key: value for key, value in settings.items()
+        if key.startswith(prefix)
+        and key[len(prefix):] not in ROUTING_SETTINGS
+    }
+    return [
+        _get_engine(dict(options, **{prefix + 'url': url}), prefix)
+        for url in aslist(settings.get(prefix + 'urls', ''))
+    ]
 
-def _get_session_factory(engine):
-    factory = sessionmaker()
+def _get_session_factory(engine, replicas=None, read_only_engines=None):
+    if replicas is None:
+        factory = sessionmaker()
+    else:
+        factory = sessionmaker(
+            class_=RoutingSession,
+            replicas=replicas,
+            read_only_engines=read_only_engines,
+        )
     factory.configure(bind=engine)
+    sqlalchemy.event.listen(factory, 'before_flush', before_flush)
     return factory
 
+def dispose_engine(registry):
+    """Drop the connections of the pool, to call in a forked worker.
+
+    The connections inherited from the parent process are discarded without
+    being closed (the parent still use them).
+    """
+    registry['dbengine'].dispose(close=False)
+    for engine in registry.get('dbreplicas', ()):
+        engine.dispose(close=False)
+    registry['dbreadonly_engines'].clear()
+
 def get_tm_session(session_factory, transaction_manager):
     """Get a ``sqlalchemy.orm.Session`` instance backed by a transaction.
 
@@ -116,6 +248,8 @@ def get_tm_session(session_factory, transaction_manager):
               dbsession = get_tm_session(session_factory, transaction.manager)
     """
     dbsession = session_factory()
+    # Used by the after-commit hooks (see pvault.listcache)
+    dbsession.info['transaction_manager'] = transaction_manager
     zope.sqlalchemy.register(
         dbsession, transaction_manager=transaction_manager
     )
@@ -137,13 +271,48 @@ def includeme(config):
 
     # SQLAchemy stuff
     engine = _get_engine(settings)
-    session_factory = _get_session_factory(engine)
+    replicas = _get_replica_engines(settings)
+    # engine -> read-only engine (see pvault.readonly)
+    read_only_engines = {}
+    session_factory = _get_session_factory(
+        engine,
+        ReplicaSelector(
+            replicas, settings.get('sqlalchemy.replica.strategy', 'round_robin')
+        ) if replicas else None,
+        read_only_engines,
+    )
+    config.registry['dbengine'] = engine
+    config.registry['dbreplicas'] = replicas
+    config.registry['dbreadonly_engines'] = read_only_engines
     config.registry['dbsession_factory'] = session_factory
 
+    # Opt-in slow query log / N+1 detection
+    config.include('.querystats')
+
+    # Opt-in per-user listings cache
+    config.include('.listcache')
+
+    # Views declared with read_only=True
+    config.add_view_deriver(read_only_view)
+
     # make request.dbsession available for use in Pyramid
-    config.add_request_method(
-        # r.tm is the transaction manager used by pyramid_tm
-        lambda r: get_tm_session(session_factory, r.tm),
-        'dbsession',
-        reify=True
-    )
+    if replicas:
+        reads = settings.get('sqlalchemy.replica.reads', 'read_only')
+        if reads not in READS:
+            raise ValueError(f'Unknown sqlalchemy.replica.reads: {reads}')
+        pin_seconds = int(settings.get('sqlalchemy.replica.pin_seconds', 0))
+
+        def dbsession(request):
+            if getattr(request, 'db_read_only', False):
+                session = get_read_only_session(session_factory, request)
+            else:
+                session = get_tm_session(session_factory, request.tm)
+            configure_session(request, session, reads, pin_seconds)
+            return session
+    else:
+        def dbsession(request):
+            if getattr(request, 'db_read_only', False):
+                return get_read_only_session(session_factory, request)
+            # request.tm is the transaction manager used by pyramid_tm
+            return get_tm_session(session_factory, request.tm)
+    config.add_request_method(dbsession, 'dbsession', reify=True)
@@ -0,0 +1,46 @@
+"""Debug toolbar panel of :mod:`pvault.querystats`.
+
+In its own module so that the application never imports
+``pyramid_debugtoolbar`` (slow to import) unless the panel is enabled::
+
+    debugtoolbar.extra_panels = pvault.debugpanel.QueryStatsDebugPanel
+"""
+import html
+
+from pyramid.request import Request
+from pyramid_debugtoolbar.panels import DebugPanel
+
+
+class QueryStatsDebugPanel(DebugPanel):
+    """Debug toolbar panel showing the statements by fingerprint."""
+
+    name = 'pvault_querystats'
+    has_content = True
+    nav_title = 'SQL fingerprints'
+    title = 'SQL statements by fingerprint'
+
+    def __init__(self, request:Request) -> None:
+        self.request = request
+
+    def process_response(self, response) -> None:
+        stats = getattr(self.request, 'query_stats', None)
+        if stats is None:
+            return
+        self.data['summary'] = stats.summary()
+        self.nav_subtitle = f'{stats.count} in {stats.duration:.3f}s'
+
+    def render_content(self, request:Request) -> str:
+        rows = ''.join(
+            '<tr><td>{count}</td><td>{duration:.4f}</td>'
+            '<td><code>{sql}</code></td></tr>'.format(
+                count=item['count'],
+                duration=item['duration'],
+                sql=html.escape(item['fingerprint']),
+            )
+            for item in self.data.get('summary', [])
+        )
+        return (
+            '<table class="table table-striped table-condensed">'
+            '<thead><tr><th>Count</th><th>Time (s)</th><th>SQL</th>'
+            f'</tr></thead><tbody>{rows}</tbody></table>'
+        )
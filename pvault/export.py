@@ -0,0 +1,154 @@
+"""Streaming export of the vault of a user.
+
+``GET /export/{table}.{format}`` (``csv`` or ``jsonl``) stream the rows of
+the authenticated user in the tables listed in the ``pvault.export.tables``
+setting (none by default): the rows whose ``pvault.export.owner_column``
+(``user_id`` by default) is the user id. The view requires the ``export``
+permission (see :mod:`pvault.security`). Other modules can stream their
+own queries with :func:`export_response`.
+
+The body is a generator used as the ``app_iter`` of the response: the rows
+are fetched with a server-side cursor, ``pvault.export.batch_size`` at a
+time, and encoded incrementally, the whole result is never in memory.
+
+pyramid_tm ends the transaction of ``request.dbsession`` when the view
+returns, before the body is sent. The generator doesn't use it: it opens
+its own read-only connection (on a replica if configured) when the first
+chunk is requested and closes it when the body is consumed or closed by the
+server.
+"""
+import io
+import csv
+import json
+
+from typing import (
+    Iterator,
+    List,
+    Sequence,
+)
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.request import Request
+from pyramid.response import Response
+from pyramid.settings import aslist
+from pyramid.view import view_config
+
+from .readonly import read_only_engine
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def encode_rows(columns:List[str], rows:Sequence, fmt:str,
+                header:bool=False) -> str:
+    """Encode rows in the csv or JSON lines format.
+
+    :param columns: the column names
+    :param rows: the rows (tuples)
+    :param fmt: ``csv`` or ``jsonl``
+    :type fmt: str
+    :param header: write the csv header before the rows
+    :type header: bool
+    :rtype: str
+    """
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(columns)
+        writer.writerows(rows)
+        return buffer.getvalue()
+    return ''.join(
+        json.dumps(dict(zip(columns, row)), default=str) + '\n'
+        for row in rows
+    )
+
+
+def stream_rows(engine:Engine, query, fmt:str,
+                batch_size:int=1000) -> Iterator[bytes]:
+    """Yield the encoded rows of a query, one chunk per batch.
+
+    :param engine: the engine, use a read-only engine
+                   (:func:`pvault.readonly.read_only_engine`)
+    :param query: the select statement
+    :param fmt: ``csv`` or ``jsonl``
+    :type fmt: str
+    :param batch_size: the number of rows fetched at once
+    :type batch_size: int
+    """
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=batch_size).execute(
+            query
+        )
+        columns = list(result.keys())
+        if fmt == 'csv':
+            yield encode_rows(columns, (), fmt, header=True).encode('utf8')
+        for partition in result.partitions():
+            yield encode_rows(columns, partition, fmt).encode('utf8')
+
+
+def _export_engine(request:Request) -> Engine:
+    replicas = request.registry['dbsession_factory'].kw.get('replicas')
+    if replicas is not None:
+        return replicas.choose()
+    return request.registry['dbengine']
+
+
+def export_response(request:Request, query, fmt:str,
+                    filename:str) -> Response:
+    """Return a response streaming the rows of a query.
+
+    :param request: the request
+    :param query: the select statement
+    :param fmt: ``csv`` or ``jsonl``
+    :type fmt: str
+    :param filename: the name of the downloaded file
+    :type filename: str
+    """
+    batch_size = int(
+        request.registry.settings.get('pvault.export.batch_size', 1000)
+    )
+    engine = read_only_engine(
+        _export_engine(request), request.registry['dbreadonly_engines']
+    )
+    return Response(
+        app_iter=stream_rows(engine, query, fmt, batch_size),
+        content_type=CONTENT_TYPES[fmt],
+        charset='utf-8',
+        content_disposition=f'attachment; filename="{filename}"',
+        cache_control='no-store',
+    )
+
+
+def _reflected_tables(registry) -> dict:
+    return registry.setdefault('pvault.export.reflected', {})
+
+
+@view_config(route_name='export', request_method='GET', permission='export')
+def export_view(request:Request) -> Response:
+    settings = request.registry.settings
+    table_name = request.matchdict['table']
+    fmt = request.matchdict['format']
+    tables = aslist(settings.get('pvault.export.tables', ''))
+    if table_name not in tables or fmt not in CONTENT_TYPES:
+        raise HTTPNotFound()
+    reflected = _reflected_tables(request.registry)
+    if table_name not in reflected:
+        reflected[table_name] = sqlalchemy.Table(
+            table_name, sqlalchemy.MetaData(),
+            autoload_with=request.registry['dbengine'],
+        )
+    table = reflected[table_name]
+    owner = table.c.get(settings.get('pvault.export.owner_column', 'user_id'))
+    if owner is None:
+        # Not a table of the vaults
+        raise HTTPNotFound()
+    return export_response(
+        request,
+        sqlalchemy.select(table).where(owner == request.authenticated_userid),
+        fmt, f'{table_name}.{fmt}',
+    )
@@ -0,0 +1,246 @@
+"""Redis cache of the per-user vault listings.
+
+The listing of a user is stored under a key containing the version of the
+user listings::
+
+    pvault/listing/version/{user_id}         -> version
+    pvault/listing/data/{user_id}/{version}  -> listing (codec encoded)
+
+Invalidating the listings of a user is a single ``INCR`` of its version,
+the old listing is never read again and expires. A listing loaded while
+the user is invalidated is stored under the old version, so it can't be
+read either.
+
+The invalidations happen in after-commit hooks of the request transaction:
+an aborted transaction never invalidate, a committed one always does. They
+are registered:
+
+- explicitly with :meth:`ListingCache.invalidate_on_commit`,
+- automatically when ``request.dbsession`` flush an instance of a model
+  declaring the column holding its owner: ``__listing_owner__ = 'user_id'``,
+- automatically when ``request.dbsession`` execute an ORM ``update()`` /
+  ``delete()`` of such a model (``dbsession.execute(update(Entry)...)``):
+  the owners of the matched rows are selected before the statement.
+
+The statements on a ``Table`` (``update(Entry.__table__)``) and the new
+owner set by a bulk ``update()`` are not seen, invalidate them with
+:meth:`ListingCache.invalidate_on_commit`.
+
+A listing loaded by a transaction which changed the rows of the user
+contains uncommitted rows: give the transaction to
+:meth:`ListingCache.get` (``txn=request.tm.get()``) so that such listings
+are not cached.
+
+Store metadata-only or encrypted payloads only, the listings are not
+encrypted by the cache. Hit / miss / invalidation counters are exported by
+``/metrics``.
+"""
+import logging
+
+from typing import (
+    Callable,
+    Optional,
+)
+
+import redis
+from pyramid.settings import asbool
+from sqlalchemy import and_, event, inspect, or_, select
+
+from .codec import SessionCodec
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+
+class ListingCache(object):
+    """Per-user listings cache.
+
+    :param client: the redis client
+    :param ttl: the lifetime of the listings in seconds
+    :type ttl: int
+    :param codec: the codec of the listings
+    :type codec: SessionCodec
+    """
+
+    def __init__(self, client:redis.StrictRedis, ttl:int=3600,
+                 codec:Optional[SessionCodec]=None) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.codec = codec or SessionCodec()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _version_key(self, user_id:str) -> str:
+        return f'pvault/listing/version/{user_id}'
+
+    def _data_key(self, user_id:str, version:int) -> str:
+        return f'pvault/listing/data/{user_id}/{version}'
+
+    def version(self, user_id:str) -> int:
+        metrics.count('redis')
+        return int(self.client.get(self._version_key(user_id)) or 0)
+
+    def get(self, user_id:str, loader:Callable[[], object], txn=None):
+        """Return the listing of a user, loaded and cached on a miss.
+
+        :param user_id: the user id
+        :param loader: function returning the listing
+        :param txn: the transaction of the loader (``request.tm.get()``), the
+                    listing is not cached if the transaction will invalidate
+                    the user on commit (the listing holds uncommitted rows)
+        """
+        version = self.version(user_id)
+        key = self._data_key(user_id, version)
+        metrics.count('redis')
+        bdata = self.client.get(key)
+        if bdata is not None:
+            try:
+                listing = self.codec.loads(bdata)
+            except ValueError:
+                log.warning('Invalid cached listing of %s', user_id)
+            else:
+                self.hits += 1
+                return listing
+        self.misses += 1
+        listing = loader()
+        # Checked after the loader, its queries may autoflush
+        if txn is not None and str(user_id) in self._pending(txn):
+            return listing
+        metrics.count('redis')
+        self.client.set(key, self.codec.dumps(listing), ex=self.ttl)
+        return listing
+
+    def invalidate(self, user_id:str) -> None:
+        """Invalidate the listings of a user now."""
+        metrics.count('redis')
+        self.client.incr(self._version_key(user_id))
+        self.invalidations += 1
+
+    def invalidate_on_commit(self, txn, user_id:str) -> None:
+        """Invalidate the listings of a user if the transaction commits.
+
+        :param txn: the transaction (``request.tm.get()``)
+        :param user_id: the user id
+        """
+        try:
+            user_ids = txn.data(self)
+        except KeyError:
+            user_ids = set()
+            txn.set_data(self, user_ids)
+            txn.addAfterCommitHook(self._after_commit, (user_ids,))
+        user_ids.add(str(user_id))
+
+    def _pending(self, txn) -> set:
+        """Return the users invalidated when the transaction commits."""
+        try:
+            return txn.data(self)
+        except KeyError:
+            return set()
+
+    def _after_commit(self, status:bool, user_ids:set) -> None:
+        if not status:
+            return
+        for user_id in user_ids:
+            try:
+                self.invalidate(user_id)
+            except redis.RedisError:
+                # The cached listing expire with its ttl
+                log.exception('Cannot invalidate the listings of %s', user_id)
+
+    def stats(self) -> dict:
+        """Return the cache counters."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def invalidate_flushed(cache:ListingCache):
+    """Return the ``after_flush`` listener invalidating the owners of the
+    flushed instances."""
+    def after_flush(session, flush_context) -> None:
+        manager = session.info.get('transaction_manager')
+        if manager is None:
+            return
+        for instance in (session.new | session.dirty | session.deleted):
+            owner = getattr(type(instance), '__listing_owner__', None)
+            if owner is None:
+                continue
+            # The previous owner too if the instance changed of owner
+            history = inspect(instance).attrs[owner].history
+            for user_id in history.sum():
+                if user_id is not None:
+                    cache.invalidate_on_commit(manager.get(), user_id)
+    return after_flush
+
+
+def _bulk_owners(orm_execute_state, owner:str) -> set:
+    """Return the owners of the rows of an ORM update / delete."""
+    mapper = orm_execute_state.bind_mapper
+    statement = orm_execute_state.statement
+    query = select(getattr(mapper.class_, owner)).distinct()
+    parameters = orm_execute_state.parameters
+    if isinstance(parameters, list):
+        # Bulk update by primary key: a list of dicts
+        keys = [
+            (column, mapper.get_property_by_column(column).key)
+            for column in mapper.primary_key
+        ]
+        query = query.where(or_(*(
+            and_(*(column == values[key] for column, key in keys))
+            for values in parameters
+        )))
+    elif statement.whereclause is not None:
+        query = query.where(statement.whereclause)
+    return set(orm_execute_state.session.execute(query).scalars())
+
+
+def invalidate_executed(cache:ListingCache):
+    """Return the ``do_orm_execute`` listener invalidating the owners of
+    the rows of the ORM bulk updates / deletes."""
+    def do_orm_execute(orm_execute_state) -> None:
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+        manager = orm_execute_state.session.info.get('transaction_manager')
+        mapper = orm_execute_state.bind_mapper
+        if manager is None or mapper is None:
+            return
+        owner = getattr(mapper.class_, '__listing_owner__', None)
+        if owner is None:
+            return
+        for user_id in _bulk_owners(orm_execute_state, owner):
+            if user_id is not None:
+                cache.invalidate_on_commit(manager.get(), user_id)
+    return do_orm_execute
+
+
+def includeme(config):
+    """Add the listing cache to the registry and ``request.listing_cache``.
+
+    Activated by ``pvault.listing_cache.enabled``, the cache use the redis
+    server ``pvault.listing_cache.redis_url``.
+    """
+    settings = config.get_settings()
+    if not asbool(settings.get('pvault.listing_cache.enabled', False)):
+        return
+    cache = ListingCache(
+        redis.StrictRedis.from_url(settings['pvault.listing_cache.redis_url']),
+        ttl=int(settings.get('pvault.listing_cache.ttl', 3600)),
+    )
+    config.registry['listing_cache'] = cache
+    event.listen(
+        config.registry['dbsession_factory'], 'after_flush',
+        invalidate_flushed(cache),
+    )
+    event.listen(
+        config.registry['dbsession_factory'], 'do_orm_execute',
+        invalidate_executed(cache),
+    )
+    config.add_request_method(
+        lambda request: request.registry['listing_cache'], 'listing_cache',
+        reify=True,
+    )
@@ -0,0 +1,54 @@
+"""Views requested by the load tests (``pvault-loadtest``).
+
+They exercise one part of the stack each:
+
+- ``/_loadtest/session/read``: load the session (redis),
+- ``/_loadtest/session/write``: load and save the session,
+- ``/_loadtest/db``: a statement in the request transaction (pyramid_tm,
+  pyramid_retry).
+
+They are only added by ``pvault-loadtest`` (``pyramid.includes``), never
+register them in a deployed application.
+"""
+import sqlalchemy
+from pyramid.request import Request
+from pyramid.response import Response
+
+# Kind of request -> (route name, path)
+ROUTES = {
+    'session_read': ('loadtest_session_read', '/_loadtest/session/read'),
+    'session_write': ('loadtest_session_write', '/_loadtest/session/write'),
+    'db': ('loadtest_db', '/_loadtest/db'),
+}
+
+
+def session_read_view(request:Request) -> Response:
+    return Response(str(request.session.get('counter', 0)))
+
+
+def session_write_view(request:Request) -> Response:
+    session = request.session
+    session['counter'] = session.get('counter', 0) + 1
+    return Response(str(session['counter']))
+
+
+def db_view(request:Request) -> Response:
+    value = request.dbsession.execute(
+        sqlalchemy.text('SELECT :value'), {'value': 1}
+    ).scalar()
+    return Response(str(value))
+
+
+def includeme(config):
+    """Add the load tests views.
+
+    Activate this setup using ``config.include('pvault.loadtest')``.
+    """
+    for kind, view in (
+        ('session_read', session_read_view),
+        ('session_write', session_write_view),
+        ('db', db_view),
+    ):
+        name, path = ROUTES[kind]
+        config.add_route(name, path)
+        config.add_view(view, route_name=name)
@@ -0,0 +1,42 @@
+"""Registrations of the application, used instead of ``config.scan()``
+when ``pvault.registration = manifest`` (see :mod:`pvault.registration`).
+
+Generated by ``pvault-manifest``, don't edit.
+"""
+
+REGISTRATIONS = [
+    ('add_exception_view',
+     'pvault.crypto:crypto_unavailable_view',
+     {'context': 'pvault.crypto:CryptoBusy'},
+     ('context',)),
+    ('add_exception_view',
+     'pvault.crypto:crypto_unavailable_view',
+     {'context': 'pvault.crypto:CryptoTimeout'},
+     ('context',)),
+    ('add_view',
+     'pvault.export:export_view',
+     {'permission': 'export', 'request_method': 'GET', 'route_name': 'export'},
+     ()),
+    ('add_view',
+     'pvault.metrics:metrics_view',
+     {'permission': 'metrics', 'route_name': 'metrics'},
+     ()),
+    ('add_view',
+     'pvault.views:home_view',
+     {'etag': 'pvault.conditional:deployment_etag',
+      'renderer': 'pvault:templates/home.jinja2',
+      'route_name': 'home'},
+     ('etag',)),
+    ('add_view',
+     'pvault.views:test_session_view',
+     {'renderer': 'pvault:templates/test_session.jinja2',
+      'route_name': 'test_session'},
+     ()),
+    ('add_view',
+     'pvault.views:test_view',
+     {'renderer': 'pvault:templates/test.jinja2', 'route_name': 'test'},
+     ()),
+]
+
+MODELS = [
+]
@@ -0,0 +1,414 @@
+"""Per-request latency breakdown and Prometheus metrics.
+
+This module include in the config:
+
+- a tween (outside of pyramid_tm) timing the whole request and a tween
+  (inside pyramid_tm) marking the end of the view so that the transaction
+  commit time can be computed,
+- two view derivers timing the view and the view plus its renderer (the
+  difference is the rendering time),
+- SQLAlchemy engine events counting and timing the statements, other
+  modules get the duration of the statements of an engine with
+  :func:`on_statement`.
+
+The session factory and any other code can record timings with
+:func:`add` and counts with :func:`count`, they are attributed to the
+request currently handled by the thread. Events (slow queries, requests
+retried by pyramid_retry...) are counted by route with :func:`increment`.
+
+Each thread aggregate its own histograms, so recording a request never
+take a lock. The ``/metrics`` view merge the histograms of every threads
+and render them in the Prometheus text format. It requires the ``metrics``
+permission, granted to the ``pvault.metrics.allowed_ips`` clients (see
+:mod:`pvault.security`).
+"""
+import time
+import bisect
+import weakref
+import threading
+
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+
+from pyramid.tweens import INGRESS
+from pyramid.interfaces import ISessionFactory
+from pyramid.request import Request
+from pyramid.response import Response
+from pyramid.view import view_config
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Phases of the request
+PHASES = ('total', 'session', 'db', 'view', 'render', 'commit')
+
+_local = threading.local()
+_registry_lock = threading.Lock()
+_thread_stats = []
+
+# engine -> callbacks of its statements
+_statement_callbacks = weakref.WeakKeyDictionary()
+
+
+class _Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets:tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other:'_Histogram') -> None:
+        for i, value in enumerate(other.counts):
+            self.counts[i] += value
+        self.sum += other.sum
+        self.count += other.count
+
+
+class _ThreadStats(object):
+    """Histograms of a thread, by ``(metric, route, label)``, and counters
+    by ``(name, route)``."""
+
+    def __init__(self) -> None:
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, key:tuple, buckets:tuple, value) -> None:
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = _Histogram(buckets)
+        histogram.observe(value)
+
+
+def _stats() -> _ThreadStats:
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        stats = _local.stats = _ThreadStats()
+        with _registry_lock:
+            _thread_stats.append(stats)
+    return stats
+
+
+class RequestMetrics(object):
+    """Timings and counts of the request handled by the thread."""
+
+    __slots__ = (
+        'start', 'handler_end', 'tm_end', 'session', 'db', 'view',
+        'rendered', 'redis_calls', 'db_statements',
+    )
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.handler_end = None
+        self.tm_end = None
+        self.session = 0.0
+        self.db = 0.0
+        self.view = 0.0
+        self.rendered = 0.0
+        self.redis_calls = 0
+        self.db_statements = 0
+
+    @property
+    def render(self) -> float:
+        return max(self.rendered - self.view, 0.0)
+
+    @property
+    def commit(self) -> float:
+        if self.handler_end is None or self.tm_end is None:
+            return 0.0
+        return self.tm_end - self.handler_end
+
+    def finish(self, request:Request) -> None:
+        """Record the request in the histograms of the thread."""
+        total = time.perf_counter() - self.start
+        if getattr(_local, 'current', None) is self:
+            _local.current = None
+
+        route = request.matched_route
+        route = route.name if route is not None else ''
+        stats = _stats()
+        for phase in PHASES:
+            value = total if phase == 'total' else getattr(self, phase)
+            stats.observe(('duration', route, phase), DURATION_BUCKETS, value)
+        stats.observe(
+            ('count', route, 'redis'), COUNT_BUCKETS, self.redis_calls
+        )
+        stats.observe(
+            ('count', route, 'db'), COUNT_BUCKETS, self.db_statements
+        )
+
+    def summary(self) -> Dict[str, float]:
+        """Return the timings / counts recorded so far."""
+        summary = {phase: getattr(self, phase) for phase in PHASES[1:]}
+        summary['redis_calls'] = self.redis_calls
+        summary['db_statements'] = self.db_statements
+        return summary
+
+
+def current() -> Optional[RequestMetrics]:
+    """Return the metrics of the request handled by the thread."""
+    return getattr(_local, 'current', None)
+
+
+def add(phase:str, elapsed:float) -> None:
+    """Add a duration to a phase of the current request.
+
+    :param phase: the phase (``session``, ``db``...)
+    :type phase: str
+    :param elapsed: the duration in seconds
+    :type elapsed: float
+    """
+    metrics = getattr(_local, 'current', None)
+    if metrics is not None:
+        setattr(metrics, phase, getattr(metrics, phase) + elapsed)
+
+
+def count(name:str, value:int=1) -> None:
+    """Count redis round-trips (``redis``) or db statements (``db``).
+
+    :param name: the counter
+    :type name: str
+    :param value: the value to add
+    :type value: int
+    """
+    metrics = getattr(_local, 'current', None)
+    if metrics is not None:
+        if name == 'redis':
+            metrics.redis_calls += value
+        else:
+            metrics.db_statements += value
+
+
+def increment(name:str, route:str='', value:int=1) -> None:
+    """Increment the ``pvault_{name}_total`` counter of a route.
+
+    :param name: the counter
+    :type name: str
+    :param route: the route name
+    :type route: str
+    :param value: the value to add
+    :type value: int
+    """
+    counters = _stats().counters
+    counters[(name, route)] = counters.get((name, route), 0) + value
+
+
+# #############################################################################
+# ############################ Pyramid integration ############################
+# #############################################################################
+def metrics_tween_factory(handler, registry):
+    """Tween timing the whole request, placed over pyramid_tm."""
+    def metrics_tween(request):
+        metrics = _local.current = RequestMetrics()
+        request.metrics = metrics
+        # Finished callbacks run after the response callbacks (session save)
+        request.add_finished_callback(metrics.finish)
+        try:
+            return handler(request)
+        finally:
+            metrics.tm_end = time.perf_counter()
+    return metrics_tween
+
+
+def metrics_tm_tween_factory(handler, registry):
+    """Tween marking the end of the view, placed under pyramid_tm."""
+    def metrics_tm_tween(request):
+        try:
+            return handler(request)
+        finally:
+            metrics = getattr(request, 'metrics', None)
+            if metrics is not None:
+                metrics.handler_end = time.perf_counter()
+    return metrics_tm_tween
+
+
+def _timed_view(phase:str):
+    def deriver(view, info):
+        def wrapper(context, request):
+            start = time.perf_counter()
+            try:
+                return view(context, request)
+            finally:
+                add(phase, time.perf_counter() - start)
+        return wrapper
+    return deriver
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('pvault_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get('pvault_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    add('db', elapsed)
+    count('db')
+    engine = conn.engine
+    # The engines of execution_options() are proxies of the engine
+    callbacks = _statement_callbacks.get(getattr(engine, '_proxied', engine))
+    if callbacks:
+        for callback in callbacks:
+            callback(statement, elapsed)
+
+
+def _listen_engines() -> None:
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def on_statement(engine:Engine,
+                 callback:Callable[[str, float], None]) -> None:
+    """Call ``callback(statement, elapsed)`` after each statement of an
+    engine, with the duration measured by the metrics events.
+
+    :param engine: the SQLAlchemy engine
+    :param callback: the function called with the SQL statement and its
+        duration in seconds
+    """
+    _listen_engines()
+    _statement_callbacks.setdefault(engine, []).append(callback)
+
+
+def _count_retry(event) -> None:
+    """Count the requests retried by pyramid_retry."""
+    route = event.request.matched_route
+    increment('request_retries', route.name if route is not None else '')
+
+
+def _merged() -> Dict[tuple, _Histogram]:
+    """Merge the histograms of every threads."""
+    with _registry_lock:
+        thread_stats = list(_thread_stats)
+    merged = {}
+    for stats in thread_stats:
+        for key, histogram in list(stats.histograms.items()):
+            if key not in merged:
+                merged[key] = _Histogram(histogram.buckets)
+            merged[key].merge(histogram)
+    return merged
+
+
+def _merged_counters() -> Dict[tuple, int]:
+    """Merge the counters of every threads."""
+    with _registry_lock:
+        thread_stats = list(_thread_stats)
+    merged = {}
+    for stats in thread_stats:
+        for key, value in list(stats.counters.items()):
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def _render_histogram(lines:List[str], name:str, labels:str,
+                      histogram:_Histogram) -> None:
+    cumulative = 0
+    for bound, value in zip(histogram.buckets, histogram.counts):
+        cumulative += value
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+
+def render_metrics(registry=None) -> str:
+    """Return the metrics in the Prometheus text format."""
+    merged = _merged()
+    lines = [
+        '# HELP pvault_request_duration_seconds Request duration by phase.',
+        '# TYPE pvault_request_duration_seconds histogram',
+    ]
+    for (kind, route, label), histogram in sorted(merged.items()):
+        if kind == 'duration':
+            _render_histogram(
+                lines, 'pvault_request_duration_seconds',
+                f'route="{route}",phase="{label}"', histogram,
+            )
+    for label, help_text in (
+        ('redis', 'Redis round-trips per request.'),
+        ('db', 'Database statements per request.'),
+    ):
+        name = f'pvault_request_{label}_calls'
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for (kind, route, other), histogram in sorted(merged.items()):
+            if kind == 'count' and other == label:
+                _render_histogram(lines, name, f'route="{route}"', histogram)
+
+    declared = set()
+    for (name, route), value in sorted(_merged_counters().items()):
+        if name not in declared:
+            declared.add(name)
+            lines.append(f'# TYPE pvault_{name}_total counter')
+        lines.append(f'pvault_{name}_total{{route="{route}"}} {value}')
+
+    # Counters of the session cache
+    factory = registry.queryUtility(ISessionFactory) if registry else None
+    cache = getattr(factory, 'cache', None)
+    if cache is not None:
+        for name, value in cache.stats().items():
+            lines.append(f'# TYPE pvault_session_cache_{name} gauge')
+            lines.append(f'pvault_session_cache_{name} {value}')
+
+    # Counters of the listings cache
+    listing_cache = registry.get('listing_cache') if registry else None
+    if listing_cache is not None:
+        for name, value in listing_cache.stats().items():
+            lines.append(f'# TYPE pvault_listing_cache_{name} gauge')
+            lines.append(f'pvault_listing_cache_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+@view_config(route_name='metrics', permission='metrics')
+def metrics_view(request:Request) -> Response:
+    return Response(
+        render_metrics(request.registry),
+        content_type='text/plain',
+        charset='utf-8',
+    )
+
+
+def includeme(config):
+    """Activate the request metrics.
+
+    Activate this setup using ``config.include('pvault.metrics')``.
+    """
+    config.add_tween(
+        'pvault.metrics.metrics_tween_factory', under=INGRESS
+    )
+    config.add_tween(
+        'pvault.metrics.metrics_tm_tween_factory',
+        under=('pyramid_tm.tm_tween_factory',
+               'pvault.metrics.metrics_tween_factory'),
+    )
+    config.add_view_deriver(
+        _timed_view('rendered'), 'pvault_rendered_timer',
+        under='decorated_view', over='rendered_view',
+    )
+    config.add_view_deriver(
+        _timed_view('view'), 'pvault_view_timer',
+        under='rendered_view', over='mapped_view',
+    )
+    config.add_subscriber(_count_retry, 'pyramid_retry.IBeforeRetry')
+    _listen_engines()
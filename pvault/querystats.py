@@ -0,0 +1,190 @@
+"""SQL statements instrumentation: slow query log and N+1 detection.
+
+This module is used by :mod:`pvault.db` when ``pvault.db.instrument`` is
+true. It receives the statements of the engine timed by the
+:mod:`pvault.metrics` events (:func:`pvault.metrics.on_statement`) and
+fingerprint them (the SQL with its literals replaced by ``?``), and a
+tween collecting the statements of each request in a :class:`QueryStats`
+(``request.query_stats``).
+
+- statements slower than ``pvault.db.slow_query_threshold`` seconds are
+  logged with the route of the request,
+- requests running the same fingerprint more than
+  ``pvault.db.n_plus_one_threshold`` times are logged as N+1 patterns.
+
+Both are counted in the ``/metrics`` endpoint. The per-request summary is
+shown by the debug toolbar with::
+
+    debugtoolbar.extra_panels = pvault.debugpanel.QueryStatsDebugPanel
+"""
+import re
+import logging
+import threading
+import collections
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+)
+
+from pyramid.request import Request
+from pyramid.settings import asbool
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+# Not the ``::type`` casts of PostgreSQL
+_PARAM_RE = re.compile(r'%\(\w+\)s|%s|(?<!:):\w+')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(statement:str) -> str:
+    """Return the normalized SQL of a statement.
+
+    Literals and bound parameters are replaced by ``?`` and the ``IN``
+    lists are collapsed, so the same query with different values has the
+    same fingerprint.
+
+    :param statement: the SQL statement
+    :type statement: str
+    :rtype: str
+    """
+    statement = _STRING_RE.sub('?', statement)
+    statement = _PARAM_RE.sub('?', statement)
+    statement = _NUMBER_RE.sub('?', statement)
+    statement = _IN_RE.sub('(?)', statement)
+    return _SPACE_RE.sub(' ', statement).strip()
+
+
+class QueryStats(object):
+    """Statements run during a request, by fingerprint."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.duration = 0.0
+        self.slow = []
+        self.fingerprints = collections.Counter()
+        self.durations = collections.defaultdict(float)
+
+    def record(self, statement:str, elapsed:float, slow_threshold:float) -> None:
+        """Record a statement.
+
+        :param statement: the SQL statement
+        :type statement: str
+        :param elapsed: the duration of the statement in seconds
+        :type elapsed: float
+        :param slow_threshold: the slow statement threshold in seconds
+        :type slow_threshold: float
+        """
+        key = fingerprint(statement)
+        self.count += 1
+        self.duration += elapsed
+        self.fingerprints[key] += 1
+        self.durations[key] += elapsed
+        if elapsed >= slow_threshold:
+            self.slow.append((key, elapsed))
+
+    def repeated(self, threshold:int) -> Dict[str, int]:
+        """Return the fingerprints run more than ``threshold`` times."""
+        return {
+            key: count
+            for key, count in self.fingerprints.items()
+            if count > threshold
+        }
+
+    def summary(self) -> List[dict]:
+        """Return the statements by fingerprint, the slowest first."""
+        return sorted(
+            (
+                {
+                    'fingerprint': key,
+                    'count': count,
+                    'duration': self.durations[key],
+                }
+                for key, count in self.fingerprints.items()
+            ),
+            key=lambda item: item['duration'],
+            reverse=True,
+        )
+
+
+def current() -> Optional[QueryStats]:
+    """Return the statistics of the request handled by the thread."""
+    return getattr(_local, 'current', None)
+
+
+def instrument(engine, slow_threshold:float) -> None:
+    """Record the statements of the engine.
+
+    :param engine: the SQLAlchemy engine
+    :param slow_threshold: the slow statement threshold in seconds
+    :type slow_threshold: float
+    """
+    def record(statement:str, elapsed:float) -> None:
+        stats = getattr(_local, 'current', None)
+        if stats is not None:
+            stats.record(statement, elapsed, slow_threshold)
+        elif elapsed >= slow_threshold:
+            log.warning(
+                'Slow query (%.3fs) outside of a request: %s',
+                elapsed, fingerprint(statement),
+            )
+    metrics.on_statement(engine, record)
+
+
+def querystats_tween_factory(handler, registry):
+    """Tween collecting the statements of the request."""
+    settings = registry.settings
+    n_plus_one = int(settings.get('pvault.db.n_plus_one_threshold', 10))
+
+    def querystats_tween(request):
+        stats = _local.current = request.query_stats = QueryStats()
+        try:
+            return handler(request)
+        finally:
+            _local.current = None
+            _report(request, stats, n_plus_one)
+    return querystats_tween
+
+
+def _report(request:Request, stats:QueryStats, n_plus_one:int) -> None:
+    route = request.matched_route
+    route = route.name if route is not None else ''
+    for key, elapsed in stats.slow:
+        log.warning(
+            'Slow query (%.3fs) on route %r: %s', elapsed, route, key
+        )
+    if stats.slow:
+        metrics.increment('db_slow_queries', route, len(stats.slow))
+    repeated = stats.repeated(n_plus_one)
+    for key, count in repeated.items():
+        log.warning(
+            'Possible N+1 on route %r, query run %d times: %s',
+            route, count, key,
+        )
+    if repeated:
+        metrics.increment('db_n_plus_one', route, len(repeated))
+
+
+def includeme(config):
+    """Activate the statements instrumentation if enabled in the settings.
+
+    Called by :mod:`pvault.db` once the engine is created.
+    """
+    settings = config.get_settings()
+    if not asbool(settings.get('pvault.db.instrument', False)):
+        return
+    slow_threshold = float(settings.get('pvault.db.slow_query_threshold', 0.1))
+    for engine in [config.registry['dbengine']] + config.registry['dbreplicas']:
+        instrument(engine, slow_threshold)
+    config.add_tween(
+        'pvault.querystats.querystats_tween_factory',
+        over='pyramid_tm.tm_tween_factory',
+    )
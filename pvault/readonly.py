@@ -0,0 +1,94 @@
+"""Read-only requests.
+
+Views declared with ``read_only=True``::
+
+    @view_config(route_name='vault', renderer='json', read_only=True)
+    def vault_view(request):
+        ...
+
+get a ``request.dbsession`` which is not joined to the pyramid_tm
+transaction: there is no zope.sqlalchemy data manager and no commit. The
+connection runs a ``READ ONLY DEFERRABLE`` transaction (PostgreSQL) which
+is rolled back when the request is finished. Flushing the session raise a
+:class:`ReadOnlyError`.
+
+The ``read_only`` option must be set on the view, ``request.dbsession``
+must not be used before the view is called (by a tween for instance), if it
+is the session stays joined to the transaction but still refuse to flush.
+"""
+from typing import Optional
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+# Execution options of the read-only connections
+READ_ONLY_OPTIONS = {
+    'postgresql_readonly': True,
+    'postgresql_deferrable': True,
+}
+
+
+class ReadOnlyError(Exception):
+    """A read-only session tried to write."""
+
+
+def read_only_engine(engine:Engine, engines:Optional[dict]=None) -> Engine:
+    """Return the engine running read-only transactions.
+
+    :param engine: the engine
+    :type engine: Engine
+    :param engines: the cache of the read-only engines of the application
+                    (``registry['dbreadonly_engines']``, cleared by
+                    :func:`pvault.db.dispose_engine`), None to not cache
+    :type engines: dict
+    """
+    if engines is None:
+        return engine.execution_options(**READ_ONLY_OPTIONS)
+    read_only = engines.get(engine)
+    if read_only is None:
+        read_only = engines[engine] = engine.execution_options(
+            **READ_ONLY_OPTIONS
+        )
+    return read_only
+
+
+def before_flush(session:Session, flush_context, instances) -> None:
+    """Session event refusing to flush the read-only sessions."""
+    if session.info.get('read_only'):
+        raise ReadOnlyError('The session of a read-only request cannot write')
+
+
+def get_read_only_session(session_factory, request):
+    """Return a session not joined to the transaction manager.
+
+    The session is closed (the transaction is rolled back) when the request
+    is finished.
+
+    :param session_factory: the session factory
+    :param request: the request
+    """
+    dbsession = session_factory(
+        bind=read_only_engine(
+            session_factory.kw['bind'],
+            request.registry['dbreadonly_engines'],
+        )
+    )
+    dbsession.info['read_only'] = True
+    request.add_finished_callback(lambda request: dbsession.close())
+    return dbsession
+
+
+def read_only_view(view, info):
+    """View deriver marking the requests of the ``read_only`` views."""
+    if not info.options.get('read_only'):
+        return view
+
+    def wrapper(context, request):
+        request.db_read_only = True
+        if 'dbsession' in request.__dict__:
+            request.dbsession.info['read_only'] = True
+        return view(context, request)
+    return wrapper
+
+
+read_only_view.options = ('read_only',)
@@ -0,0 +1,171 @@
+"""Registration of the views: venusian scan or generated manifest.
+
+``config.scan()`` imports every module of the package to find the
+``@view_config`` decorators, and the alembic ``env.py`` imported every
+subpackage to find the models. Both grow with the application and slow
+each worker boot and migration run.
+
+With ``pvault.registration = manifest`` the views are registered from
+:mod:`pvault.manifest` instead: a list of the ``add_view`` /
+``add_exception_view`` calls the scan would do, which only imports the
+modules of the views. :mod:`pvault.manifest` also lists the modules
+defining the models for the alembic migrations (``alembic revision
+--autogenerate`` still scans the package, a stale manifest would drop the
+tables of the missing models).
+
+The manifest is generated by the scan (``pvault-manifest``), run it again
+after adding or changing a view or a model: the tests check that it is up
+to date. ``pvault.registration = scan`` (the default) is convenient in
+development.
+"""
+import pprint
+
+from types import ModuleType
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+import venusian
+from pyramid.path import package_of
+
+# Modules never scanned: no registrations, slow or optional imports
+SCAN_IGNORE = [
+    'pvault.debugpanel',
+    'pvault.scripts',
+    'pvault.tests',
+]
+
+# (configurator method, dotted name of the view, arguments, names of the
+# arguments holding a dotted name)
+Registration = Tuple[str, str, Dict, Tuple[str, ...]]
+
+HEADER = '''"""Registrations of the application, used instead of ``config.scan()``
+when ``pvault.registration = manifest`` (see :mod:`pvault.registration`).
+
+Generated by ``pvault-manifest``, don't edit.
+"""
+'''
+
+
+def _dotted_name(obj) -> str:
+    return f'{obj.__module__}:{obj.__qualname__}'
+
+
+def _is_literal(value) -> bool:
+    if isinstance(value, (tuple, list, frozenset, set)):
+        return all(_is_literal(item) for item in value)
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+class _Recorder(object):
+    """Configurator recording the registrations of the venusian callbacks."""
+
+    def __init__(self) -> None:
+        self.registrations: List[Registration] = []
+        self.package = None
+
+    def with_package(self, module:ModuleType) -> '_Recorder':
+        recorder = _Recorder()
+        recorder.registrations = self.registrations
+        recorder.package = package_of(module)
+        return recorder
+
+    def _record(self, method:str, view, settings:dict) -> None:
+        arguments = {}
+        dotted = []
+        for key, value in settings.items():
+            if key.startswith('_') or value is None:
+                continue
+            if key == 'renderer' and '.' in value and ':' not in value:
+                # Template relative to the package of the view
+                value = f'{self.package.__name__}:{value}'
+            if not _is_literal(value):
+                if not callable(value):
+                    raise ValueError(
+                        f'Cannot record {key}={value!r} of {view!r}'
+                    )
+                value = _dotted_name(value)
+                dotted.append(key)
+            arguments[key] = value
+        self.registrations.append(
+            (method, _dotted_name(view), arguments, tuple(sorted(dotted)))
+        )
+
+    def add_view(self, view=None, **settings) -> None:
+        self._record('add_view', view, settings)
+
+    def add_exception_view(self, view=None, **settings) -> None:
+        self._record('add_exception_view', view, settings)
+
+
+def collect(package:ModuleType) -> List[Registration]:
+    """Return the registrations of the ``@view_config`` /
+    ``@exception_view_config`` decorators of a package (this imports every
+    module of the package).
+
+    :param package: the package to scan
+    :rtype: list
+    """
+    recorder = _Recorder()
+    scanner = venusian.Scanner(config=recorder)
+    scanner.scan(package, categories=('pyramid',), ignore=SCAN_IGNORE)
+    return sorted(recorder.registrations, key=repr)
+
+
+def model_modules(package:ModuleType) -> List[str]:
+    """Return the modules of a package defining models, once imported (by
+    :func:`collect`)."""
+    from .db import ModelBase
+    prefix = package.__name__ + '.'
+    return sorted({
+        mapper.class_.__module__
+        for mapper in ModelBase.registry.mappers
+        if mapper.class_.__module__.startswith(prefix)
+        and not any(
+            mapper.class_.__module__.startswith(ignored)
+            for ignored in SCAN_IGNORE
+        )
+    })
+
+
+def render_manifest(registrations:List[Registration],
+                    models:List[str]) -> str:
+    """Return the source of the manifest module."""
+    def items(values) -> str:
+        return ''.join(
+            '    ' + pprint.pformat(value, width=75).replace('\n', '\n    ')
+            + ',\n'
+            for value in values
+        )
+    return (
+        f'{HEADER}\n'
+        f'REGISTRATIONS = [\n{items(registrations)}]\n\n'
+        f'MODELS = [\n{items(models)}]\n'
+    )
+
+
+def register(config, registrations:List[Registration]) -> None:
+    """Register the views of a manifest.
+
+    :param config: the configurator
+    :param registrations: the registrations of the manifest
+    """
+    for method, view, arguments, dotted in registrations:
+        arguments = dict(arguments)
+        for key in dotted:
+            arguments[key] = config.maybe_dotted(arguments[key])
+        getattr(config, method)(view=config.maybe_dotted(view), **arguments)
+
+
+def includeme(config):
+    """Register the views with the ``pvault.registration`` method.
+
+    Activate this setup using ``config.include('pvault.registration')``.
+    """
+    if config.get_settings().get('pvault.registration', 'scan') == 'manifest':
+        from .manifest import REGISTRATIONS
+        register(config, REGISTRATIONS)
+    else:
+        config.scan('pvault', ignore=SCAN_IGNORE)
@@ -0,0 +1,166 @@
+"""Read replicas routing of ``request.dbsession``.
+
+When ``sqlalchemy.replica.urls`` is set, :mod:`pvault.db` create a
+:class:`RoutingSession` sending:
+
+- the flushes, the writes (``INSERT``, ``UPDATE``, ``DELETE``), the
+  ``SELECT ... FOR UPDATE`` and the textual statements to the primary,
+- the ``SELECT`` of the views marked read-only (``read_only=True`` view
+  option, see :mod:`pvault.readonly`) to a replica,
+- with ``sqlalchemy.replica.reads = all``, the ``SELECT`` of every views
+  to a replica until the session write something.
+
+The replicas are chosen by ``sqlalchemy.replica.strategy``:
+``round_robin`` or ``least_connections`` (fewer checked out connections).
+The other ``sqlalchemy.replica.*`` settings (``pool_size``...) configure the
+engines of the replicas.
+
+With ``sqlalchemy.replica.pin_seconds``, a user who wrote is sent to the
+primary for this number of seconds (read-your-writes), a cookie holds the
+end of the window.
+"""
+import time
+import threading
+
+from typing import (
+    List,
+    Optional,
+)
+
+from pyramid.request import Request
+from pyramid.response import Response
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+from .readonly import read_only_engine
+
+STRATEGIES = ('round_robin', 'least_connections')
+READS = ('read_only', 'all')
+
+# Settings of the routing, the others configure the engines
+ROUTING_SETTINGS = ('urls', 'strategy', 'reads', 'pin_seconds')
+
+PIN_COOKIE = 'pvault_primary'
+
+
+class ReplicaSelector(object):
+    """Choose the replica engine of a session.
+
+    :param engines: the replica engines
+    :type engines: list
+    :param strategy: ``round_robin`` or ``least_connections``
+    :type strategy: str
+    """
+
+    def __init__(self, engines:List[Engine],
+                 strategy:str='round_robin') -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown replica strategy: {strategy}')
+        if not engines:
+            raise ValueError('At least one replica is required')
+        self.engines = engines
+        self.strategy = strategy
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self) -> Engine:
+        """Return the engine of the next replica."""
+        if self.strategy == 'least_connections':
+            return min(self.engines, key=_checked_out)
+        with self._lock:
+            engine = self.engines[self._next % len(self.engines)]
+            self._next += 1
+        return engine
+
+
+def _checked_out(engine:Engine) -> int:
+    checkedout = getattr(engine.pool, 'checkedout', None)
+    return checkedout() if checkedout is not None else 0
+
+
+class RoutingSession(Session):
+    """Session sending the reads to the replicas and the writes to the
+    primary.
+
+    The routing is driven by the ``info`` of the session:
+
+    - ``read_only`` : every statements go to the replica,
+    - ``primary`` : every statements go to the primary (the user is
+      pinned),
+    - ``replica_reads`` : the ``SELECT`` go to the replica,
+    - ``wrote`` : set once a statement went to the primary, the next
+      ``SELECT`` go to the primary too.
+
+    A session use only one replica. ``read_only_engines`` is the cache of
+    the read-only engines (see :func:`pvault.readonly.read_only_engine`).
+    """
+
+    def __init__(self, replicas:Optional[ReplicaSelector]=None,
+                 read_only_engines:Optional[dict]=None, **kw) -> None:
+        super().__init__(**kw)
+        self.replicas = replicas
+        self.read_only_engines = read_only_engines
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        primary = super().get_bind(mapper, clause=clause, **kw)
+        info = self.info
+        if self.replicas is None:
+            return primary
+        if info.get('read_only') and not info.get('primary'):
+            return read_only_engine(
+                self._get_replica(), self.read_only_engines
+            )
+        if self._flushing or not _is_read(clause):
+            info['wrote'] = True
+            return primary
+        if info.get('replica_reads') and not info.get('wrote') \
+                and not info.get('primary'):
+            return self._get_replica()
+        return primary
+
+    def _get_replica(self) -> Engine:
+        if self._replica is None:
+            self._replica = self.replicas.choose()
+        return self._replica
+
+
+def _is_read(clause) -> bool:
+    """Return True for the ``SELECT`` without ``FOR UPDATE``."""
+    if clause is None or isinstance(clause, UpdateBase):
+        return False
+    if not getattr(clause, 'is_select', False):
+        return False
+    return getattr(clause, '_for_update_arg', None) is None
+
+
+def configure_session(request:Request, dbsession:Session, reads:str,
+                      pin_seconds:int) -> None:
+    """Set the routing of the session of a request.
+
+    :param request: the request
+    :param dbsession: the session of the request
+    :param reads: ``read_only`` or ``all``
+    :type reads: str
+    :param pin_seconds: the read-your-writes window, 0 to disable
+    :type pin_seconds: int
+    """
+    dbsession.info['replica_reads'] = reads == 'all'
+    if not pin_seconds:
+        return
+    try:
+        pinned_until = float(request.cookies.get(PIN_COOKIE, 0))
+    except ValueError:
+        pinned_until = 0
+    if pinned_until > time.time():
+        dbsession.info['primary'] = True
+
+    def pin(request:Request, response:Response) -> None:
+        if dbsession.info.get('wrote'):
+            response.set_cookie(
+                PIN_COOKIE, str(int(time.time() + pin_seconds)),
+                max_age=pin_seconds, httponly=True,
+                secure=request.scheme == 'https', samesite='Lax',
+            )
+    request.add_response_callback(pin)
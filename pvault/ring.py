@@ -0,0 +1,108 @@
+"""Consistent hashing of keys over several nodes.
+
+This module is used to spread the sessions over several redis nodes. Each
+node is placed several times (virtual nodes) on a ring of hashes, a key is
+routed to the first node found after its own hash on the ring. Adding or
+removing a node only move the keys of the ring portions owned by this node.
+"""
+import bisect
+import hashlib
+
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+
+def _hash(value: str) -> int:
+    """Return the position of the value on the ring."""
+    digest = hashlib.md5(value.encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hash ring.
+
+    The ring map a node name to a node object (a redis client for the
+    sessions). Nodes can be added or removed at any time.
+    """
+
+    def __init__(self, nodes:Optional[Dict[str, Any]]=None,
+                 replicas:int=160) -> None:
+        """Contructor of the class.
+
+        :param nodes: mapping of the node names to the node objects
+        :type nodes: dict
+        :param replicas: number of virtual nodes per node
+        :type replicas: int
+        """
+        self.replicas = replicas
+        self.nodes = {}
+        self._hashes = []
+        self._names = []
+        for name, node in (nodes or {}).items():
+            self.add(name, node)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __getitem__(self, name: str) -> Any:
+        return self.nodes[name]
+
+    def add(self, name: str, node: Any) -> None:
+        """Add a node on the ring.
+
+        :param name: the name of the node, it must be stable across
+            processes as it's used to place the node on the ring.
+        :type name: str
+        :param node: the node object
+        """
+        if name in self.nodes:
+            raise ValueError(f'Node {name} already in the ring')
+        self.nodes[name] = node
+        for i in range(self.replicas):
+            position = _hash(f'{name}#{i}')
+            index = bisect.bisect(self._hashes, position)
+            self._hashes.insert(index, position)
+            self._names.insert(index, name)
+
+    def remove(self, name: str) -> Any:
+        """Remove a node from the ring and return it.
+
+        :param name: the name of the node
+        :type name: str
+        """
+        node = self.nodes.pop(name)
+        kept = [
+            (position, node_name)
+            for position, node_name in zip(self._hashes, self._names)
+            if node_name != name
+        ]
+        self._hashes = [position for position, _ in kept]
+        self._names = [node_name for _, node_name in kept]
+        return node
+
+    def get_name(self, key: str) -> str:
+        """Return the name of the node owning the key.
+
+        :param key: the key to route
+        :type key: str
+        """
+        if not self._hashes:
+            raise LookupError('The ring has no node')
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._names[index]
+
+    def get(self, key: str) -> Any:
+        """Return the node owning the key.
+
+        :param key: the key to route
+        :type key: str
+        """
+        return self.nodes[self.get_name(key)]
+
+    def names(self) -> List[str]:
+        """Return the names of the nodes."""
+        return list(self.nodes)
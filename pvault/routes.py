@@ -5,10 +5,17 @@ application like the root ('/').
 
 Each subpackage have it's own routes module where are defined it's routes.
 """
+from .assets import add_hashed_static_view
+
 
 def includeme(config):
     """Pyramid function that used to load module."""
-    config.add_static_view('static', 'static', cache_max_age=3600)
+    add_hashed_static_view(
+        config, 'static', 'pvault:static',
+        max_age=int(config.get_settings().get('pvault.static.max_age', 3600)),
+    )
     config.add_route('home', '/')
     config.add_route('test', '/test')
     config.add_route('test_session', '/testsession')
+    config.add_route('metrics', '/metrics')
+    config.add_route('export', '/export/{table}.{format}')
@@ -0,0 +1,257 @@
+"""Bulk import / export of the rows of a table.
+
+Usage::
+
+    pvault-bulk development.ini import vault_entry entries.csv
+    pvault-bulk development.ini export vault_entry entries.jsonl
+
+The format is given by the extension of the file (``.csv``, ``.json`` or
+``.jsonl`` for JSON lines: one object per line) or by ``--format``, ``-``
+is stdin / stdout. The columns imported are the keys of the first row, the
+import fails on a row with other keys.
+
+The memory used doesn't depend on the size of the data:
+
+- the rows are imported in batches of ``--batch-size`` rows, with ``COPY``
+  (csv) or ``execute_values`` (json) on PostgreSQL and ``executemany`` on
+  the other databases, in one transaction,
+- the rows are exported with a server-side cursor fetching
+  ``--batch-size`` rows at a time.
+
+The progress and the rows/s are logged after each batch.
+"""
+import io
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import itertools
+
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    TextIO,
+)
+
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+from pyramid.paster import get_appsettings, setup_logging
+
+from ..db import _get_engine
+from ..export import encode_rows
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'jsonl')
+
+
+class Progress(object):
+    """Log the number of rows processed and the rate."""
+
+    def __init__(self, action:str) -> None:
+        self.action = action
+        self.rows = 0
+        self.start = time.perf_counter()
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.perf_counter() - self.start
+        return self.rows / elapsed if elapsed else 0.0
+
+    def update(self, rows:int) -> None:
+        self.rows += rows
+        log.info('%s %d rows (%.0f rows/s)', self.action, self.rows, self.rate)
+
+
+def _batches(rows:Iterable, size:int) -> Iterator[list]:
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def read_rows(stream:TextIO, fmt:str) -> Iterator[Dict]:
+    """Iterate over the rows (dicts) of a csv / JSON lines file."""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _copy_batch(connection:Connection, table:sqlalchemy.Table,
+                columns:List[str], batch:List[Dict]) -> None:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [row.get(column) for column in columns] for row in batch
+    )
+    buffer.seek(0)
+    preparer = connection.dialect.identifier_preparer
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                preparer.format_table(table),
+                ', '.join(preparer.quote(column) for column in columns),
+            ),
+            buffer,
+        )
+
+
+def _values_batch(connection:Connection, table:sqlalchemy.Table,
+                  columns:List[str], batch:List[Dict]) -> None:
+    from psycopg2.extras import execute_values
+    preparer = connection.dialect.identifier_preparer
+    with connection.connection.cursor() as cursor:
+        execute_values(
+            cursor,
+            'INSERT INTO {} ({}) VALUES %s'.format(
+                preparer.format_table(table),
+                ', '.join(preparer.quote(column) for column in columns),
+            ),
+            [tuple(row.get(column) for column in columns) for row in batch],
+            page_size=len(batch),
+        )
+
+
+def _executemany_batch(connection:Connection, table:sqlalchemy.Table,
+                       columns:List[str], batch:List[Dict]) -> None:
+    connection.execute(
+        table.insert(),
+        [{column: row.get(column) for column in columns} for row in batch],
+    )
+
+
+def _insert_method(engine:Engine, fmt:str) -> Callable:
+    if engine.dialect.driver != 'psycopg2':
+        return _executemany_batch
+    return _copy_batch if fmt == 'csv' else _values_batch
+
+
+def _check_columns(row:Dict, columns:List[str], number:int) -> None:
+    """Raise ValueError if the keys of a row are not the columns."""
+    if None in row:
+        raise ValueError(f'Row {number}: more fields than columns')
+    if len(row) != len(columns) or set(row) != set(columns):
+        raise ValueError(
+            f'Row {number}: columns {sorted(row)} instead of {columns}'
+        )
+
+
+def import_rows(engine:Engine, table:sqlalchemy.Table, rows:Iterable[Dict],
+                fmt:str='csv', batch_size:int=5000) -> int:
+    """Insert rows in a table, in one transaction.
+
+    :param engine: the engine
+    :param table: the table
+    :param rows: the rows, the keys of the first one are the columns and
+        every row must have the same keys (``null`` JSON values for NULL)
+    :param fmt: the format of the rows (``csv`` or ``jsonl``)
+    :type fmt: str
+    :param batch_size: the number of rows inserted at once
+    :type batch_size: int
+    :return: the number of rows inserted
+    :rtype: int
+    """
+    insert = _insert_method(engine, fmt)
+    progress = Progress('Imported')
+    columns = None
+    with engine.begin() as connection:
+        for batch in _batches(rows, batch_size):
+            if columns is None:
+                columns = list(batch[0])
+                unknown = set(columns) - set(table.columns.keys())
+                if unknown:
+                    raise ValueError(f'Unknown columns: {sorted(unknown)}')
+            for number, row in enumerate(batch, progress.rows + 1):
+                _check_columns(row, columns, number)
+            if fmt == 'csv':
+                # Empty csv fields are NULL
+                for row in batch:
+                    for column in columns:
+                        if row.get(column) == '':
+                            row[column] = None
+            insert(connection, table, columns, batch)
+            progress.update(len(batch))
+    return progress.rows
+
+
+def export_rows(engine:Engine, table:sqlalchemy.Table, stream:TextIO,
+                fmt:str='csv', batch_size:int=5000) -> int:
+    """Write the rows of a table, fetched with a server-side cursor.
+
+    :param engine: the engine
+    :param table: the table
+    :param stream: the output
+    :param fmt: the format of the output (``csv`` or ``jsonl``)
+    :type fmt: str
+    :param batch_size: the number of rows fetched at once
+    :type batch_size: int
+    :return: the number of rows exported
+    :rtype: int
+    """
+    progress = Progress('Exported')
+    columns = list(table.columns.keys())
+    if fmt == 'csv':
+        stream.write(encode_rows(columns, (), fmt, header=True))
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=batch_size).execute(
+            sqlalchemy.select(table)
+        )
+        for partition in result.partitions():
+            stream.write(encode_rows(columns, partition, fmt))
+            progress.update(len(partition))
+    return progress.rows
+
+
+def _format(path:str, fmt:str) -> str:
+    if fmt is None:
+        fmt = 'csv' if path.endswith('.csv') else 'jsonl'
+    if fmt == 'json':
+        fmt = 'jsonl'
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format: {fmt}')
+    return fmt
+
+
+def parse_args(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Bulk import / export.')
+    parser.add_argument('config_uri', help='The application ini file')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('table', help='The table name')
+    parser.add_argument('path', help='The file, - for stdin / stdout')
+    parser.add_argument('--format', choices=('csv', 'json', 'jsonl'))
+    parser.add_argument('--batch-size', type=int, default=5000)
+    return parser.parse_args(argv[1:])
+
+
+def main(argv:List[str]=sys.argv) -> int:
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    engine = _get_engine(get_appsettings(args.config_uri))
+    table = sqlalchemy.Table(
+        args.table, sqlalchemy.MetaData(), autoload_with=engine
+    )
+    fmt = _format(args.path, args.format)
+    if args.action == 'import':
+        stream = sys.stdin if args.path == '-' \
+            else open(args.path, newline='', encoding='utf8')
+        with stream:
+            rows = import_rows(
+                engine, table, read_rows(stream, fmt), fmt, args.batch_size
+            )
+    else:
+        stream = sys.stdout if args.path == '-' \
+            else open(args.path, 'w', newline='', encoding='utf8')
+        with stream:
+            rows = export_rows(engine, table, stream, fmt, args.batch_size)
+    log.info('%s %d rows of %s', args.action.capitalize() + 'ed', rows,
+             args.table)
+    return 0
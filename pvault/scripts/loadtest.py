@@ -0,0 +1,349 @@
+"""Load test of the whole stack: waitress, sessions, database.
+
+Usage::
+
+    pvault-loadtest development.ini
+    pvault-loadtest production.ini --clients 64 --duration 60 \\
+        --mix session_read=60,session_write=30,db=10
+
+The application of the configuration file is served by waitress in this
+process (``--threads`` threads, on a random local port) with the load
+tests views of :mod:`pvault.loadtest`. ``--clients`` threads request them
+with keep-alive connections, each with its own session cookie, picking the
+kind of each request with the ``--mix`` weights.
+
+After ``--warmup`` seconds, the requests of ``--duration`` seconds are
+measured. The report gives by kind of request the throughput, the latency
+percentiles, the errors (connection errors and 5xx responses), and from
+:mod:`pvault.metrics` the redis round-trips and database statements per
+request, and the requests retried by pyramid_retry.
+
+The redis and database servers of the configuration file are used,
+``--fakeredis`` replaces redis by an in-memory server and ``--set
+key=value`` overrides a setting.
+
+waitress and fakeredis are installed by the ``loadtest`` extra
+(``pip install pvault[loadtest]``).
+"""
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+import http.client
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+from plaster import get_settings
+from pyramid.interfaces import ISessionFactory
+from pyramid.paster import get_appsettings, setup_logging
+
+from .. import main as make_app
+from .. import metrics
+from ..loadtest import ROUTES
+
+log = logging.getLogger(__name__)
+
+
+def parse_mix(value:str) -> Dict[str, float]:
+    """Parse the ``kind=weight,...`` mix of requests."""
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in ROUTES:
+            raise argparse.ArgumentTypeError(
+                f'unknown request kind {kind!r} ({", ".join(ROUTES)})'
+            )
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(values:List[float], percent:float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class Client(threading.Thread):
+    """Client requesting the mix of requests until ``stop_at``.
+
+    The latencies of the requests sent after ``measure_at`` are recorded.
+    """
+
+    def __init__(self, port:int, mix:Dict[str, float], measure_at:float,
+                 stop_at:float, seed:int) -> None:
+        super().__init__(daemon=True)
+        self.port = port
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.measure_at = measure_at
+        self.stop_at = stop_at
+        self.random = random.Random(seed)
+        self.cookies: Dict[str, str] = {}
+        self.latencies: Dict[str, List[float]] = {kind: [] for kind in mix}
+        self.errors: Dict[str, int] = {kind: 0 for kind in mix}
+        self.connection = None
+
+    def _request(self, path:str) -> int:
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                '127.0.0.1', self.port, timeout=30,
+            )
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(
+                f'{name}={value}' for name, value in self.cookies.items()
+            )
+        try:
+            self.connection.request('GET', path, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return 0
+        for header in response.headers.get_all('Set-Cookie') or ():
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value.strip()
+        return response.status
+
+    def run(self) -> None:
+        # Create the session of the client
+        self._request(ROUTES['session_write'][1])
+        while True:
+            start = time.perf_counter()
+            if start >= self.stop_at:
+                break
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            status = self._request(ROUTES[kind][1])
+            if start < self.measure_at:
+                continue
+            self.latencies[kind].append(time.perf_counter() - start)
+            if status == 0 or status >= 500:
+                self.errors[kind] += 1
+        if self.connection is not None:
+            self.connection.close()
+
+
+def _server_metrics() -> Tuple[Dict[tuple, Tuple[float, int]], Dict]:
+    """Return the sums / counts of the per-request counts histograms and
+    the counters of :mod:`pvault.metrics`."""
+    histograms = {
+        key: (histogram.sum, histogram.count)
+        for key, histogram in metrics._merged().items()
+        if key[0] == 'count'
+    }
+    return histograms, metrics._merged_counters()
+
+
+def _per_request(before:dict, after:dict, route:str, label:str) -> float:
+    total, count = after.get(('count', route, label), (0, 0))
+    previous_total, previous_count = before.get(
+        ('count', route, label), (0, 0)
+    )
+    requests = count - previous_count
+    return (total - previous_total) / requests if requests else 0.0
+
+
+def _serve(server, stopped:threading.Event) -> None:
+    try:
+        server.run()
+    except OSError:
+        # The sockets closed by run()
+        if not stopped.is_set():
+            raise
+
+
+def run(app, options) -> dict:
+    """Serve ``app`` and run the clients, return the results."""
+    from waitress import create_server
+
+    # The requests queue up when there are more clients than threads
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+    server = create_server(
+        app, host='127.0.0.1', port=0, threads=options.threads,
+        connection_limit=max(100, options.clients * 2),
+        backlog=max(1024, options.clients * 2),
+    )
+    stopped = threading.Event()
+    thread = threading.Thread(target=_serve, args=(server, stopped),
+                              daemon=True)
+    thread.start()
+
+    measure_at = time.perf_counter() + options.warmup
+    stop_at = measure_at + options.duration
+    clients = [
+        Client(server.effective_port, options.mix, measure_at, stop_at,
+               options.seed + i)
+        for i in range(options.clients)
+    ]
+    try:
+        for client in clients:
+            client.start()
+        time.sleep(max(measure_at - time.perf_counter(), 0))
+        histograms_before, counters_before = _server_metrics()
+        for client in clients:
+            client.join()
+        histograms_after, counters_after = _server_metrics()
+    finally:
+        # Wait for the running tasks before closing the sockets
+        stopped.set()
+        server.task_dispatcher.shutdown()
+        server.close()
+        thread.join(5)
+
+    results = {'kinds': {}}
+    everything = []
+    for kind in options.mix:
+        route = ROUTES[kind][0]
+        latencies = [
+            latency for client in clients for latency in client.latencies[kind]
+        ]
+        everything.extend(latencies)
+        retries = counters_after.get(('request_retries', route), 0) \
+            - counters_before.get(('request_retries', route), 0)
+        results['kinds'][kind] = {
+            'requests': len(latencies),
+            'throughput': len(latencies) / options.duration,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies, default=0.0) * 1000,
+            'errors': sum(client.errors[kind] for client in clients),
+            'retries': retries,
+            'redis_per_request': _per_request(
+                histograms_before, histograms_after, route, 'redis'
+            ),
+            'db_per_request': _per_request(
+                histograms_before, histograms_after, route, 'db'
+            ),
+        }
+    kinds = results['kinds'].values()
+    results['total'] = {
+        'requests': len(everything),
+        'throughput': len(everything) / options.duration,
+        'p50_ms': percentile(everything, 50) * 1000,
+        'p90_ms': percentile(everything, 90) * 1000,
+        'p99_ms': percentile(everything, 99) * 1000,
+        'max_ms': max(everything, default=0.0) * 1000,
+        'errors': sum(kind['errors'] for kind in kinds),
+        'retries': sum(kind['retries'] for kind in kinds),
+    }
+    results['options'] = {
+        'clients': options.clients,
+        'threads': options.threads,
+        'duration': options.duration,
+        'mix': options.mix,
+        'fakeredis': options.fakeredis,
+    }
+    return results
+
+
+def report(results:dict) -> str:
+    columns = (
+        ('requests', 'requests', 'd'),
+        ('req/s', 'throughput', '.1f'),
+        ('p50 ms', 'p50_ms', '.2f'),
+        ('p90 ms', 'p90_ms', '.2f'),
+        ('p99 ms', 'p99_ms', '.2f'),
+        ('max ms', 'max_ms', '.2f'),
+        ('errors', 'errors', 'd'),
+        ('retries', 'retries', 'd'),
+        ('redis/req', 'redis_per_request', '.2f'),
+        ('db/req', 'db_per_request', '.2f'),
+    )
+    lines = [f'{"kind":<14}' + ''.join(f'{title:>10}' for title, _, _ in columns)]
+    rows = list(results['kinds'].items()) + [('total', results['total'])]
+    for kind, values in rows:
+        lines.append(f'{kind:<14}' + ''.join(
+            f'{values[key]:>10{spec}}' if key in values else f'{"":>10}'
+            for _, key, spec in columns
+        ))
+    return '\n'.join(lines)
+
+
+def _use_fakeredis(app) -> None:
+    import fakeredis
+    from ..ring import HashRing
+    server = fakeredis.FakeServer()
+    factory = app.registry.queryUtility(ISessionFactory)
+    factory.ring = HashRing(
+        {'default': fakeredis.FakeStrictRedis(server=server)}
+    )
+    if 'listing_cache' in app.registry:
+        app.registry['listing_cache'].client = \
+            fakeredis.FakeStrictRedis(server=server)
+
+
+def _server_threads(config_uri:str) -> int:
+    try:
+        server = get_settings(config_uri, 'server:main')
+    except LookupError:
+        return 4
+    return int(server.get('threads', 4))
+
+
+def parse_args(argv:List[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description=__doc__.splitlines()[0],
+    )
+    parser.add_argument('config_uri', help='the configuration file')
+    parser.add_argument('--clients', type=int, default=16,
+                        help='number of concurrent clients')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='waitress threads (default: [server:main])')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=2.0,
+                        help='seconds before the measure')
+    parser.add_argument(
+        '--mix', type=parse_mix,
+        default=parse_mix('session_read=60,session_write=30,db=10'),
+        help='weights of the kinds of requests (%(default)s)',
+    )
+    parser.add_argument('--fakeredis', action='store_true',
+                        help='use an in-memory redis')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE', help='override a setting')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None,
+                        help='store the results in this file')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv:List[str]=sys.argv) -> int:
+    options = parse_args(argv)
+    setup_logging(options.config_uri)
+    if options.threads is None:
+        options.threads = _server_threads(options.config_uri)
+
+    settings = get_appsettings(options.config_uri)
+    for item in options.set:
+        key, _, value = item.partition('=')
+        settings[key.strip()] = value.strip()
+    settings['pyramid.includes'] = \
+        settings.get('pyramid.includes', '') + '\npvault.loadtest'
+    app = make_app(settings.global_conf, **settings)
+    if options.fakeredis:
+        _use_fakeredis(app)
+
+    log.info('%d clients, %d threads, %.0fs', options.clients,
+             options.threads, options.duration)
+    results = run(app, options)
+    print(report(results))
+    if options.json:
+        with open(options.json, 'w', encoding='utf8') as output:
+            json.dump(results, output, indent=2)
+    return 1 if results['total']['requests'] == 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""Generate the registrations manifest of the application.
+
+Usage::
+
+    pvault-manifest
+    pvault-manifest --check
+
+Scan the package and write :mod:`pvault.manifest` (see
+:mod:`pvault.registration`). With ``--check``, only exit with 1 if the
+manifest is not up to date.
+"""
+import os
+import sys
+import logging
+import argparse
+
+from typing import List
+
+import pvault
+from ..registration import collect, model_modules, render_manifest
+
+log = logging.getLogger(__name__)
+
+MANIFEST = os.path.join(os.path.dirname(pvault.__file__), 'manifest.py')
+
+
+def generate() -> str:
+    """Return the source of the manifest of the package."""
+    registrations = collect(pvault)
+    return render_manifest(registrations, model_modules(pvault))
+
+
+def parse_args(argv:List[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description=__doc__.splitlines()[0],
+    )
+    parser.add_argument('--check', action='store_true',
+                        help='check that the manifest is up to date')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv:List[str]=sys.argv) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    source = generate()
+    try:
+        with open(MANIFEST, encoding='utf8') as manifest:
+            current = manifest.read()
+    except FileNotFoundError:
+        current = None
+    if args.check:
+        if source != current:
+            log.error('%s is not up to date, run pvault-manifest', MANIFEST)
+            return 1
+        return 0
+    if source != current:
+        with open(MANIFEST, 'w', encoding='utf8') as manifest:
+            manifest.write(source)
+        log.info('Wrote %s', MANIFEST)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
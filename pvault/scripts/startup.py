@@ -0,0 +1,178 @@
+"""Report where the startup of the application spends its time.
+
+Usage::
+
+    pvault-startup-profile production.ini
+    pvault-startup-profile production.ini --top 30
+
+The application is created in a child process run with
+``python -X importtime``. The report gives:
+
+- the import time of the modules, by top-level package (by module for
+  pvault),
+- the time of each ``config.include`` (cumulative: an include contains
+  the includes it does) and of the ``config.commit`` (the actions: views,
+  routes, renderers...).
+
+Compare ``pvault.registration = scan`` and ``manifest`` (see
+:mod:`pvault.registration`) with ``pvault-startup-profile`` on two
+configuration files.
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+import collections
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+
+def _parse_line(line:str):
+    fields = line[len('import time:'):].split('|')
+    if len(fields) != 3 or not fields[0].strip().isdigit():
+        # The header
+        return None
+    return int(fields[0]), fields[2].strip()
+
+
+def import_times(output:str) -> Dict[str, float]:
+    """Return the self import time in seconds by package of a
+    ``-X importtime`` output (by module for the pvault modules)."""
+    times = collections.Counter()
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parsed = _parse_line(line)
+        if parsed is None:
+            continue
+        self_us, name = parsed
+        if not name.startswith('pvault.'):
+            name = name.split('.')[0]
+        times[name] += self_us / 1e6
+    return times
+
+
+def profile_config(config_uri:str) -> dict:
+    """Create the application and return the time of the includes, of the
+    commit and of the whole :func:`pvault.main`."""
+    from pyramid.config import Configurator
+    from pyramid.paster import get_app
+
+    includes: List[Tuple[str, float, int]] = []
+    depth = [0]
+    include = Configurator.include
+    commit = Configurator.commit
+
+    def timed_include(self, callable, route_prefix=None):
+        name = callable if isinstance(callable, str) else \
+            getattr(callable, '__module__', repr(callable))
+        if name.startswith('.'):
+            name = self.package_name + name
+        position = len(includes)
+        includes.append((name, 0.0, depth[0]))
+        depth[0] += 1
+        start = time.perf_counter()
+        try:
+            return include(self, callable, route_prefix)
+        finally:
+            depth[0] -= 1
+            includes[position] = (
+                name, time.perf_counter() - start, depth[0]
+            )
+
+    commits = []
+
+    def timed_commit(self):
+        start = time.perf_counter()
+        try:
+            return commit(self)
+        finally:
+            commits.append(time.perf_counter() - start)
+
+    Configurator.include = timed_include
+    Configurator.commit = timed_commit
+    try:
+        start = time.perf_counter()
+        get_app(config_uri)
+        total = time.perf_counter() - start
+    finally:
+        Configurator.include = include
+        Configurator.commit = commit
+    return {
+        'includes': includes,
+        'commit': sum(commits),
+        'total': total,
+    }
+
+
+def run_child(config_uri:str) -> Tuple[dict, Dict[str, float]]:
+    """Profile the startup in a ``python -X importtime`` child process."""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'pvault.scripts.startup',
+         '--child', config_uri],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        check=False,
+    )
+    if process.returncode:
+        sys.stderr.writelines(
+            line for line in process.stderr.splitlines(keepends=True)
+            if not line.startswith('import time:')
+        )
+        raise RuntimeError(f'The startup failed ({process.returncode})')
+    return json.loads(process.stdout), import_times(process.stderr)
+
+
+def report(config:dict, imports:Dict[str, float], top:int) -> str:
+    lines = [f'{"imports (self time)":<50} {"ms":>8}']
+    for name, seconds in imports.most_common(top):
+        lines.append(f'  {name:<48} {seconds * 1000:>8.1f}')
+    lines.append(f'  {"total":<48} {sum(imports.values()) * 1000:>8.1f}')
+    lines.append('')
+    lines.append(f'{"configuration":<50} {"ms":>8}')
+    for name, seconds, depth in config['includes']:
+        label = '  ' * depth + name
+        lines.append(f'  {label:<48} {seconds * 1000:>8.1f}')
+    lines.append(f'  {"commit":<48} {config["commit"] * 1000:>8.1f}')
+    lines.append('')
+    lines.append(f'{"startup":<50} {config["total"] * 1000:>8.1f}')
+    return '\n'.join(lines)
+
+
+def parse_args(argv:List[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description=__doc__.splitlines()[0],
+    )
+    parser.add_argument('config_uri', help='the configuration file')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of packages of the imports report')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv[1:])
+
+
+def main(argv:List[str]=sys.argv) -> int:
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(profile_config(args.config_uri)))
+        return 0
+    try:
+        config, imports = run_child(args.config_uri)
+    except RuntimeError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps({'config': config, 'imports': imports}, indent=2))
+    else:
+        print(report(config, imports, args.top))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""Precompile the templates in the Jinja2 bytecode cache.
+
+Usage::
+
+    pvault-templates production.ini
+
+Run it at build / deploy time, with the bytecode cache settings of the
+application (``jinja2.bytecode_caching_directory`` or
+``pvault.templates.bytecode_cache.redis_url``, see
+:mod:`pvault.templating`), so that the new workers never compile the
+templates.
+"""
+import sys
+import time
+import logging
+import argparse
+
+from typing import List
+
+from pyramid.config import Configurator
+from pyramid.paster import get_appsettings, setup_logging
+
+from ..templating import get_environment, precompile, template_names
+
+log = logging.getLogger(__name__)
+
+
+def parse_args(argv:List[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description=__doc__.splitlines()[0],
+    )
+    parser.add_argument('config_uri', help='the configuration file')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv:List[str]=sys.argv) -> int:
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    # The renderers environment, without the rest of the application
+    config = Configurator(settings=settings, package='pvault')
+    config.include('pvault.templating')
+    config.include('pyramid_jinja2')
+    config.commit()
+    env = get_environment(config.registry)
+    if env.bytecode_cache is None:
+        log.error('No bytecode cache configured in %s', args.config_uri)
+        return 1
+    start = time.perf_counter()
+    names = precompile(env, template_names())
+    log.info('Compiled %d templates in %.2fs: %s', len(names),
+             time.perf_counter() - start, ', '.join(names))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""Security policy of the application.
+
+The user id is stored in the session (``session['user_id']``) by
+:meth:`PVaultSecurityPolicy.remember`, such sessions are always stored in
+redis (see ``PVaultSessionFactory.redis_only_keys``) so that they can be
+revoked.
+
+Every permission is denied by default, :data:`PERMISSIONS` lists the
+permissions granted and to whom. The views without permission stay public.
+
+The ``metrics`` permission is granted to the clients whose address is in
+the ``pvault.metrics.allowed_ips`` setting (addresses or networks, the
+local host by default). Behind a reverse proxy the address is the one of
+the proxy: deny ``/metrics`` there, or serve it on an internal listener.
+"""
+import ipaddress
+
+from typing import (
+    Callable,
+    Dict,
+    Optional,
+)
+
+from pyramid.request import Request
+from pyramid.security import Allowed, Denied
+from pyramid.settings import aslist
+
+SESSION_KEY = 'user_id'
+
+
+def _authenticated(request:Request) -> bool:
+    return request.authenticated_userid is not None
+
+
+def _metrics_client(request:Request) -> bool:
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        return False
+    return any(
+        address in network
+        for network in request.registry['metrics_allowed_networks']
+    )
+
+
+# permission -> predicate of the requests allowed
+PERMISSIONS: Dict[str, Callable[[Request], bool]] = {
+    'export': _authenticated,
+    'metrics': _metrics_client,
+}
+
+
+class PVaultSecurityPolicy(object):
+    """Session based security policy, denying the unknown permissions."""
+
+    def identity(self, request:Request) -> Optional[str]:
+        return request.session.get(SESSION_KEY)
+
+    def authenticated_userid(self, request:Request) -> Optional[str]:
+        return self.identity(request)
+
+    def permits(self, request:Request, context, permission:str):
+        predicate = PERMISSIONS.get(permission)
+        if predicate is not None and predicate(request):
+            return Allowed(f'{permission!r} granted')
+        return Denied(f'{permission!r} denied')
+
+    def remember(self, request:Request, userid:str, **kw) -> list:
+        request.session[SESSION_KEY] = userid
+        return []
+
+    def forget(self, request:Request, **kw) -> list:
+        request.session.pop(SESSION_KEY, None)
+        return []
+
+
+def includeme(config):
+    """Set the security policy.
+
+    Activate this setup using ``config.include('pvault.security')``.
+    """
+    config.set_security_policy(PVaultSecurityPolicy())
+    config.registry['metrics_allowed_networks'] = [
+        ipaddress.ip_network(value, strict=False)
+        for value in aslist(config.get_settings().get(
+            'pvault.metrics.allowed_ips', '127.0.0.1 ::1'
+        ))
+    ]
@@ -10,38 +10,78 @@ Differences are noted:
  - there is currently no equivalent to their InvalidSession
 """
 import os
+import hmac
+import copy
 import time
 import base64
+import hashlib
+import binascii
 import functools
+import threading
+import collections
 
 from typing import (
+    Dict,
+    List,
     Optional,
     Callable,
+    Tuple,
 )
 
 import redis
-import msgpack
 from itsdangerous import TimestampSigner, BadSignature
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from pyramid.request import Request
 from pyramid.response import Response
-from pyramid.interfaces import ISession, ISessionFactory
+from pyramid.interfaces import (
+    ISession,
+    ISessionFactory,
+    ICSRFStoragePolicy,
+)
 
 from zope.interface import implementer
 
+from .ring import HashRing
+from .codec import SessionCodec
+from . import metrics
+
 
 def _create_token() -> str:
     """Create a new base 64 token."""
     token = base64.urlsafe_b64encode(os.urandom(32).rstrip(b'='))
     return token.decode('utf-8')
 
-def _changed_method(method: Callable) -> Callable:
+def _to_int(value) -> Optional[int]:
+    """Convert a redis reply to int, None stays None."""
+    if value is None:
+        return None
+    return int(value)
+
+def _changed_method(method: Callable, track:Optional[Callable]=None) -> Callable:
+    """Wrap a dict method so that it mark the session as changed.
+
+    :param method: the dict method to wrap
+    :param track: called with the same arguments as the method to record
+        the modified keys. If not given the whole session must be rewritten.
+    """
     @functools.wraps(method)
     def wrapped(self, *args, **kwargs):
-        self.changed()
+        if track is None:
+            self.changed()
+        else:
+            track(self, *args, **kwargs)
         return method(self, *args, **kwargs)
     return wrapped
 
+def _track_set(session, key, *args, **kwargs) -> None:
+    session._record_set(key)
+
+def _track_delete(session, key, *args, **kwargs) -> None:
+    if key in session:
+        session._record_delete(key)
+
 
 @implementer(ISession)
 class PVaultSession(dict):
@@ -61,14 +101,12 @@ class PVaultSession(dict):
     _flash_key = "_flash_messages"
 
     # A number of our methods need to be decorated so that they also call
-    # self.changed()
-    __delitem__ = _changed_method(dict.__delitem__)
-    __setitem__ = _changed_method(dict.__setitem__)
+    # self.changed() or record the keys they modify.
+    __delitem__ = _changed_method(dict.__delitem__, _track_delete)
+    __setitem__ = _changed_method(dict.__setitem__, _track_set)
     clear = _changed_method(dict.clear)
-    pop = _changed_method(dict.pop)
-    popitem = _changed_method(dict.popitem)
-    setdefault = _changed_method(dict.setdefault)
-    update = _changed_method(dict.update)
+    pop = _changed_method(dict.pop, _track_delete)
+    setdefault = _changed_method(dict.setdefault, _track_set)
 
     def __init__(self, data:dict={}, session_id:Optional[str]=None, new:bool=True) -> None:
         """Contructor of the class.
@@ -86,8 +124,27 @@ class PVaultSession(dict):
         super(PVaultSession, self).__init__(data)
         self._sid = session_id
         self._changed = False
+        self._rewrite = False
+        self._set_keys = set()
+        self._deleted_keys = set()
         self.new = new
         self.created = int(time.time())
+        # Timestamp of the last time the session cookie was issued
+        self.renewed = None
+        # True if the session data is stored in the cookie itself
+        self.in_cookie = False
+        # Object storing the flash queues outside of the session data (see
+        # PVaultSessionFactory.pop_flash), if None they are stored in the
+        # session.
+        self.flash_storage = None
+        # The (queue_key, msg, allow_duplicate) flash messages to push to
+        # the flash_storage when the session is saved
+        self.flash_pushes = []
+        # Object deriving the CSRF tokens from the session id (see
+        # PVaultSessionFactory.new_csrf_token), if None the token is stored
+        # in the session.
+        self.csrf_storage = None
+        self._csrf_token = None
 
         # We'll track all of the IDs that have been invalidated here
         self.invalidated = set()
@@ -109,6 +166,8 @@ class PVaultSession(dict):
         self.new = True
         self.created = int(time.time())
         self._changed = False
+        self._csrf_token = None
+        del self.flash_pushes[:]
 
         # If the current session id isn't None we'll want to record it as one
         # of the ones that have been invalidated.
@@ -128,8 +187,96 @@ class PVaultSession(dict):
         return self._changed
 
     def changed(self) -> None:
-        """Set the status changed to True."""
+        """Set the status changed to True.
+
+        As we do not know what has been modified, the whole session will be
+        rewritten.
+        """
+        self._changed = True
+        self._rewrite = True
+
+    def _record_set(self, key) -> None:
+        self._changed = True
+        self._set_keys.add(key)
+        self._deleted_keys.discard(key)
+
+    def _record_delete(self, key) -> None:
         self._changed = True
+        self._deleted_keys.add(key)
+        self._set_keys.discard(key)
+
+    def popitem(self) -> tuple:
+        key, value = super(PVaultSession, self).popitem()
+        self._record_delete(key)
+        return key, value
+
+    def update(self, *args, **kwargs) -> None:
+        data = dict(*args, **kwargs)
+        for key in data:
+            self._record_set(key)
+        super(PVaultSession, self).update(data)
+
+    def delta(self) -> Optional[Tuple[set, set]]:
+        """Return the keys set and deleted since the session was loaded.
+
+        :return: a ``(set_keys, deleted_keys)`` tuple or None if the whole
+            session must be rewritten.
+        :rtype: tuple
+        """
+        if self.new or self._rewrite:
+            return None
+        return set(self._set_keys), set(self._deleted_keys)
+
+    def new_csrf_token(self) -> str:
+        """Create a new CSRF token and return it.
+
+        If the session has a ``csrf_storage`` the token is derived from the
+        session id and the session data is not modified.
+
+        :return: the new token
+        :rtype: str
+        """
+        if self.csrf_storage is None:
+            token = _create_token()
+            self[self._csrf_token_key] = token
+            return token
+
+        # A new session must be saved so that the client get the session id
+        # the token is derived from.
+        if self.new:
+            self.changed()
+        self._csrf_token = self.csrf_storage.new_csrf_token(self.sid)
+        return self._csrf_token
+
+    def get_csrf_token(self) -> str:
+        """Return the CSRF token, a new one is created if needed.
+
+        :return: the token
+        :rtype: str
+        """
+        if self.csrf_storage is None:
+            token = self.get(self._csrf_token_key)
+        else:
+            token = self._csrf_token
+        if token is None:
+            token = self.new_csrf_token()
+        return token
+
+    def check_csrf_token(self, token: str) -> bool:
+        """Return true if the token is a valid CSRF token for the session.
+
+        :param token: the token supplied by the client
+        :type token: str
+        :rtype: bool
+        """
+        if self.csrf_storage is None:
+            expected = self.get(self._csrf_token_key)
+            return expected is not None and hmac.compare_digest(
+                expected.encode('utf8'), token.encode('utf8')
+            )
+        if self._sid is None:
+            return False
+        return self.csrf_storage.check_csrf_token(self._sid, token)
 
     def _get_flash_queue_key(self, queue: str) -> str:
         # TODO: Verify the type of queue
@@ -143,6 +290,11 @@ class PVaultSession(dict):
     def flash(self, msg, queue:str='', allow_duplicate:bool=True) -> None:
         """Function to add a message to the flash queue.
 
+        If the session has a ``flash_storage`` the message is pushed there
+        when the session is saved, with the other redis commands of the
+        response, and the session data is not modified. A message pushed
+        without duplicate is then moved to the end of the queue if present.
+
         :param msg: The message to add to the queue
         :type msg: str
         :param queue: The queue to use, default queue is used if not
@@ -154,9 +306,21 @@ class PVaultSession(dict):
         """
         queue_key = self._get_flash_queue_key(queue)
 
+        if self.flash_storage is not None:
+            # A new session must be saved so that the client get the session
+            # id owning the queue.
+            if self.new:
+                self.changed()
+            if not allow_duplicate and any(
+                    pushed[:2] == (queue_key, msg)
+                    for pushed in self.flash_pushes):
+                return
+            self.flash_pushes.append((queue_key, msg, allow_duplicate))
+            return
+
         # If we're not allowing duplicates check if this message is already
         # in the queue, and if it is just return immediately.
-        if not allow_duplicate and msg in self[queue_key]:
+        if not allow_duplicate and msg in self.get(queue_key, []):
             return
 
         self.setdefault(queue_key, []).append(msg)
@@ -172,6 +336,16 @@ class PVaultSession(dict):
         :rtype: list
         """
         queue_key = self._get_flash_queue_key(queue)
+        if self.flash_storage is not None:
+            messages = []
+            if self._sid is not None:
+                messages = self.flash_storage.pop_flash(self._sid, queue_key)
+            messages.extend(self._pending_flash(queue_key))
+            self.flash_pushes[:] = [
+                pushed for pushed in self.flash_pushes
+                if pushed[0] != queue_key
+            ]
+            return messages
         messages = self.pop(queue_key, [])
         return messages
 
@@ -186,107 +360,785 @@ class PVaultSession(dict):
         :rtype: list
         """
         queue_key = self._get_flash_queue_key(queue)
+        if self.flash_storage is not None:
+            messages = []
+            if self._sid is not None:
+                messages = self.flash_storage.peek_flash(self._sid, queue_key)
+            return messages + self._pending_flash(queue_key)
         messages = self.get(queue_key, [])
         return messages
 
+    def _pending_flash(self, queue_key:str) -> list:
+        """Return the messages of a queue not pushed yet."""
+        return [
+            msg for pushed_key, msg, _ in self.flash_pushes
+            if pushed_key == queue_key
+        ]
+
+@implementer(ICSRFStoragePolicy)
+class PVaultCSRFStoragePolicy(object):
+    """CSRF storage policy delegating to the :class:`PVaultSession`.
+
+    Pyramid default policy compare the supplied token with the stored one,
+    this policy let the session check the (stateless) token.
+    """
+
+    def new_csrf_token(self, request:Request) -> str:
+        return request.session.new_csrf_token()
+
+    def get_csrf_token(self, request:Request) -> str:
+        return request.session.get_csrf_token()
+
+    def check_csrf_token(self, request:Request, supplied_token:str) -> bool:
+        return request.session.check_csrf_token(supplied_token)
+
+
+class SessionCache(object):
+    """Per-worker LRU cache of decoded sessions.
+
+    Entries are keyed by session id and hold the decoded session data along
+    with the generation stamp that was stored in redis next to the blob. An
+    entry is only served if the stamp still match the one in redis, so a
+    session written by another worker is never served stale.
+
+    Entries older than ``ttl`` seconds are dropped and the least recently
+    used entry is evicted when ``maxsize`` is reached.
+    """
+
+    def __init__(self, maxsize:int=1024, ttl:int=60) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, session_id:str) -> bool:
+        return session_id in self._data
+
+    def get(self, session_id:str) -> Optional[Tuple[int, dict]]:
+        """Return the ``(generation, data)`` tuple for the session id.
+
+        :param session_id: the session id
+        :type session_id: str
+        :return: the cached entry or None if absent / expired
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return None
+            expires, generation, data = entry
+            if expires < time.monotonic():
+                del self._data[session_id]
+                return None
+            self._data.move_to_end(session_id)
+            return generation, data
+
+    def set(self, session_id:str, generation:int, data:dict) -> None:
+        """Store the decoded data of a session.
+
+        :param session_id: the session id
+        :type session_id: str
+        :param generation: the generation stamp stored in redis
+        :type generation: int
+        :param data: the decoded session data
+        :type data: dict
+        """
+        with self._lock:
+            self._data[session_id] = (
+                time.monotonic() + self.ttl, generation, data
+            )
+            self._data.move_to_end(session_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def evict(self, session_id:str) -> None:
+        """Remove the session from the cache."""
+        with self._lock:
+            self._data.pop(session_id, None)
+
+    def clear(self) -> None:
+        """Remove every entries from the cache."""
+        with self._lock:
+            self._data.clear()
+
+    def after_fork(self) -> None:
+        """Replace the lock, it may be held by a thread of the parent."""
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        """Return the cache counters."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+        }
+
+
 @implementer(ISessionFactory)
 class PVaultSessionFactory(object):
-    """PVaultSession factory."""
+    """PVaultSession factory.
+
+    If ``cache_size`` is greater than 0, decoded sessions are kept in a per
+    worker :class:`SessionCache`. On a cache hit only the generation stamp is
+    read from redis instead of the whole blob.
+
+    Two storage modes are available:
+
+    - **blob** : the whole session is stored as one blob and
+      rewritten each time the session change.
+    - **hash** : each key of the session is stored as a field of a redis
+      hash, only the keys set / deleted during the request are written.
+      Session keys must be strings in this mode.
+
+    If ``touch_interval`` is greater than 0, the expiry of an unchanged
+    session is reset (sliding expiry) at most once every ``touch_interval``
+    seconds.
+
+    If ``cookie_max_size`` is greater than 0, sessions whose encoded data is
+    smaller than ``cookie_max_size`` bytes are stored encrypted in the
+    cookie itself and never touch redis. Bigger sessions spill over to
+    redis. The signed cookie value is prefixed by a marker telling where the
+    session lives:
+
+    - ``c:<encrypted data>`` : the session is in the cookie
+    - ``r:<session id>`` : the session is in redis
+
+    A session stored in the cookie can't be revoked: a copy of the cookie
+    stays valid until it expires. The sessions holding one of the
+    ``redis_only_keys`` (the authenticated user, see :mod:`pvault.security`)
+    are always stored in redis, so that invalidating them on the server
+    (logout) is effective.
+
+    Sessions can be spread over several redis nodes given as a list of urls
+    in ``redis_nodes``. Each session id is routed to a node with consistent
+    hashing (see :class:`pvault.ring.HashRing`). ``redis_options`` are given
+    to the connection pool of each node (``max_connections``,
+    ``socket_timeout``, ``socket_connect_timeout``...).
+
+    Session data are encoded with ``codec`` (see :mod:`pvault.codec`).
+
+    CSRF tokens are stateless: a random nonce followed by the HMAC of the
+    nonce and the session id. Tokens are created with the first secret of
+    ``csrf_secrets`` and checked against all of them, so a secret can be
+    rotated by adding the new one in first position.
+    """
+
+    # The redis module used to create the clients, redis.asyncio for
+    # asyncio factories.
+    redis_module = redis
+
+    cookie_marker = b'c:'
+    redis_marker = b'r:'
 
     cookie_name = 'session_id'
     max_age = 12 * 60 * 60  # 12 hours
+    # Keys of the sessions never stored in the cookie (revocable sessions)
+    redis_only_keys = ('user_id',)
+    storages = ('blob', 'hash')
 
-    def __init__(self, secret:str, redis_host:str, redis_port:str) -> None:
-        self.redis = redis.StrictRedis(host=redis_host, port=redis_port)
+    def __init__(self, secret:str, redis_host:str, redis_port:str,
+                 cache_size:int=0, cache_ttl:int=60,
+                 storage:str='blob', touch_interval:int=0,
+                 cookie_max_size:int=0,
+                 redis_nodes:Optional[List[str]]=None,
+                 redis_options:Optional[Dict]=None,
+                 codec:Optional[SessionCodec]=None,
+                 csrf_secrets:Optional[List[str]]=None) -> None:
+        if storage not in self.storages:
+            raise ValueError(f'Unknown session storage: {storage}')
+        self.storage = storage
+        self.touch_interval = touch_interval
+        self.codec = codec or SessionCodec()
+        self.ring = self._make_ring(
+            redis_host, redis_port, redis_nodes, redis_options or {}
+        )
         self.signer = TimestampSigner(secret, salt='session')
+        self.cookie_max_size = cookie_max_size
+        self.aead = AESGCM(hmac.new(
+            secret.encode('utf8'), b'pvault/session/cookie', hashlib.sha256
+        ).digest())
+        self.cache = None
+        if cache_size > 0:
+            self.cache = SessionCache(cache_size, cache_ttl)
+        self.csrf_keys = [
+            hmac.new(
+                csrf_secret.encode('utf8'), b'pvault/session/csrf',
+                hashlib.sha256
+            ).digest()
+            for csrf_secret in (csrf_secrets or [secret])
+        ]
+        self.invalidate_callbacks = []
+
+    def _make_ring(self, redis_host:str, redis_port:str,
+                   redis_nodes:Optional[List[str]],
+                   redis_options:Dict) -> HashRing:
+        """Create the ring of the redis clients."""
+        if redis_nodes:
+            return HashRing({
+                url: self.redis_module.StrictRedis(
+                    connection_pool=self.redis_module.ConnectionPool.from_url(
+                        url, **redis_options
+                    )
+                )
+                for url in redis_nodes
+            })
+        return HashRing({
+            f'{redis_host}:{redis_port}': self.redis_module.StrictRedis(
+                host=redis_host, port=redis_port, **redis_options
+            )
+        })
+
+    def add_invalidate_callback(self, callback) -> None:
+        """Call ``callback(session_id)`` when a session is invalidated.
+
+        The callbacks are called when the response of the request that
+        invalidated the session is processed.
+        """
+        self.invalidate_callbacks.append(callback)
+
+    def reset_pools(self) -> None:
+        """Drop the redis connections, to call in a forked worker.
+
+        The connections inherited from the parent process are discarded
+        without being closed (the parent still use them), the worker open
+        its own connections on the first request.
+        """
+        for client in self.ring.nodes.values():
+            client.connection_pool.reset()
+        if self.cache is not None:
+            self.cache.after_fork()
 
     def __call__(self, request:Request) -> PVaultSession:
-        return self._process_request(request)
+        start = time.perf_counter()
+        session = self._process_request(request)
+        session.flash_storage = self
+        session.csrf_storage = self
+        metrics.add('session', time.perf_counter() - start)
+        return session
 
     def _redis_key(self, session_id: str) -> str:
         return f'pvault/session/data/{session_id}'
 
-    def _process_request(self, request:Request) -> PVaultSession:
-        # Register a callback with the request so we can save the session once
-        # it's finished.
-        request.add_response_callback(self._process_response)
+    def _redis_hash_key(self, session_id: str) -> str:
+        return f'pvault/session/hash/{session_id}'
 
-        # Load our session ID from the request.
-        session_id = request.cookies.get(self.cookie_name)
+    def _redis_generation_key(self, session_id: str) -> str:
+        return f'pvault/session/generation/{session_id}'
+
+    def _redis_flash_key(self, session_id: str, queue_key: str) -> str:
+        return f'pvault/session/flash/{session_id}/{queue_key}'
+
+    def _queue_flash(self, session:PVaultSession, pipe) -> None:
+        """Queue the commands pushing the flash messages of the request.
+
+        Each queue is a redis list, which expires ``max_age`` seconds after
+        the last push. The lists are not deleted with the session: an
+        invalidated session gets a new id, its queues can't be read again.
+
+        :param session: the session
+        :type session: PVaultSession
+        :param pipe: the redis pipeline where commands are queued
+        """
+        keys = set()
+        for queue_key, msg, allow_duplicate in session.flash_pushes:
+            key = self._redis_flash_key(session.sid, queue_key)
+            value = self.codec.dumps(msg)
+            if not allow_duplicate:
+                # Atomic in the MULTI: the message ends up once in the queue
+                pipe.lrem(key, 0, value)
+            pipe.rpush(key, value)
+            keys.add(key)
+        for key in keys:
+            pipe.expire(key, self.max_age)
+        del session.flash_pushes[:]
+
+    def _decode_flash(self, values:list) -> list:
+        """Decode the items of a flash list, skipping the invalid ones."""
+        messages = []
+        for value in values:
+            try:
+                messages.append(self.codec.loads(value))
+            except (ValueError, TypeError):
+                continue
+        return messages
 
+    def pop_flash(self, session_id:str, queue_key:str) -> list:
+        """Return and remove the messages of a queue.
+
+        The list of the queue is read and deleted atomically (MULTI).
+
+        :param session_id: the session id
+        :type session_id: str
+        :param queue_key: the key of the queue
+        :type queue_key: str
+        """
+        key = self._redis_flash_key(session_id, queue_key)
+        pipe = self.ring.get(session_id).pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        metrics.count('redis')
+        values, _ = pipe.execute()
+        return self._decode_flash(values)
+
+    def peek_flash(self, session_id:str, queue_key:str) -> list:
+        """Return the messages of a queue without removing them.
+
+        :param session_id: the session id
+        :type session_id: str
+        :param queue_key: the key of the queue
+        :type queue_key: str
+        """
+        key = self._redis_flash_key(session_id, queue_key)
+        metrics.count('redis')
+        return self._decode_flash(self.ring.get(session_id).lrange(key, 0, -1))
+
+    def new_csrf_token(self, session_id:str) -> str:
+        """Create a CSRF token for the session.
+
+        :param session_id: the session id
+        :type session_id: str
+        :return: the token
+        :rtype: str
+        """
+        nonce = os.urandom(16)
+        digest = hmac.new(
+            self.csrf_keys[0], nonce + session_id.encode('utf8'),
+            hashlib.sha256
+        ).digest()
+        return base64.urlsafe_b64encode(nonce + digest).decode('utf8')
+
+    def check_csrf_token(self, session_id:str, token:str) -> bool:
+        """Return true if the token was created for the session.
+
+        The digests are compared in constant time.
+
+        :param session_id: the session id
+        :type session_id: str
+        :param token: the token supplied by the client
+        :type token: str
+        :rtype: bool
+        """
+        try:
+            token = base64.urlsafe_b64decode(token.encode('utf8'))
+        except (binascii.Error, ValueError):
+            return False
+        if len(token) != 48:
+            return False
+        nonce, digest = token[:16], token[16:]
+        valid = False
+        for key in self.csrf_keys:
+            expected = hmac.new(
+                key, nonce + session_id.encode('utf8'), hashlib.sha256
+            ).digest()
+            valid |= hmac.compare_digest(expected, digest)
+        return valid
+
+    def _encrypt(self, payload: bytes) -> bytes:
+        """Encrypt and authenticate the payload stored in the cookie."""
+        nonce = os.urandom(12)
+        token = nonce + self.aead.encrypt(nonce, payload, self.cookie_marker)
+        return base64.urlsafe_b64encode(token).rstrip(b'=')
+
+    def _decrypt(self, token: bytes) -> bytes:
+        """Decrypt a payload stored in the cookie.
+
+        :raise ValueError: if the token is invalid
+        """
+        try:
+            token = base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4))
+            return self.aead.decrypt(token[:12], token[12:], self.cookie_marker)
+        except (InvalidTag, binascii.Error) as exc:
+            raise ValueError('Invalid session cookie') from exc
+
+    def _cookie_payload(self, session: PVaultSession) -> Optional[bytes]:
+        """Return the encoded session if it fit in the cookie, else None."""
+        if not self.cookie_max_size:
+            return None
+        if any(key in session for key in self.redis_only_keys):
+            return None
+        payload = self.codec.dumps([session.sid, dict(session)])
+        if len(payload) > self.cookie_max_size:
+            return None
+        return payload
+
+    def _queue_fetch(self, session_id:str, pipe) -> None:
+        """Queue the commands fetching the session data and its generation.
+
+        :param session_id: the session id
+        :type session_id: str
+        :param pipe: the redis pipeline where commands are queued
+        """
+        if self.storage == 'hash':
+            pipe.hgetall(self._redis_hash_key(session_id))
+        else:
+            pipe.get(self._redis_key(session_id))
+        pipe.get(self._redis_generation_key(session_id))
+
+    def _decode(self, reply) -> Optional[dict]:
+        """Decode the session data fetched from redis.
+
+        :param reply: the blob or the hash fields of the session
+        :return: the session data or None if missing or invalid
+        :rtype: dict
+        """
+        if not reply:
+            return None
+        try:
+            if self.storage == 'hash':
+                return {
+                    field.decode('utf8'): self.codec.loads(value)
+                    for field, value in reply.items()
+                }
+            return self.codec.loads(reply)
+        except ValueError:
+            return None
+
+    def _fetch(self, session_id: str) -> Tuple[Optional[dict], Optional[int]]:
+        """Fetch the session data and its generation from redis.
+
+        Both are fetched in one round-trip, in a MULTI transaction: a save
+        landing between the two reads would cache the old data with the new
+        generation.
+
+        :param session_id: the session id
+        :type session_id: str
+        :return: the ``(data, generation)`` tuple, data is None if the
+            session is missing or invalid.
+        :rtype: tuple
+        """
+        pipe = self.ring.get(session_id).pipeline(transaction=True)
+        self._queue_fetch(session_id, pipe)
+        metrics.count('redis')
+        reply, generation = pipe.execute()
+        data = self._decode(reply)
+        if data is None:
+            return None, None
+        return data, _to_int(generation)
+
+    def _save(self, session:PVaultSession, pipe) -> int:
+        """Queue the commands to save the session and bump its generation.
+
+        :param session: the session to save
+        :type session: PVaultSession
+        :param pipe: the redis pipeline where commands are queued
+        :return: the index of the new generation in the pipeline results
+        :rtype: int
+        """
+        session_id = session.sid
+        generation_key = self._redis_generation_key(session_id)
+        if self.storage == 'hash':
+            key = self._redis_hash_key(session_id)
+            delta = session.delta()
+            if delta is None:
+                pipe.delete(key)
+                set_keys, deleted_keys = set(session), set()
+            else:
+                set_keys, deleted_keys = delta
+            if set_keys:
+                pipe.hset(key, mapping={
+                    k: self.codec.dumps(session[k]) for k in set_keys
+                })
+            if deleted_keys:
+                pipe.hdel(key, *deleted_keys)
+            pipe.expire(key, self.max_age)
+        else:
+            pipe.setex(
+                self._redis_key(session_id),
+                self.max_age,
+                self.codec.dumps(session),
+            )
+        pipe.incr(generation_key)
+        pipe.expire(generation_key, self.max_age)
+        return len(pipe) - 2
+
+    def _pipeline(self, session_id:str, pipes:dict):
+        """Return the pipeline of the node owning the session.
+
+        :param session_id: the session id
+        :type session_id: str
+        :param pipes: the pipelines of the response by node name
+        :type pipes: dict
+        """
+        name = self.ring.get_name(session_id)
+        if name not in pipes:
+            pipes[name] = self.ring[name].pipeline()
+        return pipes[name]
+
+    def _delete(self, session_ids, pipes:dict) -> None:
+        """Queue the commands to delete sessions from redis and the cache.
+
+        :param session_ids: the ids of the sessions to delete
+        :param pipes: the pipelines of the response by node name
+        :type pipes: dict
+        """
+        for session_id in session_ids:
+            self._pipeline(session_id, pipes).delete(
+                self._redis_key(session_id),
+                self._redis_hash_key(session_id),
+                self._redis_generation_key(session_id),
+            )
+        if self.cache is not None:
+            for session_id in session_ids:
+                self.cache.evict(session_id)
+
+    def _touch(self, session:PVaultSession, pipe) -> None:
+        """Queue the commands to reset the expiry of an unchanged session.
+
+        :param session: the session to touch
+        :type session: PVaultSession
+        :param pipe: the redis pipeline where commands are queued
+        """
+        if self.storage == 'hash':
+            pipe.expire(self._redis_hash_key(session.sid), self.max_age)
+        else:
+            pipe.expire(self._redis_key(session.sid), self.max_age)
+        pipe.expire(self._redis_generation_key(session.sid), self.max_age)
+
+    def _should_touch(self, session:PVaultSession) -> bool:
+        """Return true if the expiry of an unchanged session must be reset.
+
+        The cookie is reissued on each touch, so the timestamp of the signed
+        cookie tell us when the session was last touched.
+        """
+        if not self.touch_interval or session.new or session.renewed is None:
+            return False
+        return time.time() - session.renewed >= self.touch_interval
+
+    def _cache_get(self, session_id:str, generation) -> Optional[dict]:
+        """Return a copy of the cached data if it match the generation.
+
+        :param session_id: the session id
+        :type session_id: str
+        :param generation: the generation stored in redis
+        :return: the session data or None on cache miss
+        :rtype: dict
+        """
+        cached = self.cache.get(session_id)
+        generation = _to_int(generation)
+        if cached is not None:
+            if generation is not None and generation == cached[0]:
+                self.cache.hits += 1
+                return copy.deepcopy(cached[1])
+            self.cache.evict(session_id)
+        self.cache.misses += 1
+        return None
+
+    def _cache_set(self, session_id:str, data:Optional[dict],
+                   generation:Optional[int]) -> None:
+        if self.cache is not None and data is not None \
+                and generation is not None:
+            self.cache.set(session_id, generation, copy.deepcopy(data))
+
+    def _load(self, session_id: str) -> Optional[dict]:
+        """Load the session data from the cache or from redis.
+
+        :param session_id: the session id
+        :type session_id: str
+        :return: the decoded session data or None if missing / invalid
+        :rtype: dict
+        """
+        if self.cache is not None and session_id in self.cache:
+            metrics.count('redis')
+            data = self._cache_get(
+                session_id,
+                self.ring.get(session_id).get(
+                    self._redis_generation_key(session_id)
+                ),
+            )
+            if data is not None:
+                return data
+        elif self.cache is not None:
+            self.cache.misses += 1
+
+        data, generation = self._fetch(session_id)
+        self._cache_set(session_id, data, generation)
+        return data
+
+    def _parse_cookie(self, cookie:Optional[str]) -> Tuple[
+            Optional[PVaultSession], Optional[str], Optional[int]]:
+        """Parse the session cookie.
+
+        :param cookie: the value of the session cookie
+        :type cookie: str
+        :return: a ``(session, session_id, renewed)`` tuple. If the session
+            is stored in redis, session is None and the session must be
+            loaded with the session id. Otherwise session is the session
+            stored in the cookie, or a new session if the cookie is missing
+            or invalid.
+        :rtype: tuple
+        """
         # If we do not have a session ID then we'll just use a new empty
         # session.
-        if session_id is None:
-            return PVaultSession()
+        if cookie is None:
+            return PVaultSession(), None, None
 
         # Check to make sure we have a valid session id
         try:
-            session_id = self.signer.unsign(session_id, max_age=self.max_age)
-            session_id = session_id.decode('utf8')
+            value, signed_at = self.signer.unsign(
+                cookie, max_age=self.max_age, return_timestamp=True
+            )
         except BadSignature:
-            return PVaultSession()
+            return PVaultSession(), None, None
+        renewed = int(signed_at.timestamp())
 
-        # Fetch the serialized data from redis
-        bdata = self.redis.get(self._redis_key(session_id))
+        if value.startswith(self.cookie_marker):
+            # The whole session is in the cookie
+            try:
+                session_id, data = self.codec.loads(
+                    self._decrypt(value[len(self.cookie_marker):])
+                )
+                # Never written in the cookie (see _cookie_payload)
+                if any(key in data for key in self.redis_only_keys):
+                    return PVaultSession(), None, None
+            except (ValueError, TypeError):
+                return PVaultSession(), None, None
+            session = self._make_session(data, session_id, renewed)
+            session.in_cookie = True
+            return session, None, None
 
-        # If the session didn't exist in redis, we'll give the user a new
-        # session.
-        if bdata is None:
-            return PVaultSession()
+        # Cookies issued without marker are redis sessions
+        if value.startswith(self.redis_marker):
+            value = value[len(self.redis_marker):]
+        return None, value.decode('utf8'), renewed
 
-        # De-serialize our session data
-        try:
-            data = msgpack.unpackb(bdata, encoding='utf8', use_list=True)
-        except msgpack.exceptions.ExtraData:
-            # If the session data was invalid we'll give the user a new session
-            return PVaultSession()
-        except msgpack.exceptions.UnpackException:
-            # If the session data was invalid we'll give the user a new session
+    def _make_session(self, data:Optional[dict], session_id:str,
+                      renewed:int) -> PVaultSession:
+        # If the session didn't exist in redis or if the session data was
+        # invalid, we'll give the user a new session.
+        if data is None:
             return PVaultSession()
 
         # If we were able to load existing session data, load it into a
         # Session class
         session = PVaultSession(data, session_id, False)
+        session.renewed = renewed
+        return session
+
+    def _process_request(self, request:Request) -> PVaultSession:
+        # Register a callback with the request so we can save the session once
+        # it's finished.
+        request.add_response_callback(self._process_response)
+
+        # Load our session ID from the request.
+        session, session_id, renewed = self._parse_cookie(
+            request.cookies.get(self.cookie_name)
+        )
+        if session is None:
+            session = self._make_session(
+                self._load(session_id), session_id, renewed
+            )
         return session
-        # return
 
     def _process_response(self, request:Request, response:Response) -> None:
+        start = time.perf_counter()
+        pipes, generation_index = self._prepare_response(request, response)
+        results = {name: pipe.execute() for name, pipe in pipes.items()}
+        self._saved(request.session, results, generation_index)
+        metrics.count('redis', len(pipes))
+        metrics.add('session', time.perf_counter() - start)
+
+    def _saved(self, session:PVaultSession, results:dict,
+               generation_index:Optional[int]) -> None:
+        """Update the cache once the session has been saved.
+
+        :param session: the saved session
+        :type session: PVaultSession
+        :param results: the results of the pipelines by node name
+        :type results: dict
+        :param generation_index: the index of the new generation in the
+            results of the session node pipeline
+        :type generation_index: int
+        """
+        if generation_index is not None and self.cache is not None:
+            self.cache.set(
+                session.sid,
+                results[self.ring.get_name(session.sid)][generation_index],
+                copy.deepcopy(dict(session)),
+            )
+
+    def _prepare_response(self, request:Request, response:Response) -> Tuple[
+            dict, Optional[int]]:
+        """Queue the redis commands of the response and set the cookie.
+
+        :return: the ``(pipes, generation_index)`` tuple, the pipelines to
+            execute by node name and the index of the new generation in the
+            results of the session node pipeline.
+        :rtype: tuple
+        """
         # If the request has an InvalidSession, then the view can't have
         # accessed the session, and we can just skip all of this anyways.
         # if isinstance(request.session, InvalidSession):
         #     return
 
+        # All the redis commands of the response are sent in one pipeline
+        # (MULTI / EXEC) per node so the deletes, the write and the expiry
+        # are applied atomically in a single round-trip.
+        pipes = {}
+        generation_index = None
+        cookie_value = None
+        session = request.session
+
         # Check to see if the session has been marked to be deleted, if it has
         # benn then we'll delete it, and tell our response to delete the
         # session cookie as well.
-        if request.session.invalidated:
-            for session_id in request.session.invalidated:
-                self.redis.delete(self._redis_key(session_id))
+        if session.invalidated:
+            self._delete(session.invalidated, pipes)
+            for callback in self.invalidate_callbacks:
+                for session_id in session.invalidated:
+                    callback(session_id)
 
-            if not request.session.should_save():
+            if not session.should_save():
                 response.delete_cookie(self.cookie_name)
 
         # Check to see if the session has been marked to be saved, generally
         # this means that the session data has been modified and thus we need
         # to store the new data.
-        if request.session.should_save():
-            # Save our session in Redis
-            self.redis.setex(
-                self._redis_key(request.session.sid),
-                self.max_age,
-                msgpack.packb(
-                    request.session,
-                    encoding='utf8',
-                    use_bin_type=True
-                ),
-            )
+        if session.should_save() or self._should_touch(session):
+            payload = self._cookie_payload(session)
+            if payload is not None:
+                # Small session, store it in the cookie and drop the redis
+                # copy if the session was stored there (the flash messages
+                # stay in redis).
+                if not session.new and not session.in_cookie:
+                    self._delete([session.sid], pipes)
+                session.in_cookie = True
+                cookie_value = self.cookie_marker + self._encrypt(payload)
+            else:
+                if session.in_cookie:
+                    # Spill over from the cookie, every keys must be written
+                    session.changed()
+                    session.in_cookie = False
+                pipe = self._pipeline(session.sid, pipes)
+                if session.should_save():
+                    # The generation is bumped so that the other workers
+                    # drop their cached copy.
+                    generation_index = self._save(session, pipe)
+                else:
+                    # If the session is unchanged we only reset its expiry,
+                    # at most once every touch_interval seconds.
+                    self._touch(session, pipe)
+                cookie_value = self.redis_marker + session.sid.encode('utf8')
+
+        if session.flash_pushes:
+            self._queue_flash(session, self._pipeline(session.sid, pipes))
 
+        if cookie_value is not None:
             # Send our session cookie to the client
             response.set_cookie(
                 self.cookie_name,
-                self.signer.sign(request.session.sid.encode('utf8')),
+                self.signer.sign(cookie_value),
                 max_age=self.max_age,
                 httponly=True,
                 secure=request.scheme == 'https',
                 samesite=b'lax',
             )
+
+        return pipes, generation_index
@@ -0,0 +1,139 @@
+"""Jinja2 bytecode cache and templates precompilation.
+
+Each worker compiles a template to Python bytecode the first time it
+renders it. With a bytecode cache, the compiled templates are stored and
+loaded by the next workers:
+
+- ``jinja2.bytecode_caching = true`` and
+  ``jinja2.bytecode_caching_directory`` store them in a directory
+  (``pyramid_jinja2`` setting, for the workers of a host),
+- ``pvault.templates.bytecode_cache.redis_url`` store them in redis (for
+  the workers of every host), under ``pvault/jinja2/``.
+
+:func:`precompile` (``pvault-templates`` command) fills the cache at build
+/ deploy time so that the first requests of a new worker don't compile
+anything. A template is recompiled when its source changes (checksum of
+the source), the cache doesn't need to be cleared on deployment.
+"""
+import os
+import logging
+
+from typing import (
+    Iterator,
+    List,
+    Optional,
+)
+
+import redis
+from jinja2 import Environment, meta
+from jinja2.bccache import MemcachedBytecodeCache
+from pyramid.settings import asbool
+from pyramid_jinja2 import IJinja2Environment
+
+log = logging.getLogger(__name__)
+
+# Directory of the templates of the application
+TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+class RedisBytecodeClient(object):
+    """Client of :class:`jinja2.bccache.MemcachedBytecodeCache` storing the
+    bytecode in redis.
+
+    :param client: the redis client
+    """
+
+    def __init__(self, client:redis.StrictRedis) -> None:
+        self.client = client
+
+    def get(self, key:str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key:str, value:bytes, timeout:Optional[int]=None) -> None:
+        self.client.set(key, value, ex=timeout or None)
+
+
+def bytecode_cache_from_settings(
+        settings:dict) -> Optional[MemcachedBytecodeCache]:
+    """Return the redis bytecode cache configured by the settings, or None.
+
+    :param settings: the application settings
+    :type settings: dict
+    """
+    url = settings.get('pvault.templates.bytecode_cache.redis_url')
+    if not url:
+        return None
+    # Errors are ignored: the templates are compiled like without cache
+    return MemcachedBytecodeCache(
+        RedisBytecodeClient(redis.StrictRedis.from_url(url)),
+        prefix='pvault/jinja2/',
+        timeout=int(
+            settings.get('pvault.templates.bytecode_cache.ttl', 0)
+        ) or None,
+        ignore_memcache_errors=True,
+    )
+
+
+def template_names(directory:str=TEMPLATES,
+                   package:str='pvault') -> Iterator[str]:
+    """Iterate over the asset specs of the templates of a directory."""
+    base = os.path.dirname(os.path.abspath(__import__(package).__file__))
+    for root, _, files in sorted(os.walk(directory)):
+        for name in sorted(files):
+            if not name.endswith('.jinja2'):
+                continue
+            relative = os.path.relpath(os.path.join(root, name), base)
+            yield f'{package}:{relative.replace(os.sep, "/")}'
+
+
+def precompile(env:Environment, names:Iterator[str]) -> List[str]:
+    """Compile templates and the templates they extend / include, in the
+    bytecode cache of ``env``.
+
+    The templates are loaded by the names used by the renderers (the
+    bytecode cache key depends on it): the asset spec of the templates,
+    and the relative names of the templates they reference.
+
+    :param env: the environment of the renderers
+    :param names: the asset specs of the templates
+    :return: the names of the compiled templates
+    :rtype: list
+    """
+    compiled = []
+    pending = [(name, None) for name in names]
+    while pending:
+        name, parent = pending.pop(0)
+        template = env.get_template(name, parent)
+        if template.name in compiled:
+            continue
+        compiled.append(template.name)
+        source = env.loader.get_source(env, template.name)[0]
+        for reference in meta.find_referenced_templates(env.parse(source)):
+            # None for the dynamic names
+            if reference is not None:
+                pending.append((reference, template.name))
+    return compiled
+
+
+def get_environment(registry) -> Environment:
+    """Return the environment of the ``.jinja2`` renderer."""
+    return registry.queryUtility(IJinja2Environment, name='.jinja2')
+
+
+def includeme(config):
+    """Configure the bytecode cache of the Jinja2 renderers.
+
+    Activate this setup using ``config.include('pvault.templating')``
+    before ``config.include('pyramid_jinja2')``.
+    """
+    settings = config.get_settings()
+    cache = bytecode_cache_from_settings(settings)
+    if cache is not None:
+        # pyramid_jinja2 accept a cache instance
+        settings['jinja2.bytecode_caching'] = cache
+        config.registry['template_cache'] = cache
+    elif asbool(settings.get('jinja2.bytecode_caching', False)):
+        directory = settings.get('jinja2.bytecode_caching_directory')
+        if directory:
+            # FileSystemBytecodeCache doesn't create it
+            os.makedirs(directory, exist_ok=True)
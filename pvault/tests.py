@@ -2,6 +2,24 @@ import unittest
 
 from pyramid import testing
 
+from .ring import HashRing
+
+SECRET_SETTING = 'hero_million.session.secret'
+
+
+def _make_config(settings, client=None):
+    """Return the configurator of the application, the sessions stored in
+    ``client`` (an in-memory redis by default)."""
+    import fakeredis
+    from . import make_config, session_factory_from_settings
+    settings = dict({SECRET_SETTING: 'seekrit'}, **settings)
+    factory = session_factory_from_settings(settings)
+    factory.ring = HashRing({
+        'default': client if client is not None
+        else fakeredis.FakeStrictRedis(),
+    })
+    return make_config(settings, factory)
+
 
 class ViewTests(unittest.TestCase):
     def setUp(self):
@@ -27,3 +45,1685 @@ class FunctionalTests(unittest.TestCase):
     def test_root(self):
         res = self.testapp.get('/', status=200)
         self.assertTrue(b'Pyramid' in res.body)
+
+
+class SessionCacheTests(unittest.TestCase):
+    def setUp(self):
+        import fakeredis
+        from .sessions import PVaultSessionFactory
+        self.server = fakeredis.FakeServer()
+        self.factory = PVaultSessionFactory(
+            'seekrit', 'localhost', 6379, cache_size=2
+        )
+        self.redis = fakeredis.FakeStrictRedis(server=self.server)
+        self.factory.ring = HashRing({'default': self.redis})
+
+    def _save(self, factory, session):
+        request = testing.DummyRequest(scheme='http')
+        request.session = session
+        response = request.response
+        factory._process_response(request, response)
+        return response
+
+    def _load(self, factory, response):
+        request = testing.DummyRequest()
+        request.cookies[factory.cookie_name] = (
+            response.headers['Set-Cookie'].split(';')[0].split('=', 1)[1]
+        )
+        return factory(request)
+
+    def test_cache_hit(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session['counter'] = 1
+        response = self._save(self.factory, session)
+
+        loaded = self._load(self.factory, response)
+        self.assertEqual(loaded['counter'], 1)
+        self.assertEqual(self.factory.cache.stats()['hits'], 1)
+
+        # The cached data is not shared with the returned session
+        loaded['counter'] = 2
+        self.assertEqual(self._load(self.factory, response)['counter'], 1)
+
+    def test_cache_stale_generation(self):
+        import fakeredis
+        from .sessions import PVaultSession, PVaultSessionFactory
+        other = PVaultSessionFactory('seekrit', 'localhost', 6379)
+        other.ring = HashRing({
+            'default': fakeredis.FakeStrictRedis(server=self.server)
+        })
+
+        session = PVaultSession()
+        session['counter'] = 1
+        response = self._save(self.factory, session)
+
+        # Another worker update the session
+        session = self._load(other, response)
+        session['counter'] = 2
+        self._save(other, session)
+
+        loaded = self._load(self.factory, response)
+        self.assertEqual(loaded['counter'], 2)
+        self.assertEqual(self.factory.cache.stats()['misses'], 1)
+
+    def test_atomic_fetch(self):
+        from unittest import mock
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session['counter'] = 1
+        response = self._save(self.factory, session)
+        self.factory.cache.clear()
+
+        # The data and the generation are read in one MULTI transaction
+        with mock.patch.object(
+            self.redis, 'pipeline', wraps=self.redis.pipeline
+        ) as pipeline:
+            self.assertEqual(self._load(self.factory, response)['counter'], 1)
+        pipeline.assert_called_once_with(transaction=True)
+
+    def test_cache_invalidate_and_eviction(self):
+        from .sessions import PVaultSession
+        sessions = []
+        for i in range(3):
+            session = PVaultSession()
+            session['counter'] = i
+            self._save(self.factory, session)
+            sessions.append(session)
+        self.assertEqual(len(self.factory.cache), 2)
+        self.assertEqual(self.factory.cache.stats()['evictions'], 1)
+
+        sid = sessions[2].sid
+        sessions[2].invalidate()
+        self._save(self.factory, sessions[2])
+        self.assertIsNone(self.factory.cache.get(sid))
+        self.assertIsNone(self.redis.get(self.factory._redis_key(sid)))
+
+
+class SessionHashStorageTests(unittest.TestCase):
+    def setUp(self):
+        import fakeredis
+        from .sessions import PVaultSessionFactory
+        self.factory = PVaultSessionFactory(
+            'seekrit', 'localhost', 6379, storage='hash'
+        )
+        self.redis = fakeredis.FakeStrictRedis()
+        self.factory.ring = HashRing({'default': self.redis})
+
+    def _round_trip(self, session):
+        request = testing.DummyRequest(scheme='http')
+        request.session = session
+        self.factory._process_response(request, request.response)
+        cookie = request.response.headers['Set-Cookie']
+        request = testing.DummyRequest()
+        request.cookies[self.factory.cookie_name] = (
+            cookie.split(';')[0].split('=', 1)[1]
+        )
+        return self.factory(request)
+
+    def test_delta(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session.update({'counter': 1, 'user': 'marc', 'tmp': [1, 2]})
+        self.assertIsNone(session.delta())
+
+        session = self._round_trip(session)
+        self.assertIsInstance(session, PVaultSession)
+        self.assertEqual(session, {'counter': 1, 'user': 'marc', 'tmp': [1, 2]})
+        self.assertFalse(session.should_save())
+
+        session['counter'] += 1
+        del session['tmp']
+        self.assertEqual(session.delta(), ({'counter'}, {'tmp'}))
+
+        session = self._round_trip(session)
+        self.assertEqual(session, {'counter': 2, 'user': 'marc'})
+
+    def test_changed_rewrite(self):
+        from .sessions import PVaultSession
+        session = PVaultSession({'a': 1}, 'sid', new=False)
+        session.changed()
+        self.assertIsNone(session.delta())
+
+
+class SessionResponseTests(unittest.TestCase):
+    def setUp(self):
+        import fakeredis
+        from .sessions import PVaultSessionFactory
+        self.factory = PVaultSessionFactory(
+            'seekrit', 'localhost', 6379, touch_interval=60
+        )
+        self.redis = fakeredis.FakeStrictRedis()
+        self.factory.ring = HashRing({'default': self.redis})
+
+    def _response(self, session):
+        request = testing.DummyRequest(scheme='http')
+        request.session = session
+        self.factory._process_response(request, request.response)
+        return request.response
+
+    def _load(self, response):
+        request = testing.DummyRequest()
+        request.cookies[self.factory.cookie_name] = (
+            response.headers['Set-Cookie'].split(';')[0].split('=', 1)[1]
+        )
+        return self.factory(request)
+
+    def test_rotate_single_round_trip(self):
+        from unittest import mock
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session['user'] = 'marc'
+        session = self._load(self._response(session))
+        old_sid = session.sid
+
+        session.invalidate()
+        session['user'] = 'marc'
+        with mock.patch.object(
+            self.redis, 'pipeline', wraps=self.redis.pipeline
+        ) as pipeline:
+            response = self._response(session)
+        self.assertEqual(pipeline.call_count, 1)
+        self.assertIsNone(
+            self.redis.get(self.factory._redis_key(old_sid))
+        )
+        self.assertEqual(self._load(response)['user'], 'marc')
+
+    def test_touch(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session['user'] = 'marc'
+        session = self._load(self._response(session))
+        key = self.factory._redis_key(session.sid)
+
+        # Recently touched, nothing is sent
+        self.redis.expire(key, 10)
+        response = self._response(session)
+        self.assertNotIn('Set-Cookie', response.headers)
+        self.assertLessEqual(self.redis.ttl(key), 10)
+
+        session.renewed -= 120
+        response = self._response(session)
+        self.assertIn('Set-Cookie', response.headers)
+        self.assertGreater(self.redis.ttl(key), 10)
+
+
+class SessionCookieStorageTests(unittest.TestCase):
+    def setUp(self):
+        import fakeredis
+        from .sessions import PVaultSessionFactory
+        self.factory = PVaultSessionFactory(
+            'seekrit', 'localhost', 6379, cookie_max_size=64
+        )
+        self.redis = fakeredis.FakeStrictRedis()
+        self.factory.ring = HashRing({'default': self.redis})
+
+    def _round_trip(self, session):
+        request = testing.DummyRequest(scheme='http')
+        request.session = session
+        self.factory._process_response(request, request.response)
+        cookie = request.response.headers['Set-Cookie']
+        cookie = cookie.split(';')[0].split('=', 1)[1]
+        request = testing.DummyRequest()
+        request.cookies[self.factory.cookie_name] = cookie
+        return cookie, self.factory(request)
+
+    def test_small_session_in_cookie(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session['counter'] = 1
+        cookie, session = self._round_trip(session)
+        self.assertTrue(cookie.startswith('c:'))
+        self.assertNotIn(b'counter', cookie.encode('utf8'))
+        self.assertTrue(session.in_cookie)
+        self.assertEqual(session['counter'], 1)
+        self.assertEqual(self.redis.dbsize(), 0)
+
+    def test_spill_over_to_redis(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session['counter'] = 1
+        _, session = self._round_trip(session)
+        sid = session.sid
+
+        session['data'] = 'x' * 100
+        cookie, session = self._round_trip(session)
+        self.assertTrue(cookie.startswith('r:'))
+        self.assertFalse(session.in_cookie)
+        self.assertEqual(session.sid, sid)
+        self.assertEqual(session['counter'], 1)
+
+        # Back in the cookie, the redis copy is removed
+        del session['data']
+        cookie, session = self._round_trip(session)
+        self.assertTrue(cookie.startswith('c:'))
+        self.assertEqual(self.redis.dbsize(), 0)
+
+    def test_authenticated_session_in_redis(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session['counter'] = 1
+        _, session = self._round_trip(session)
+        session['user_id'] = 'marc'
+        cookie, session = self._round_trip(session)
+        self.assertTrue(cookie.startswith('r:'))
+        self.assertEqual(session['user_id'], 'marc')
+
+        # Logout: the session is deleted from redis, the cookie is revoked
+        session.invalidate()
+        request = testing.DummyRequest(scheme='http')
+        request.session = session
+        self.factory._process_response(request, request.response)
+        self.assertEqual(self.redis.dbsize(), 0)
+        request = testing.DummyRequest()
+        request.cookies[self.factory.cookie_name] = cookie
+        self.assertNotIn('user_id', self.factory(request))
+
+    def test_tampered_cookie(self):
+        from .sessions import PVaultSession
+        payload = self.factory.cookie_marker + self.factory._encrypt(b'x')
+        request = testing.DummyRequest()
+        request.cookies[self.factory.cookie_name] = (
+            self.factory.signer.sign(payload[:-2] + b'AA').decode('utf8')
+        )
+        session = self.factory(request)
+        self.assertTrue(session.new)
+
+    def test_redis_only_keys_in_cookie(self):
+        payload = self.factory.cookie_marker + self.factory._encrypt(
+            self.factory.codec.dumps(['sid', {'user_id': 'victim'}])
+        )
+        request = testing.DummyRequest()
+        request.cookies[self.factory.cookie_name] = (
+            self.factory.signer.sign(payload).decode('utf8')
+        )
+        session = self.factory(request)
+        self.assertTrue(session.new)
+        self.assertNotIn('user_id', session)
+
+    def test_secret_required(self):
+        from . import session_factory_from_settings
+        for settings in ({}, {SECRET_SETTING: ' '}):
+            with self.assertRaises(ValueError):
+                session_factory_from_settings(settings)
+
+
+class HashRingTests(unittest.TestCase):
+    def test_distribution_and_moves(self):
+        ring = HashRing({'a': 'a', 'b': 'b', 'c': 'c'})
+        keys = [f'session-{i}' for i in range(3000)]
+        before = {key: ring.get(key) for key in keys}
+        counts = {name: list(before.values()).count(name) for name in 'abc'}
+        for count in counts.values():
+            self.assertGreater(count, 700)
+
+        # Adding a node only move the keys taken by the new node
+        ring.add('d', 'd')
+        after = {key: ring.get(key) for key in keys}
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertTrue(all(after[key] == 'd' for key in moved))
+        self.assertLess(len(moved), len(keys) / 3)
+
+        # Removing it move them back
+        ring.remove('d')
+        self.assertEqual(before, {key: ring.get(key) for key in keys})
+
+    def test_empty_ring(self):
+        with self.assertRaises(LookupError):
+            HashRing().get('session')
+
+
+class ShardedSessionFactoryTests(unittest.TestCase):
+    def setUp(self):
+        import fakeredis
+        from .sessions import PVaultSessionFactory
+        self.factory = PVaultSessionFactory(
+            'seekrit', None, None, redis_nodes=[
+                'redis://localhost:6379/0', 'redis://localhost:6380/0'
+            ], redis_options={'max_connections': 10, 'socket_timeout': 1}
+        )
+        node = self.factory.ring['redis://localhost:6380/0']
+        self.assertEqual(node.connection_pool.max_connections, 10)
+
+        self.factory.ring = HashRing({
+            name: fakeredis.FakeStrictRedis() for name in 'abc'
+        })
+
+    def test_sessions_spread(self):
+        from .sessions import PVaultSession
+        cookies = []
+        for i in range(30):
+            request = testing.DummyRequest(scheme='http')
+            request.session = PVaultSession()
+            request.session['counter'] = i
+            self.factory._process_response(request, request.response)
+            cookies.append(request.response.headers['Set-Cookie'])
+
+        for name in 'abc':
+            self.assertGreater(self.factory.ring[name].dbsize(), 0)
+
+        for i, cookie in enumerate(cookies):
+            request = testing.DummyRequest()
+            request.cookies[self.factory.cookie_name] = (
+                cookie.split(';')[0].split('=', 1)[1]
+            )
+            self.assertEqual(self.factory(request)['counter'], i)
+
+
+class SessionCodecTests(unittest.TestCase):
+    def test_round_trip(self):
+        import uuid
+        import datetime
+        from .codec import SessionCodec
+        value = {
+            'user': uuid.uuid4(),
+            'login': datetime.datetime.now(datetime.timezone.utc),
+            'birthday': datetime.date(1990, 1, 1),
+            'history': ['/vault'] * 500,
+        }
+        for compression in ('none', 'zlib'):
+            codec = SessionCodec(compression, threshold=100)
+            bdata = codec.dumps(value)
+            self.assertEqual(bdata[0], 0xc1)
+            self.assertEqual(codec.loads(bdata), value)
+        self.assertLess(
+            len(SessionCodec('zlib').dumps(value)),
+            len(SessionCodec('none').dumps(value)),
+        )
+
+    def test_legacy_and_invalid(self):
+        import msgpack
+        from .codec import SessionCodec
+        codec = SessionCodec()
+        legacy = msgpack.packb({'counter': 1}, use_bin_type=True)
+        self.assertEqual(codec.loads(legacy), {'counter': 1})
+        for bdata in (b'\xc1', b'\xc1\xf0', b'\xc1\x11garbage'):
+            with self.assertRaises(ValueError):
+                codec.loads(bdata)
+
+
+class SessionFlashTests(unittest.TestCase):
+    def setUp(self):
+        import fakeredis
+        from .sessions import PVaultSessionFactory
+        self.factory = PVaultSessionFactory('seekrit', 'localhost', 6379)
+        self.redis = fakeredis.FakeStrictRedis()
+        self.factory.ring = HashRing({'default': self.redis})
+
+    def _load(self):
+        from .sessions import PVaultSession
+        session = PVaultSession({'counter': 1}, 'sid', new=False)
+        session.flash_storage = self.factory
+        return session
+
+    def _save(self, session):
+        request = testing.DummyRequest(scheme='http')
+        request.session = session
+        self.factory._process_response(request, request.response)
+        return request.response
+
+    def test_flash_without_session_write(self):
+        from unittest import mock
+        session = self._load()
+        session.flash('saved', queue='success')
+        session.flash('saved', queue='success', allow_duplicate=False)
+        session.flash('error')
+        self.assertFalse(session.should_save())
+        # Pushed with the session save
+        self.assertEqual(self.redis.dbsize(), 0)
+        self.assertEqual(session.peek_flash('success'), ['saved'])
+        self._save(session)
+        self.assertEqual(sorted(self.redis.keys('*')), [
+            b'pvault/session/flash/sid/_flash_messages',
+            b'pvault/session/flash/sid/_flash_messages.success',
+        ])
+        for key in self.redis.keys('*'):
+            self.assertGreater(self.redis.ttl(key), 0)
+
+        session = self._load()
+        self.assertEqual(session.peek_flash('success'), ['saved'])
+        self.assertEqual(session.peek_flash('success'), ['saved'])
+        with mock.patch.object(
+            self.redis, 'pipeline', wraps=self.redis.pipeline
+        ) as pipeline:
+            self.assertEqual(session.pop_flash('success'), ['saved'])
+        # One MULTI on the queue, the other queues are not touched
+        pipeline.assert_called_once_with()
+        self.assertEqual(session.peek_flash(), ['error'])
+        self.assertEqual(session.pop_flash('success'), [])
+        self.assertEqual(session.pop_flash(), ['error'])
+        self.assertFalse(session.should_save())
+        self.assertEqual(self.redis.dbsize(), 0)
+
+    def test_flash_no_duplicate(self):
+        for _ in range(2):
+            session = self._load()
+            session.flash('saved', allow_duplicate=False)
+            session.flash('other')
+            self._save(session)
+        session = self._load()
+        # Moved to the end of the queue, once
+        self.assertEqual(session.pop_flash(), ['other', 'saved', 'other'])
+
+    def test_flash_pending_pop(self):
+        session = self._load()
+        session.flash('saved')
+        self.assertEqual(session.pop_flash(), ['saved'])
+        self._save(session)
+        self.assertEqual(self.redis.dbsize(), 0)
+
+    def test_flash_expire_and_invalidate(self):
+        key = 'pvault/session/flash/sid/_flash_messages'
+        session = self._load()
+        session.flash('saved')
+        self._save(session)
+        self.redis.expire(key, 10)
+        session = self._load()
+        session.flash('other')
+        self._save(session)
+        # Reset by each push
+        self.assertGreater(self.redis.ttl(key), 10)
+
+        # The invalidated session gets a new id, without the old queues
+        session = self._load()
+        session.invalidate()
+        session.flash_storage = self.factory
+        self.assertEqual(session.peek_flash(), [])
+
+    def test_flash_new_session(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session.flash_storage = self.factory
+        self.assertEqual(session.peek_flash(), [])
+        session.flash('welcome')
+        self.assertTrue(session.should_save())
+        self._save(session)
+        key = self.factory._redis_flash_key(session.sid, '_flash_messages')
+        self.assertGreater(self.redis.ttl(key), 0)
+
+    def test_flash_in_session(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session.flash('saved', allow_duplicate=False)
+        session.flash('saved', allow_duplicate=False)
+        self.assertEqual(session.pop_flash(), ['saved'])
+
+
+class SessionCSRFTests(unittest.TestCase):
+    def setUp(self):
+        from .sessions import PVaultSession, PVaultSessionFactory
+        self.factory = PVaultSessionFactory(
+            'seekrit', 'localhost', 6379, csrf_secrets=['new', 'old']
+        )
+        self.session = PVaultSession({'counter': 1}, 'sid', new=False)
+        self.session.csrf_storage = self.factory
+
+    def test_form_rendering_does_not_save(self):
+        from pyramid.csrf import get_csrf_token, check_csrf_token
+        from .sessions import PVaultCSRFStoragePolicy
+        self.config = testing.setUp()
+        self.config.set_csrf_storage_policy(PVaultCSRFStoragePolicy())
+        request = testing.DummyRequest(session=self.session)
+        token = get_csrf_token(request)
+        self.assertEqual(get_csrf_token(request), token)
+        self.assertFalse(self.session.should_save())
+
+        request = testing.DummyRequest(
+            session=self.session, post={'csrf_token': token}
+        )
+        self.assertTrue(check_csrf_token(request, raises=False))
+        request = testing.DummyRequest(
+            session=self.session, post={'csrf_token': token[:-4] + 'AAA='}
+        )
+        self.assertFalse(check_csrf_token(request, raises=False))
+        testing.tearDown()
+
+    def test_rotation(self):
+        from .sessions import PVaultSessionFactory
+        old = PVaultSessionFactory(
+            'seekrit', 'localhost', 6379, csrf_secrets=['old']
+        )
+        other = PVaultSessionFactory(
+            'seekrit', 'localhost', 6379, csrf_secrets=['other']
+        )
+        self.assertTrue(self.session.check_csrf_token(
+            old.new_csrf_token('sid')
+        ))
+        self.assertFalse(self.session.check_csrf_token(
+            other.new_csrf_token('sid')
+        ))
+        self.assertFalse(self.session.check_csrf_token(
+            self.factory.new_csrf_token('another-sid')
+        ))
+        self.assertFalse(self.session.check_csrf_token('garbage'))
+
+    def test_new_session_is_saved(self):
+        from .sessions import PVaultSession
+        session = PVaultSession()
+        session.csrf_storage = self.factory
+        token = session.get_csrf_token()
+        self.assertTrue(session.should_save())
+        self.assertTrue(session.check_csrf_token(token))
+
+
+class ASGITests(unittest.TestCase):
+    def setUp(self):
+        import fakeredis
+        from . import make_config, session_factory_from_settings
+        from .asgi import PVaultASGIApp
+        from .aiosessions import AsyncPVaultSessionFactory
+        settings = {
+            'sqlalchemy.url': 'sqlite://',
+            'hero_million.session.redis.host': 'localhost',
+            'hero_million.session.redis.port': '6379',
+            SECRET_SETTING: 'seekrit',
+        }
+        self.factory = session_factory_from_settings(
+            settings, AsyncPVaultSessionFactory
+        )
+        self.redis = fakeredis.FakeAsyncRedis()
+        self.factory.ring = HashRing({'default': self.redis})
+        self.config = config = make_config(settings, self.factory)
+        self.app = PVaultASGIApp(config.make_wsgi_app(), self.factory, 4)
+
+    def tearDown(self):
+        self.app.executor.shutdown()
+
+    async def _get(self, path, cookie=None):
+        headers = [(b'host', b'localhost')]
+        if cookie is not None:
+            headers.append((b'cookie', cookie.encode('latin1')))
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path,
+            'query_string': b'', 'headers': headers, 'http_version': '1.1',
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        await self.app(scope, receive, send)
+        headers = dict(messages[0]['headers'])
+        body = b''.join(m.get('body', b'') for m in messages[1:])
+        return messages[0]['status'], headers, body
+
+    def test_session_round_trip(self):
+        import asyncio
+
+        async def run():
+            status, headers, body = await self._get('/testsession')
+            self.assertEqual(status, 200)
+            self.assertIn(b'Counter updated', body)
+            cookie = headers[b'set-cookie'].decode('latin1').split(';')[0]
+
+            status, headers, body = await self._get('/testsession', cookie)
+            self.assertEqual(status, 200)
+            self.assertIn(b'2', body)
+            self.assertIn(b'Counter updated', body)
+            keys = await self.redis.keys('pvault/session/data/*')
+            self.assertEqual(len(keys), 1)
+
+        asyncio.run(run())
+
+    def test_environ_headers(self):
+        from .asgi import _environ
+        environ = _environ({
+            'type': 'http', 'method': 'GET', 'path': '/',
+            'headers': [
+                (b'cookie', b'a=1'), (b'cookie', b'b=2'),
+                (b'accept', b'text/html'), (b'accept', b'*/*'),
+            ],
+        }, b'')
+        self.assertEqual(environ['HTTP_COOKIE'], 'a=1; b=2')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'text/html,*/*')
+
+    def test_application_error(self):
+        import asyncio
+
+        def wsgi_app(environ, start_response):
+            raise RuntimeError('boom')
+        self.app.wsgi_app = wsgi_app
+        with self.assertLogs('pvault.asgi', 'ERROR'):
+            status, headers, body = asyncio.run(self._get('/'))
+        self.assertEqual(status, 500)
+        self.assertEqual(body, b'Internal Server Error')
+
+    def test_retry_reloads_session(self):
+        import asyncio
+        from pyramid.response import Response
+        from pyramid_retry import RetryableException
+
+        def view(request):
+            session = request.session
+            session['counter'] = session.get('counter', 0) + 1
+            if request.environ['retry.attempt'] == 0:
+                raise RetryableException()
+            return Response(str(session['counter']))
+        self.config.add_route('retried', '/retried')
+        self.config.add_view(view, route_name='retried')
+        self.app.wsgi_app = self.config.make_wsgi_app()
+
+        async def run():
+            status, headers, body = await self._get('/retried')
+            self.assertEqual(body, b'1')
+            cookie = headers[b'set-cookie'].decode('latin1').split(';')[0]
+            # The retry doesn't see the changes of the aborted attempt
+            status, headers, body = await self._get('/retried', cookie)
+            self.assertEqual(body, b'2')
+
+        asyncio.run(run())
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        from webtest import TestApp
+        settings = {'sqlalchemy.url': 'sqlite://'}
+        config = _make_config(settings)
+        self.engine = config.registry['dbsession_factory'].kw['bind']
+        self.testapp = TestApp(config.make_wsgi_app())
+
+    def test_metrics_endpoint(self):
+        self.testapp.get('/testsession', status=200)
+        res = self.testapp.get(
+            '/metrics', extra_environ={'REMOTE_ADDR': '127.0.0.1'}, status=200
+        )
+        self.assertEqual(res.content_type, 'text/plain')
+        for line in (
+            'pvault_request_duration_seconds_count'
+            '{route="test_session",phase="render"}',
+            'pvault_request_duration_seconds_count'
+            '{route="test_session",phase="session"}',
+            'pvault_request_redis_calls_bucket{route="test_session",le="+Inf"}',
+        ):
+            self.assertIn(line, res.text)
+
+    def test_metrics_allowed_ips(self):
+        self.testapp.get('/metrics', status=403)
+        self.testapp.get(
+            '/metrics', extra_environ={'REMOTE_ADDR': '10.0.0.7'}, status=403
+        )
+        self.testapp.get(
+            '/metrics', extra_environ={'REMOTE_ADDR': '::1'}, status=200
+        )
+
+    def test_db_statements(self):
+        import sqlalchemy
+        from . import metrics
+        request_metrics = metrics._local.current = metrics.RequestMetrics()
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(sqlalchemy.text('SELECT 1'))
+                connection.execute(sqlalchemy.text('SELECT 2'))
+        finally:
+            metrics._local.current = None
+        self.assertEqual(request_metrics.db_statements, 2)
+        self.assertGreater(request_metrics.summary()['db'], 0)
+
+
+class QueryStatsTests(unittest.TestCase):
+    def test_fingerprint(self):
+        from .querystats import fingerprint
+        self.assertEqual(
+            fingerprint("SELECT *  FROM vault\n WHERE id = 12 AND name = 'a''b'"),
+            'SELECT * FROM vault WHERE id = ? AND name = ?',
+        )
+        self.assertEqual(
+            fingerprint('SELECT * FROM vault WHERE id IN (%s, %s, %s)'),
+            fingerprint('SELECT * FROM vault WHERE id IN (:id_1)'),
+        )
+        self.assertEqual(
+            fingerprint('SELECT :name::text, now()::date'),
+            'SELECT ?::text, now()::date',
+        )
+
+    def test_instrumented_request(self):
+        import sqlalchemy
+        from . import metrics, querystats
+        engine = sqlalchemy.create_engine('sqlite://')
+        querystats.instrument(engine, slow_threshold=0)
+
+        def handler(request):
+            # The engines of execution_options() are recorded too
+            with engine.execution_options(
+                    isolation_level='AUTOCOMMIT').connect() as connection:
+                for i in range(3):
+                    connection.execute(sqlalchemy.text(f'SELECT {i}'))
+            return 'response'
+
+        registry = testing.setUp(
+            settings={'pvault.db.n_plus_one_threshold': 2}
+        ).registry
+        self.addCleanup(testing.tearDown)
+        request = testing.DummyRequest()
+        request.matched_route = None
+        tween = querystats.querystats_tween_factory(handler, registry)
+        with self.assertLogs('pvault.querystats', 'WARNING') as logs:
+            self.assertEqual(tween(request), 'response')
+        self.assertIsNone(querystats.current())
+        self.assertEqual(request.query_stats.count, 3)
+        self.assertEqual(
+            [item['fingerprint'] for item in request.query_stats.summary()],
+            ['SELECT ?'],
+        )
+        self.assertEqual(len(logs.output), 4)
+        self.assertIn('N+1', logs.output[-1])
+        text = metrics.render_metrics()
+        self.assertIn('pvault_db_n_plus_one_total{route=""}', text)
+        self.assertIn('pvault_db_slow_queries_total{route=""}', text)
+
+
+class EngineLifecycleTests(unittest.TestCase):
+    def test_pool_settings(self):
+        from .db import _get_engine
+        engine = _get_engine({
+            'sqlalchemy.url': 'sqlite://',
+            'sqlalchemy.pool_pre_ping': 'false',
+            'sqlalchemy.statement_timeout': '0',
+        })
+        self.assertFalse(engine.pool._pre_ping)
+
+    def test_statement_timeout(self):
+        from unittest import mock
+        from .db import _get_engine
+        settings = {
+            'sqlalchemy.url': 'postgresql://pvault@localhost/pvault',
+            'sqlalchemy.pool_size': '3',
+            'sqlalchemy.pool_pre_ping': 'true',
+            'sqlalchemy.statement_timeout': '5000',
+        }
+        with mock.patch('pvault.db.engine_from_config') as engine_from_config:
+            _get_engine(settings)
+        engine_from_config.assert_called_once_with(
+            {
+                'sqlalchemy.url': 'postgresql://pvault@localhost/pvault',
+                'sqlalchemy.pool_size': '3',
+            },
+            'sqlalchemy.',
+            pool_pre_ping=True,
+            connect_args={'options': '-c statement_timeout=5000'},
+        )
+
+    def test_post_fork(self):
+        import fakeredis
+        from . import post_fork
+        settings = {'sqlalchemy.url': 'sqlite://'}
+        client = fakeredis.FakeStrictRedis()
+        config = _make_config(settings, client)
+        pool = config.registry['dbengine'].pool
+        client.set('key', b'value')
+        post_fork(config.registry)
+        self.assertEqual(client.get('key'), b'value')
+        self.assertIsNot(config.registry['dbengine'].pool, pool)
+
+    def test_register_post_fork(self):
+        import gc
+        import weakref
+        from unittest import mock
+        from pyramid.registry import Registry
+        import pvault
+        registries = weakref.WeakValueDictionary()
+        with mock.patch.object(pvault, '_fork_registries', registries), \
+                mock.patch.object(pvault, '_fork_hook_registered', False), \
+                mock.patch('os.register_at_fork') as register_at_fork, \
+                mock.patch.object(pvault, 'post_fork') as post_fork:
+            first, second = Registry('first'), Registry('second')
+            pvault.register_post_fork(first)
+            pvault.register_post_fork(second)
+            pvault.register_post_fork(second)
+            register_at_fork.assert_called_once_with(
+                after_in_child=pvault._after_fork_in_child
+            )
+            del first
+            gc.collect()
+            pvault._after_fork_in_child()
+            post_fork.assert_called_once_with(second)
+
+
+class ReplicaRoutingTests(unittest.TestCase):
+    def setUp(self):
+        import sqlalchemy
+        from .db import _get_session_factory
+        from .replicas import ReplicaSelector
+        self.engines = {}
+        for name in ('primary', 'replica1', 'replica2'):
+            engine = self.engines[name] = sqlalchemy.create_engine('sqlite://')
+            with engine.begin() as connection:
+                connection.execute(sqlalchemy.text('CREATE TABLE node (name)'))
+                connection.execute(
+                    sqlalchemy.text('INSERT INTO node VALUES (:name)'),
+                    {'name': name},
+                )
+        self.table = sqlalchemy.table('node', sqlalchemy.column('name'))
+        self.session_factory = _get_session_factory(
+            self.engines['primary'],
+            ReplicaSelector([self.engines['replica1'], self.engines['replica2']]),
+        )
+
+    def _node(self, dbsession, for_update=False):
+        import sqlalchemy
+        query = sqlalchemy.select(self.table.c.name)
+        if for_update:
+            query = query.with_for_update()
+        return dbsession.execute(query).scalar()
+
+    def test_read_only(self):
+        dbsession = self.session_factory()
+        dbsession.info['read_only'] = True
+        self.assertEqual(self._node(dbsession), 'replica1')
+        self.assertEqual(self._node(dbsession), 'replica1')
+        dbsession = self.session_factory()
+        dbsession.info['read_only'] = True
+        self.assertEqual(self._node(dbsession), 'replica2')
+
+    def test_reads_until_write(self):
+        import sqlalchemy
+        dbsession = self.session_factory()
+        self.assertEqual(self._node(dbsession), 'primary')
+        dbsession.info['replica_reads'] = True
+        self.assertEqual(self._node(dbsession), 'replica1')
+        self.assertEqual(self._node(dbsession, for_update=True), 'primary')
+        self.assertEqual(self._node(dbsession), 'primary')
+
+        dbsession = self.session_factory()
+        dbsession.info['replica_reads'] = True
+        dbsession.execute(sqlalchemy.update(self.table).values(name='updated'))
+        self.assertTrue(dbsession.info['wrote'])
+        self.assertEqual(self._node(dbsession), 'updated')
+
+    def test_least_connections(self):
+        from unittest import mock
+        from .replicas import ReplicaSelector
+        selector = ReplicaSelector(
+            [self.engines['replica1'], self.engines['replica2']],
+            'least_connections',
+        )
+        with mock.patch.object(
+            self.engines['replica1'].pool, 'checkedout', return_value=2,
+            create=True,
+        ), mock.patch.object(
+            self.engines['replica2'].pool, 'checkedout', return_value=1,
+            create=True,
+        ):
+            self.assertIs(selector.choose(), self.engines['replica2'])
+
+    def test_pin_after_write(self):
+        import time
+        from pyramid.response import Response
+        from .replicas import PIN_COOKIE, configure_session
+        request = testing.DummyRequest(scheme='http')
+        dbsession = self.session_factory()
+        configure_session(request, dbsession, 'all', 30)
+        dbsession.info['wrote'] = True
+        response = Response()
+        request.response_callbacks[0](request, response)
+        self.assertIn(PIN_COOKIE, response.headers['Set-Cookie'])
+
+        request = testing.DummyRequest(
+            cookies={PIN_COOKIE: str(time.time() + 30)}
+        )
+        dbsession = self.session_factory()
+        configure_session(request, dbsession, 'all', 30)
+        self.assertEqual(self._node(dbsession), 'primary')
+
+
+class ReadOnlyRequestTests(unittest.TestCase):
+    def setUp(self):
+        from webtest import TestApp
+        from pyramid.response import Response
+        import sqlalchemy
+        settings = {'sqlalchemy.url': 'sqlite://'}
+        config = _make_config(settings)
+        self.registry = config.registry
+        self.sessions = []
+        # in_transaction() of the sessions after the commit of pyramid_tm
+        self.after_commit = []
+
+        def view(request):
+            dbsession = request.dbsession
+            self.sessions.append(dbsession)
+            dbsession.execute(sqlalchemy.text('SELECT 1'))
+            request.tm.get().addAfterCommitHook(
+                lambda status: self.after_commit.append(
+                    dbsession.in_transaction()
+                )
+            )
+            return Response('OK')
+        config.add_route('read_only', '/read_only')
+        config.add_view(view, route_name='read_only', read_only=True)
+        config.add_route('read_write', '/read_write')
+        config.add_view(view, route_name='read_write')
+        self.testapp = TestApp(config.make_wsgi_app())
+
+    def test_not_joined(self):
+        self.testapp.get('/read_write')
+        self.testapp.get('/read_only')
+        # the joined session is finished by the commit, the other one when
+        # the request is finished
+        self.assertEqual(self.after_commit, [False, True])
+        dbsession = self.sessions[-1]
+        self.assertTrue(dbsession.info['read_only'])
+        self.assertFalse(dbsession.in_transaction())
+
+    def test_dispose_engine(self):
+        from .db import dispose_engine
+        self.testapp.get('/read_only')
+        engines = self.registry['dbreadonly_engines']
+        engine = self.registry['dbengine']
+        self.assertIs(self.sessions[-1].get_bind(), engines[engine])
+        dispose_engine(self.registry)
+        self.assertEqual(engines, {})
+
+    def test_flush(self):
+        import sqlalchemy
+        from sqlalchemy.orm import registry
+        from .readonly import ReadOnlyError
+
+        @registry().mapped
+        class Entry(object):
+            __tablename__ = 'entry'
+            id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        self.testapp.get('/read_only')
+        dbsession = self.sessions[-1]
+        dbsession.add(Entry(id=1))
+        with self.assertRaises(ReadOnlyError):
+            dbsession.flush()
+
+
+class ClientUUIDTests(unittest.TestCase):
+    def test_uuid7(self):
+        import time
+        from .db import uuid7
+        before = int(time.time() * 1000)
+        uuids = [uuid7() for _ in range(1000)]
+        self.assertEqual(uuids, sorted(uuids))
+        self.assertEqual(len(set(uuids)), 1000)
+        self.assertEqual(uuids[0].version, 7)
+        self.assertGreaterEqual(uuids[0].int >> 80, before)
+
+    def test_client_uuid_model(self):
+        from sqlalchemy.orm import declarative_base
+        from .db import UUIDPrimaryKey
+
+        # Not on the metadata of the application
+        class ClientKeyEntry(UUIDPrimaryKey, declarative_base()):
+            __tablename__ = 'test_client_key_entry'
+            __client_uuid__ = True
+
+        entry = ClientKeyEntry()
+        self.assertEqual(len(entry.uuid), 36)
+        self.assertEqual(ClientKeyEntry(uuid='key').uuid, 'key')
+        # Core inserts
+        self.assertIsNotNone(ClientKeyEntry.__table__.c.uuid.default)
+
+
+class BulkTests(unittest.TestCase):
+    def setUp(self):
+        import sqlalchemy
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        self.table = sqlalchemy.Table(
+            'entry', sqlalchemy.MetaData(),
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('name', sqlalchemy.String),
+        )
+        self.table.create(self.engine)
+
+    def test_csv_round_trip(self):
+        import io
+        from .scripts.bulk import export_rows, import_rows, read_rows
+        data = 'id,name\n' + ''.join(f'{i},name {i}\n' for i in range(25))
+        data += '25,\n'
+        rows = import_rows(
+            self.engine, self.table, read_rows(io.StringIO(data), 'csv'),
+            batch_size=10,
+        )
+        self.assertEqual(rows, 26)
+        output = io.StringIO()
+        self.assertEqual(
+            export_rows(self.engine, self.table, output, batch_size=10), 26
+        )
+        self.assertEqual(output.getvalue().replace('\r\n', '\n'), data)
+
+    def test_jsonl(self):
+        import io
+        import json
+        from .scripts.bulk import export_rows, import_rows, read_rows
+        data = '{"id": 1, "name": "a"}\n\n{"id": 2, "name": null}\n'
+        import_rows(
+            self.engine, self.table, read_rows(io.StringIO(data), 'jsonl'),
+            'jsonl',
+        )
+        output = io.StringIO()
+        export_rows(self.engine, self.table, output, 'jsonl')
+        self.assertEqual(
+            [json.loads(line) for line in output.getvalue().splitlines()],
+            [{'id': 1, 'name': 'a'}, {'id': 2, 'name': None}],
+        )
+
+    def test_unknown_column(self):
+        from .scripts.bulk import import_rows
+        with self.assertRaises(ValueError):
+            import_rows(self.engine, self.table, [{'id': 1, 'password': 'x'}])
+
+    def test_inconsistent_columns(self):
+        import io
+        from .scripts.bulk import import_rows, read_rows
+        for data, fmt in (
+            ('{"id": 1}\n{"id": 2, "name": "b"}\n', 'jsonl'),
+            ('{"id": 1, "name": "a"}\n{"id": 2}\n', 'jsonl'),
+            ('id,name\n1,a\n2,b,c\n', 'csv'),
+        ):
+            with self.assertRaisesRegex(ValueError, 'Row 2'):
+                import_rows(self.engine, self.table,
+                            read_rows(io.StringIO(data), fmt), fmt)
+
+
+class StreamingExportTests(unittest.TestCase):
+    rows = 20000
+
+    def setUp(self):
+        import sqlalchemy
+        from webtest import TestApp
+        settings = {
+            'sqlalchemy.url': 'sqlite://',
+            'pvault.export.tables': 'entry',
+            'pvault.export.batch_size': '500',
+        }
+        config = _make_config(settings)
+        config.add_route('login', '/login/{user_id}')
+        config.add_view(self._login, route_name='login', renderer='json')
+        engine = config.registry['dbengine']
+        table = sqlalchemy.Table(
+            'entry', sqlalchemy.MetaData(),
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('user_id', sqlalchemy.String),
+            sqlalchemy.Column('secret', sqlalchemy.String),
+        )
+        table.create(engine)
+        with engine.begin() as connection:
+            connection.execute(table.insert(), [
+                {'id': i, 'user_id': 'marc', 'secret': 'x' * 100}
+                for i in range(self.rows)
+            ] + [{'id': self.rows, 'user_id': 'other', 'secret': 'y'}])
+        self.app = config.make_wsgi_app()
+        self.testapp = TestApp(self.app)
+
+    @staticmethod
+    def _login(request):
+        from pyramid.security import remember
+        remember(request, request.matchdict['user_id'])
+        return {}
+
+    def test_export(self):
+        import json
+        self.testapp.get('/login/marc', status=200)
+        res = self.testapp.get('/export/entry.jsonl', status=200)
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        lines = res.text.splitlines()
+        self.assertEqual(len(lines), self.rows)
+        self.assertEqual(json.loads(lines[1]),
+                         {'id': 1, 'user_id': 'marc', 'secret': 'x' * 100})
+        res = self.testapp.get('/export/entry.csv', status=200)
+        self.assertEqual(res.text.splitlines()[:2],
+                         ['id,user_id,secret', '0,marc,' + 'x' * 100])
+
+    def test_owner(self):
+        import json
+        self.testapp.get('/login/other', status=200)
+        res = self.testapp.get('/export/entry.jsonl', status=200)
+        self.assertEqual([json.loads(line) for line in res.text.splitlines()],
+                         [{'id': self.rows, 'user_id': 'other', 'secret': 'y'}])
+
+    def test_anonymous(self):
+        self.testapp.get('/export/entry.jsonl', status=403)
+        self.testapp.get('/export/sqlite_master.csv', status=403)
+
+    def test_unlisted_table(self):
+        self.testapp.get('/login/marc', status=200)
+        self.testapp.get('/export/sqlite_master.csv', status=404)
+        self.testapp.get('/export/entry.xml', status=404)
+
+    def test_memory_bound(self):
+        import tracemalloc
+        from webob import Request
+        self.testapp.get('/login/marc', status=200)
+        environ = Request.blank('/export/entry.jsonl', headers={
+            'Cookie': '; '.join(
+                f'{name}={value}'
+                for name, value in self.testapp.cookies.items()
+            ),
+        }).environ
+        app_iter = self.app(environ, lambda status, headers: None)
+        tracemalloc.start()
+        try:
+            size = 0
+            for chunk in app_iter:
+                size += len(chunk)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            app_iter.close()
+            tracemalloc.stop()
+        self.assertGreater(size, 2_000_000)
+        # A few batches of 500 rows, not the whole result
+        self.assertLess(peak, size / 4, peak)
+
+
+class CryptoTests(unittest.TestCase):
+    kdf_params = {'n': 2 ** 10, 'r': 8, 'p': 1}
+
+    def test_derive_and_decrypt(self):
+        from .crypto import CryptoEngine, DecryptionError, encrypt
+        for workers in (0, 1):
+            engine = CryptoEngine(workers=workers, kdf_params=self.kdf_params,
+                                  offload_threshold=5)
+            self.addCleanup(engine.close)
+            key = engine.derive_key('master', b'0' * 16)
+            self.assertEqual(key, engine.derive_key('master', b'0' * 16))
+            self.assertNotEqual(key, engine.derive_key('master', b'1' * 16))
+            values = [encrypt(key, f'secret {i}'.encode(), b'%d' % i)
+                      for i in range(10)]
+            self.assertEqual(
+                engine.decrypt_many(key, values, [b'%d' % i for i in range(10)]),
+                [f'secret {i}'.encode() for i in range(10)],
+            )
+            with self.assertRaises(DecryptionError):
+                engine.decrypt_many(key, values)
+
+    def test_busy(self):
+        from .crypto import CryptoBusy, CryptoEngine
+        engine = CryptoEngine(workers=0, max_pending=1,
+                              kdf_params=self.kdf_params)
+        engine._slots.acquire()
+        with self.assertRaises(CryptoBusy):
+            engine.derive_key('master', b'0' * 16)
+        engine._slots.release()
+        engine.derive_key('master', b'0' * 16)
+
+    def test_timeout(self):
+        from .crypto import CryptoEngine, CryptoTimeout
+        engine = CryptoEngine(workers=1, timeout=0.01,
+                              kdf_params={'n': 2 ** 16, 'r': 8, 'p': 4})
+        self.addCleanup(engine.close)
+        with self.assertRaises(CryptoTimeout):
+            engine.derive_key('master', b'0' * 16)
+
+    def test_key_cache_eviction(self):
+        from pyramid.interfaces import ISessionFactory
+        settings = {
+            'sqlalchemy.url': 'sqlite://',
+            'pvault.crypto.workers': '0',
+            'pvault.crypto.n': str(2 ** 10),
+        }
+        config = _make_config(settings)
+        config.commit()
+        factory = config.registry.queryUtility(ISessionFactory)
+        engine = config.registry['crypto']
+        self.assertEqual(engine.keys.ttl, factory.max_age)
+
+        request = testing.DummyRequest(scheme='http')
+        request.session = session = factory(request)
+        key = engine.unlock(session, 'master', b'0' * 16)
+        self.assertEqual(engine.session_key(session), key)
+        self.assertNotIn(key, engine.keys._keys[session.sid][1])
+
+        session.invalidate()
+        factory._prepare_response(request, request.response)
+        self.assertEqual(len(engine.keys), 0)
+
+
+class ListingCacheTests(unittest.TestCase):
+    def setUp(self):
+        import fakeredis
+        import sqlalchemy
+        from sqlalchemy.orm import registry
+        from .db import _get_session_factory
+        from .listcache import (
+            ListingCache,
+            invalidate_executed,
+            invalidate_flushed,
+        )
+
+        @registry().mapped
+        class Entry(object):
+            __tablename__ = 'entry'
+            __listing_owner__ = 'user_id'
+            id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+            user_id = sqlalchemy.Column(sqlalchemy.String)
+
+        self.Entry = Entry
+        engine = sqlalchemy.create_engine('sqlite://')
+        Entry.__table__.create(engine)
+        self.session_factory = _get_session_factory(engine)
+        self.cache = ListingCache(fakeredis.FakeStrictRedis())
+        sqlalchemy.event.listen(
+            self.session_factory, 'after_flush', invalidate_flushed(self.cache)
+        )
+        sqlalchemy.event.listen(
+            self.session_factory, 'do_orm_execute',
+            invalidate_executed(self.cache),
+        )
+
+    def _listing(self, user_id):
+        return self.cache.get(user_id, lambda: [f'entries of {user_id}'])
+
+    def test_hits(self):
+        self.assertEqual(self._listing('alice'), ['entries of alice'])
+        self.assertEqual(self._listing('alice'), ['entries of alice'])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        self.cache.invalidate('alice')
+        self._listing('alice')
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_invalidate_on_commit(self):
+        import transaction
+        from .db import get_tm_session
+        manager = transaction.TransactionManager(explicit=True)
+        self._listing('alice')
+        self._listing('bob')
+
+        with manager:
+            dbsession = get_tm_session(self.session_factory, manager)
+            dbsession.add(self.Entry(id=1, user_id='alice'))
+            dbsession.flush()
+            self.assertEqual(self.cache.version('alice'), 0)
+        self.assertEqual(self.cache.version('alice'), 1)
+        self.assertEqual(self.cache.version('bob'), 0)
+
+        # Aborted: no invalidation
+        manager.begin()
+        dbsession = get_tm_session(self.session_factory, manager)
+        dbsession.get(self.Entry, 1).user_id = 'bob'
+        dbsession.flush()
+        manager.abort()
+        self.assertEqual(self.cache.version('bob'), 0)
+
+        # Owner changed: both users
+        with manager:
+            dbsession = get_tm_session(self.session_factory, manager)
+            dbsession.get(self.Entry, 1).user_id = 'bob'
+        self.assertEqual(self.cache.version('alice'), 2)
+        self.assertEqual(self.cache.version('bob'), 1)
+        self.assertEqual(self.cache.stats()['invalidations'], 3)
+
+    def test_bulk_statements(self):
+        import transaction
+        from sqlalchemy import delete, update
+        from .db import get_tm_session
+        manager = transaction.TransactionManager(explicit=True)
+        with manager:
+            dbsession = get_tm_session(self.session_factory, manager)
+            dbsession.add_all([
+                self.Entry(id=1, user_id='alice'),
+                self.Entry(id=2, user_id='bob'),
+                self.Entry(id=3, user_id='carol'),
+            ])
+        versions = {user: self.cache.version(user)
+                    for user in ('alice', 'bob', 'carol')}
+
+        with manager:
+            dbsession = get_tm_session(self.session_factory, manager)
+            dbsession.execute(
+                update(self.Entry).where(self.Entry.id < 3)
+                .values(user_id='alice')
+            )
+        self.assertEqual(self.cache.version('alice'), versions['alice'] + 1)
+        self.assertEqual(self.cache.version('bob'), versions['bob'] + 1)
+        self.assertEqual(self.cache.version('carol'), versions['carol'])
+
+        # By primary key
+        with manager:
+            dbsession = get_tm_session(self.session_factory, manager)
+            dbsession.execute(update(self.Entry), [{'id': 3, 'user_id': 'x'}])
+        self.assertEqual(self.cache.version('carol'), versions['carol'] + 1)
+        self.assertEqual(self.cache.version('alice'), versions['alice'] + 1)
+
+        with manager:
+            dbsession = get_tm_session(self.session_factory, manager)
+            dbsession.execute(delete(self.Entry))
+        self.assertEqual(self.cache.version('alice'), versions['alice'] + 2)
+
+    def test_uncommitted_listing(self):
+        import transaction
+        from sqlalchemy import select
+        from .db import get_tm_session
+        manager = transaction.TransactionManager(explicit=True)
+
+        def listing(dbsession):
+            return self.cache.get('alice', lambda: list(dbsession.scalars(
+                select(self.Entry.id).where(self.Entry.user_id == 'alice')
+            )), manager.get())
+
+        manager.begin()
+        dbsession = get_tm_session(self.session_factory, manager)
+        dbsession.add(self.Entry(id=1, user_id='alice'))
+        self.assertEqual(listing(dbsession), [1])
+        manager.abort()
+
+        with manager:
+            dbsession = get_tm_session(self.session_factory, manager)
+            self.assertEqual(listing(dbsession), [])
+            self.assertEqual(listing(dbsession), [])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+
+class ConditionalGetTests(unittest.TestCase):
+    def setUp(self):
+        from webtest import TestApp
+        settings = {'sqlalchemy.url': 'sqlite://'}
+        config = _make_config(settings)
+        self.calls = []
+        self.version = '1'
+
+        def view(request):
+            self.calls.append(request)
+            return {'version': self.version}
+        config.add_route('versioned', '/versioned')
+        config.add_view(view, route_name='versioned', renderer='json',
+                        etag=lambda request: self.version)
+        self.testapp = TestApp(config.make_wsgi_app())
+
+    def test_not_modified(self):
+        res = self.testapp.get('/versioned', status=200)
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache, private')
+        self.assertEqual(res.headers['Vary'], 'Cookie')
+        etag = res.headers['ETag']
+        res = self.testapp.get(
+            '/versioned', headers={'If-None-Match': etag}, status=304
+        )
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(self.calls), 1)
+
+        self.version = '2'
+        self.testapp.get(
+            '/versioned', headers={'If-None-Match': etag}, status=200
+        )
+        self.assertEqual(len(self.calls), 2)
+
+    def test_session_cookie(self):
+        etag = self.testapp.get('/versioned').headers['ETag']
+        self.testapp.set_cookie('session_id', 'another-user')
+        res = self.testapp.get(
+            '/versioned', headers={'If-None-Match': etag}, status=200
+        )
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_home(self):
+        etag = self.testapp.get('/', status=200).headers['ETag']
+        self.testapp.get('/', headers={'If-None-Match': etag}, status=304)
+
+
+class HashedAssetsTests(unittest.TestCase):
+    def setUp(self):
+        from webtest import TestApp
+        settings = {'sqlalchemy.url': 'sqlite://'}
+        self.config = _make_config(settings)
+        self.testapp = TestApp(self.config.make_wsgi_app())
+
+    def test_manifest(self):
+        import os
+        import gzip
+        import tempfile
+        from .assets import build_manifest
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'css'))
+            path = os.path.join(directory, 'css', 'app.css')
+            with open(path, 'w') as asset:
+                asset.write('body {}')
+            with gzip.open(path + '.gz', 'wb') as asset:
+                asset.write(b'body {}')
+            manifest = build_manifest(directory)
+        self.assertEqual(list(manifest), ['css/app.css'])
+        self.assertRegex(manifest['css/app.css'],
+                         r'^css/app\.[0-9a-f]{12}\.css$')
+
+    def test_hashed_url(self):
+        from .assets import build_manifest
+        from pyramid.path import AssetResolver
+        manifest = build_manifest(
+            AssetResolver().resolve('pvault:static').abspath()
+        )
+        request = testing.DummyRequest()
+        request.registry = self.config.registry
+        url = request.static_url('pvault:static/theme.css')
+        self.assertEqual(
+            url, 'http://example.com/static/' + manifest['theme.css']
+        )
+        res = self.testapp.get(url[len('http://example.com'):], status=200)
+        self.assertEqual(res.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        self.assertIn('body', res.text)
+
+    def test_unhashed_url(self):
+        res = self.testapp.get('/static/theme.css', status=200)
+        self.assertEqual(res.headers['Cache-Control'], 'max-age=3600')
+
+    def test_deployment_id(self):
+        import os
+        import tempfile
+        from .assets import add_hashed_static_view
+        registry = self.config.registry
+        deployment_ids = [registry['deployment_id']]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'app.css')
+            for content in ('body {}', 'body {}', 'p {}'):
+                with open(path, 'w') as asset:
+                    asset.write(content)
+                registry['deployment_id'] = deployment_ids[0]
+                add_hashed_static_view(self.config, 'other', directory)
+                deployment_ids.append(registry['deployment_id'])
+        # The home page ETag changes with the assets only
+        self.assertNotEqual(deployment_ids[0], deployment_ids[1])
+        self.assertEqual(deployment_ids[1], deployment_ids[2])
+        self.assertNotEqual(deployment_ids[2], deployment_ids[3])
+
+
+class TemplatingTests(unittest.TestCase):
+    def _app(self, settings):
+        from webtest import TestApp
+        return TestApp(_make_config(settings).make_wsgi_app())
+
+    def test_precompile(self):
+        import os
+        import tempfile
+        from pyramid.config import Configurator
+        from .templating import get_environment, precompile, template_names
+        with tempfile.TemporaryDirectory() as directory:
+            settings = {
+                'sqlalchemy.url': 'sqlite://',
+                'jinja2.bytecode_caching': 'true',
+                'jinja2.bytecode_caching_directory': directory,
+            }
+            config = Configurator(settings=dict(settings), package='pvault')
+            config.include('pyramid_jinja2')
+            config.commit()
+            names = precompile(get_environment(config.registry),
+                               template_names())
+            self.assertIn('pvault:templates/home.jinja2', names)
+            compiled = {
+                name: os.path.getmtime(os.path.join(directory, name))
+                for name in os.listdir(directory)
+            }
+            self.assertEqual(len(compiled), len(names))
+
+            # The renderers of the application use the compiled templates
+            testapp = self._app(settings)
+            testapp.get('/', status=200)
+            testapp.get('/test', status=200)
+            self.assertEqual({
+                name: os.path.getmtime(os.path.join(directory, name))
+                for name in os.listdir(directory)
+            }, compiled)
+
+    def test_redis_cache(self):
+        import fakeredis
+        from .templating import RedisBytecodeClient, includeme
+        client = RedisBytecodeClient(fakeredis.FakeStrictRedis())
+        self.assertIsNone(client.get('key'))
+        client.set('key', b'bytecode', timeout=60)
+        self.assertEqual(client.get('key'), b'bytecode')
+        self.assertTrue(0 < client.client.ttl('key') <= 60)
+
+        config = testing.setUp(settings={
+            'pvault.templates.bytecode_cache.redis_url': 'redis://localhost',
+        })
+        try:
+            includeme(config)
+            settings = config.get_settings()
+            self.assertIs(settings['jinja2.bytecode_caching'],
+                          config.registry['template_cache'])
+        finally:
+            testing.tearDown()
+
+
+class RegistrationTests(unittest.TestCase):
+    # Generous: the regression test catches a new slow import or scan, not
+    # a slow machine
+    STARTUP_BUDGET = 5.0
+
+    def _views(self, registration):
+        from . import make_config, session_factory_from_settings
+        settings = {
+            'sqlalchemy.url': 'sqlite://',
+            'pvault.registration': registration,
+            SECRET_SETTING: 'seekrit',
+        }
+        config = make_config(settings,
+                             session_factory_from_settings(settings))
+        config.commit()
+        return sorted(
+            (str(view['route_name']), repr(view['context']),
+             view['callable'].__name__)
+            for view in (
+                item['introspectable']
+                for item in config.registry.introspector.get_category('views')
+            )
+            if view['callable'].__module__.startswith('pvault')
+        )
+
+    def test_manifest_up_to_date(self):
+        from .scripts.manifest import MANIFEST, generate
+        with open(MANIFEST, encoding='utf8') as manifest:
+            self.assertEqual(manifest.read(), generate(),
+                             'pvault/manifest.py is stale, run pvault-manifest')
+
+    def test_manifest_registration(self):
+        views = self._views('manifest')
+        self.assertEqual(views, self._views('scan'))
+        self.assertIn(('home', 'None', 'home_view'), views)
+
+    def test_startup_time(self):
+        import sys
+        import json
+        import subprocess
+        code = '''if True:
+            import sys, json, time
+            start = time.perf_counter()
+            from pvault import make_config, session_factory_from_settings
+            settings = {
+                'sqlalchemy.url': 'sqlite://',
+                'pvault.registration': 'manifest',
+                'hero_million.session.secret': 'seekrit',
+            }
+            make_config(
+                settings, session_factory_from_settings(settings)
+            ).make_wsgi_app()
+            print(json.dumps({
+                'seconds': time.perf_counter() - start,
+                'modules': sorted(sys.modules),
+            }))
+        '''
+        result = json.loads(subprocess.run(
+            [sys.executable, '-c', code], stdout=subprocess.PIPE,
+            check=True, text=True,
+        ).stdout)
+        for module in ('pvault.tests', 'pvault.scripts',
+                       'pyramid_debugtoolbar', 'concurrent.futures.process'):
+            self.assertNotIn(module, result['modules'])
+        self.assertLess(result['seconds'], self.STARTUP_BUDGET)
+
+
+class LoadTestTests(unittest.TestCase):
+    def test_parse_mix(self):
+        import argparse
+        from .scripts.loadtest import parse_mix
+        self.assertEqual(parse_mix('session_read=3,db'),
+                         {'session_read': 3.0, 'db': 1.0})
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_mix('vault=1')
+
+    def test_run(self):
+        import fakeredis
+        from pyramid.interfaces import ISessionFactory
+        from . import main
+        from .scripts.loadtest import parse_args, run
+        app = main({}, **{
+            'sqlalchemy.url': 'sqlite://',
+            'pyramid.includes': 'pvault.loadtest',
+            SECRET_SETTING: 'seekrit',
+        })
+        factory = app.registry.queryUtility(ISessionFactory)
+        factory.ring = HashRing({'default': fakeredis.FakeStrictRedis()})
+        options = parse_args([
+            'pvault-loadtest', 'test.ini', '--clients', '2', '--threads', '2',
+            '--duration', '0.5', '--warmup', '0.1',
+        ])
+        results = run(app, options)
+        self.assertGreater(results['total']['requests'], 0)
+        self.assertEqual(results['total']['errors'], 0)
+        self.assertEqual(results['kinds']['db']['db_per_request'], 1.0)
+        self.assertGreaterEqual(
+            results['kinds']['session_write']['redis_per_request'], 1.0
+        )
+
+
+class BenchmarkCompareTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import importlib.util
+        path = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)),
+            'benchmarks', 'compare.py',
+        )
+        spec = importlib.util.spec_from_file_location('compare', path)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+    def _results(self, **medians):
+        return {
+            name: {'name': name, 'hot': not name.startswith('cold'),
+                   'stats': {'median': median, 'stddev': 0.1}}
+            for name, median in medians.items()
+        }
+
+    def test_pass(self):
+        baseline = self._results(session=10.0, cold=10.0)
+        current = self._results(session=10.5, cold=20.0, new=1.0)
+        lines, failures = self.module.compare(baseline, current, 10.0)
+        self.assertEqual(failures, [])
+        self.assertTrue(any('(new)' in line for line in lines))
+        self.assertTrue(any('not hot' in line for line in lines))
+
+    def test_threshold(self):
+        baseline = self._results(session=10.0)
+        lines, failures = self.module.compare(
+            baseline, self._results(session=11.5), 10.0
+        )
+        self.assertEqual(failures, ['session'])
+        self.assertIn('REGRESSION', lines[-1])
+        self.assertEqual(self.module.compare(
+            baseline, self._results(session=11.5), 20.0
+        )[1], [])
+
+    def test_missing(self):
+        baseline = self._results(session=10.0, cold=10.0)
+        lines, failures = self.module.compare(
+            baseline, self._results(renamed=10.0), 10.0
+        )
+        self.assertEqual(failures, ['session', 'cold'])
+        self.assertEqual(
+            sum('MISSING' in line for line in lines), 2
+        )
@@ -1,7 +1,10 @@
 from pyramid.view import view_config
 
+from .conditional import deployment_etag
 
-@view_config(route_name='home', renderer='templates/home.jinja2')
+
+@view_config(route_name='home', renderer='templates/home.jinja2',
+             etag=deployment_etag)
 def home_view(request):
     return {'project': 'pvault'}
 
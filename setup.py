@@ -38,6 +38,9 @@ REQUIRES = [
     # Signing
     'itsdangerous',
 
+    # Encryption of the sessions stored in cookies
+    'cryptography',
+
     'plaster_pastedeploy',
 ]
 
@@ -65,6 +68,7 @@ DEV_REQUIRES = [
     'webtest',
     'pytest',
     'pytest-cov',
+    'fakeredis',
 
     # Docs
     'sphinx',
@@ -97,6 +101,10 @@ setup(
     install_requires=REQUIRES,
     extras_require={
         'dev': DEV_REQUIRES,
+        # lz4 compression of the sessions
+        'lz4': ['lz4'],
+        # pvault-loadtest (fakeredis for --fakeredis)
+        'loadtest': ['waitress', 'fakeredis'],
     },
 
     packages=find_packages(),
@@ -105,6 +113,14 @@ setup(
     entry_points={
         'paste.app_factory': [
             'main = pvault:main',
+            'asgi = pvault.asgi:main',
+        ],
+        'console_scripts': [
+            'pvault-bulk = pvault.scripts.bulk:main',
+            'pvault-templates = pvault.scripts.templates:main',
+            'pvault-manifest = pvault.scripts.manifest:main',
+            'pvault-startup-profile = pvault.scripts.startup:main',
+            'pvault-loadtest = pvault.scripts.loadtest:main',
         ],
     },
 )